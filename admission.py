@@ -0,0 +1,326 @@
+import asyncio
+import contextvars
+import heapq
+import itertools
+import os
+import random
+import threading
+import time
+
+from contextlib import contextmanager
+
+from google.api_core import exceptions as google_exceptions
+
+from deadline import current_deadline
+from metrics import gemini_admission_shed, gemini_throttled
+from tracing import span
+
+# Gemini quota, as requests per minute, and how many calls may start at once
+# after an idle spell
+GEMINI_RATE_LIMIT_RPM = float(os.getenv("GEMINI_RATE_LIMIT_RPM", "600"))
+GEMINI_BURST = int(os.getenv("GEMINI_BURST", "20"))
+# Longest a call may wait for a slot before it is shed, per priority class
+GEMINI_INTERACTIVE_DEADLINE = float(os.getenv("GEMINI_INTERACTIVE_DEADLINE", "8"))
+GEMINI_BACKGROUND_DEADLINE = float(os.getenv("GEMINI_BACKGROUND_DEADLINE", "60"))
+GEMINI_INTERACTIVE_QUEUE_MAX = int(os.getenv("GEMINI_INTERACTIVE_QUEUE_MAX", "100"))
+GEMINI_BACKGROUND_QUEUE_MAX = int(os.getenv("GEMINI_BACKGROUND_QUEUE_MAX", "20"))
+# Times a call that got a 429 is re-admitted and retried
+GEMINI_THROTTLE_RETRIES = int(os.getenv("GEMINI_THROTTLE_RETRIES", "1"))
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BACKGROUND = 1
+PRIORITY_NAMES = {PRIORITY_INTERACTIVE: "interactive", PRIORITY_BACKGROUND: "background"}
+
+THROTTLE_ERRORS = (google_exceptions.ResourceExhausted, google_exceptions.TooManyRequests)
+
+# Backoff after a 429: THROTTLE_BACKOFF * 2^(consecutive 429s - 1), capped
+THROTTLE_BACKOFF = 0.5
+THROTTLE_BACKOFF_MAX = 30.0
+
+# Priority of Gemini calls made in this context. Request handlers are
+# interactive; pool refill workers mark themselves as background.
+_current_priority = contextvars.ContextVar("gemini_priority", default=PRIORITY_INTERACTIVE)
+
+
+@contextmanager
+def priority(level):
+    """Run the enclosed Gemini calls at the given priority class."""
+    token = _current_priority.set(level)
+    try:
+        yield
+    finally:
+        _current_priority.reset(token)
+
+
+def current_priority():
+    return _current_priority.get()
+
+
+class GeminiOverloaded(RuntimeError):
+    """A Gemini call was shed: its queue was full or it could not start before its deadline."""
+
+
+class _Waiter:
+    def __init__(self, level, deadline, loop=None):
+        self.priority = level
+        self.deadline = deadline
+        self.granted = False
+        self.cancelled = False
+        self.loop = loop
+        if loop is None:
+            self.event = threading.Event()
+        else:
+            self.future = loop.create_future()
+
+    def wake(self):
+        if self.loop is None:
+            self.event.set()
+        else:
+            self.loop.call_soon_threadsafe(self._resolve)
+
+    def _resolve(self):
+        if not self.future.done():
+            self.future.set_result(None)
+
+
+class GeminiScheduler:
+    """
+    Admission control for Gemini calls.
+
+    Calls take a token from a bucket refilled at the quota rate. When none is
+    free they queue by priority class (interactive ahead of background), and
+    within a class in arrival order. A call is shed with GeminiOverloaded
+    instead of queued when its class's queue is full or the expected wait runs
+    past its deadline, and shed from the queue if its deadline passes there.
+
+    A 429 from Gemini halves the admitted rate and pauses admissions with
+    exponential backoff; 429s for calls sent before that backoff began don't
+    start another. Each success adds back 5% of the quota until the full rate
+    is restored. Throttled calls are re-admitted up to throttle_retries
+    times, so retries wait their turn instead of piling on.
+    """
+
+    def __init__(self, rate_per_minute=GEMINI_RATE_LIMIT_RPM, burst=GEMINI_BURST,
+                 deadlines=None, queue_limits=None, throttle_retries=GEMINI_THROTTLE_RETRIES):
+        self.max_rate = rate_per_minute / 60
+        self.rate = self.max_rate
+        self.min_rate = self.max_rate / 10
+        self.burst = burst
+        self.tokens = float(burst)
+        self.deadlines = deadlines or {
+            PRIORITY_INTERACTIVE: GEMINI_INTERACTIVE_DEADLINE, PRIORITY_BACKGROUND: GEMINI_BACKGROUND_DEADLINE
+        }
+        self.queue_limits = queue_limits or {
+            PRIORITY_INTERACTIVE: GEMINI_INTERACTIVE_QUEUE_MAX, PRIORITY_BACKGROUND: GEMINI_BACKGROUND_QUEUE_MAX
+        }
+        self.throttle_retries = throttle_retries
+        self.paused_until = 0.0
+        self.consecutive_throttles = 0
+        self._throttled_at = float("-inf")
+        self._updated = time.monotonic()
+        self._heap = []
+        self._seq = itertools.count()
+        self._queued = {level: 0 for level in PRIORITY_NAMES}
+        self._cond = threading.Condition()
+        self._dispatcher = None
+        self.stats = {"admitted": 0, "queued": 0, "shed_queue_full": 0, "shed_deadline": 0, "throttled": 0, "retried": 0}
+
+    # ---------- token bucket (call with the lock held) ----------
+
+    def _refill(self, now):
+        # No tokens accrue while admissions are paused after a 429
+        start = max(self._updated, self.paused_until)
+        if now > start:
+            self.tokens = min(self.burst, self.tokens + (now - start) * self.rate)
+        self._updated = max(self._updated, now)
+
+    def _expected_wait(self, now, ahead):
+        """Seconds until a caller with `ahead` queued callers in front of it would get a token."""
+        short = ahead + 1 - self.tokens
+        return max(self.paused_until - now, 0.0) + max(short, 0.0) / self.rate
+
+    def _shed(self, level, reason):
+        self.stats[f"shed_{reason}"] += 1
+        gemini_admission_shed.inc(PRIORITY_NAMES[level], reason)
+        raise GeminiOverloaded(f"Gemini {PRIORITY_NAMES[level]} call shed: {reason.replace('_', ' ')}")
+
+    def _enqueue(self, level, deadline, loop=None):
+        """Take a token now (returns None) or queue a waiter for one, shedding if that can't work out."""
+        now = time.monotonic()
+        self._refill(now)
+        if not self._heap and now >= self.paused_until and self.tokens >= 1:
+            self.tokens -= 1
+            self.stats["admitted"] += 1
+            return None
+
+        if self._queued[level] >= self.queue_limits[level]:
+            self._shed(level, "queue_full")
+        ahead = sum(count for other, count in self._queued.items() if other <= level)
+        if now + self._expected_wait(now, ahead) > deadline:
+            self._shed(level, "deadline")
+
+        waiter = _Waiter(level, deadline, loop)
+        heapq.heappush(self._heap, (level, next(self._seq), waiter))
+        self._queued[level] += 1
+        self.stats["queued"] += 1
+        if self._dispatcher is None:
+            self._dispatcher = threading.Thread(target=self._dispatch, name="gemini-admission", daemon=True)
+            self._dispatcher.start()
+        self._cond.notify()
+        return waiter
+
+    def _grant(self, now):
+        """Hand the tokens accrued by `now` to queued callers in priority order (call with the lock held)."""
+        self._refill(now)
+        while self._heap and now >= self.paused_until and self.tokens >= 1:
+            _, _, waiter = heapq.heappop(self._heap)
+            if waiter.cancelled:
+                continue
+            self._queued[waiter.priority] -= 1
+            if waiter.deadline <= now:
+                # Too late to be useful; the caller sheds it when it wakes
+                waiter.cancelled = True
+            else:
+                self.tokens -= 1
+                waiter.granted = True
+                self.stats["admitted"] += 1
+            waiter.wake()
+
+    def _dispatch(self):
+        """Worker thread: grant tokens to queued callers as they accrue."""
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                self._grant(now)
+                if not self._heap:
+                    self._cond.wait()
+                else:
+                    self._cond.wait(max(self.paused_until - now, (1 - self.tokens) / self.rate, 0.001))
+
+    def _finish_wait(self, waiter):
+        """After a queued caller wakes or times out: return if it got a token, otherwise shed it."""
+        with self._cond:
+            if waiter.granted:
+                return
+            if not waiter.cancelled:
+                waiter.cancelled = True
+                self._queued[waiter.priority] -= 1
+            self._shed(waiter.priority, "deadline")
+
+    # ---------- admission ----------
+
+    def acquire(self, level=None, deadline=None):
+        """Block until this call may go to Gemini. Raises GeminiOverloaded if it is shed."""
+        level = current_priority() if level is None else level
+        deadline = deadline or time.monotonic() + self.deadlines[level]
+        with self._cond:
+            waiter = self._enqueue(level, deadline)
+        if waiter is None:
+            return
+
+        with span("gemini-admission", PRIORITY_NAMES[level]):
+            waiter.event.wait(max(deadline - time.monotonic(), 0.0))
+        self._finish_wait(waiter)
+
+    async def acquire_async(self, level=None, deadline=None):
+        level = current_priority() if level is None else level
+        deadline = deadline or time.monotonic() + self.deadlines[level]
+        with self._cond:
+            waiter = self._enqueue(level, deadline, asyncio.get_running_loop())
+        if waiter is None:
+            return
+
+        try:
+            with span("gemini-admission", PRIORITY_NAMES[level]):
+                await asyncio.wait_for(asyncio.shield(waiter.future), max(deadline - time.monotonic(), 0.0))
+        except asyncio.TimeoutError:
+            pass
+        except asyncio.CancelledError:
+            with self._cond:
+                if not waiter.granted and not waiter.cancelled:
+                    waiter.cancelled = True
+                    self._queued[waiter.priority] -= 1
+            raise
+        self._finish_wait(waiter)
+
+    def _throttled(self, sent_at):
+        with self._cond:
+            self.stats["throttled"] += 1
+            # Calls sent before the last backoff began hit the same overload; only back off once for it
+            if sent_at >= self._throttled_at:
+                self._throttled_at = time.monotonic()
+                self.consecutive_throttles += 1
+                self.rate = max(self.min_rate, self.rate / 2)
+                self.tokens = min(self.tokens, 0.0)
+                backoff = min(THROTTLE_BACKOFF * 2 ** (self.consecutive_throttles - 1), THROTTLE_BACKOFF_MAX)
+                self.paused_until = max(self.paused_until, self._throttled_at + backoff * random.uniform(0.8, 1.2))
+                self._cond.notify()
+        gemini_throttled.inc()
+
+    def _succeeded(self):
+        with self._cond:
+            self.consecutive_throttles = 0
+            if self.rate < self.max_rate:
+                self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+
+    def _retry_throttled(self, attempt, sent_at):
+        self._throttled(sent_at)
+        if attempt >= self.throttle_retries:
+            return False
+        with self._cond:
+            self.stats["retried"] += 1
+        return True
+
+    def _deadline(self, level):
+        """Latest time a call may start: its class's deadline, or sooner if the request's budget runs out first."""
+        deadline = time.monotonic() + self.deadlines[level]
+        request = current_deadline()
+        return deadline if request is None else min(deadline, request.expires)
+
+    def call(self, fn):
+        """Run fn() once admitted, re-admitting it after a 429 up to throttle_retries times."""
+        level = current_priority()
+        deadline = self._deadline(level)
+        for attempt in itertools.count():
+            self.acquire(level, deadline)
+            sent_at = time.monotonic()
+            try:
+                result = fn()
+            except THROTTLE_ERRORS:
+                if not self._retry_throttled(attempt, sent_at):
+                    raise
+                continue
+            self._succeeded()
+            return result
+
+    async def call_async(self, fn):
+        """asyncio counterpart of call(); fn is a coroutine function."""
+        level = current_priority()
+        deadline = self._deadline(level)
+        for attempt in itertools.count():
+            await self.acquire_async(level, deadline)
+            sent_at = time.monotonic()
+            try:
+                result = await fn()
+            except THROTTLE_ERRORS:
+                if not self._retry_throttled(attempt, sent_at):
+                    raise
+                continue
+            self._succeeded()
+            return result
+
+    def get_stats(self):
+        with self._cond:
+            self._refill(time.monotonic())
+            stats = dict(self.stats)
+            stats.update({
+                "rate_per_minute": round(self.rate * 60, 1),
+                "max_rate_per_minute": round(self.max_rate * 60, 1),
+                "tokens": round(self.tokens, 2),
+                "paused_for": round(max(self.paused_until - time.monotonic(), 0.0), 2),
+                "queued_now": {PRIORITY_NAMES[level]: count for level, count in self._queued.items()},
+            })
+        return stats
+
+
+gemini_scheduler = GeminiScheduler()
@@ -1,10 +1,16 @@
-import json
 import os
 import time
-from recommendation import map_names_to_entity_ids, get_recommendations, get_single_example,  get_item_details, get_activity_recommendations_by_mood, get_genre_based_examples, merge_and_map_entity_ids, get_recommendations_for_activities, get_community_example, find_entity_id, fetch_individual_recommendation, get_opposite_community_journey_cards, get_examples_for_user_and_friends, enrich_recommendations_with_details, get_contrasting_examples, map_examples_to_entity_ids, get_recommendations_from_entity_ids, generate_descriptions_with_categories, generate_group_descriptions
+from recommendation import map_names_to_entity_ids, get_recommendations, get_single_example,  get_item_details, get_community_example, find_entity_id, resolve_entity_ids, resolve_entity_id_list, fetch_individual_recommendation, fetch_pooled_recommendation, get_examples_for_user_and_friends, enrich_recommendations_with_details, get_contrasting_examples, map_examples_to_entity_ids, get_recommendations_from_entity_ids, generate_descriptions_with_categories, generate_group_descriptions, iter_seed_recommendations, pop_community_example, community_example_pool, get_journey_deck, journey_deck_store, mood_example_pool, get_daily_recommendations, warm_example_pools, entity_cache, insights_cache, candidate_pool, gemini, qloo_flights, group_description_batcher, enrichment_batcher, descriptions_batcher, ROUTE_ENTITY_TYPE_MAP as ENTITY_TYPE_MAP
 
-from flask import Flask, request, jsonify
+from flask import Flask, Response, g, request, jsonify, stream_with_context
 from flask_cors import CORS
+from streaming import STREAM_HEADERS, SSE_KEEPALIVE, format_event, stream_mimetype, wants_sse
+from metrics import CONTENT_TYPE, http_request_duration, render_metrics
+from tracing import end_trace, start_trace, wants_timing_debug
+from deadline import budget_for, degraded_parts, end_deadline, start_deadline
+from cassette import cassette
+from qloo_client import qloo_breaker, qloo_hedger
+from jobs import JOB_EVENTS_KEEPALIVE, JobQueueFull, job_queue
 import logging
 
 # Enable more detailed logging
@@ -13,18 +19,57 @@ logging.basicConfig(level=logging.DEBUG)
 app = Flask(__name__)
 CORS(app, resources={r"/*": {"origins": "*"}})
 
-ENTITY_TYPE_MAP = {
-    "movies": "urn:entity:movie",
-    "books": "urn:entity:book",
-    "travel": "urn:entity:place",
-    "podcast":"urn:entity:podcast",
-    "videogame":"urn:entity:videogame",
-    "video games":"urn:entity:videogame",
-    "tv_show":"urn:entity:tv_show",
-    "tv shows":"urn:entity:tv_show",
-    "artist":"urn:entity:artist",
-    "music":"urn:entity:album"
-}
+# Pre-generate community examples, journey decks and mood examples before the first requests ask for them
+warm_example_pools()
+
+
+@app.before_request
+def start_request_trace():
+    g.request_started = time.perf_counter()
+    g.trace, g.trace_token = start_trace()
+    g.deadline, g.deadline_token = start_deadline(budget_for(request.url_rule.rule if request.url_rule else None))
+    if cassette is not None and cassette.recording:
+        cassette.record_inbound(request.method, request.path, request.get_json(silent=True))
+
+
+@app.after_request
+def add_server_timing(response):
+    """Attach Server-Timing to every response, and the full waterfall to JSON bodies on request."""
+    if "request_started" in g:
+        endpoint = request.url_rule.rule if request.url_rule else "unmatched"
+        http_request_duration.observe(
+            time.perf_counter() - g.request_started, endpoint, request.method, response.status_code
+        )
+
+    trace = g.get("trace")
+    if trace is None:
+        return response
+
+    response.headers["Server-Timing"] = trace.server_timing()
+    response.headers["Timing-Allow-Origin"] = "*"
+    # Parts of the response built from cached or default data, e.g. when a stage would have missed the deadline
+    degraded = g.deadline.degraded() if "deadline" in g else []
+    timing = wants_timing_debug(request.args, request.headers)
+    if response.mimetype == "application/json" and (degraded or timing):
+        body = response.get_json(silent=True)
+        if isinstance(body, dict):
+            if degraded:
+                body["degraded"] = degraded
+            if timing:
+                body["timing"] = {"total_ms": trace.elapsed_ms(), "waterfall": trace.waterfall()}
+            response.set_data(app.json.dumps(body))
+    return response
+
+
+@app.teardown_request
+def end_request_trace(exc):
+    token = g.pop("trace_token", None)
+    if token is not None:
+        end_trace(token)
+    token = g.pop("deadline_token", None)
+    if token is not None:
+        end_deadline(token)
+
 
 # @app.route('/save-preferences', methods=['POST'])
 # def save_preferences():
@@ -81,13 +126,18 @@ def save_preferences():
     active_entity_type = ENTITY_TYPE_MAP.get(active_category.lower())
     example_entity_type = ENTITY_TYPE_MAP.get(example_category.lower())
     all_recommendations = []
-    
-    for example in seed_examples:
+
+    # Resolve both seeds at once
+    lookups = resolve_entity_ids((example, example_entity_type) for example in seed_examples)
+
+    for example, lookup in zip(seed_examples, lookups):
         try:
-            entity_id = find_entity_id(example, example_entity_type)
+            if lookup["error"]:
+                raise RuntimeError(lookup["error"])
+            entity_id = lookup["entity_id"]
             if entity_id:
                 # Get metadata (name, image)
-                metadata = fetch_individual_recommendation(entity_id, active_entity_type, take=5)
+                metadata = fetch_pooled_recommendation(entity_id, active_entity_type, take=5)
                 if metadata:
                     all_recommendations.extend(metadata)
         except Exception as e:
@@ -107,6 +157,58 @@ def save_preferences():
 
 
 
+@app.route('/save-preferences/stream', methods=['POST'])
+def save_preferences_stream():
+    """
+    Streaming /save-preferences. Emits `seeds`, then one `recommendations` event per
+    seed as soon as its batch is ready, then `group` with the title and description,
+    then `done`. NDJSON by default, SSE when the client accepts text/event-stream.
+    """
+    data = request.get_json()
+    active_category = data.get("activeCategory")
+    example_category = data.get("exampleCategory")
+    preference = data.get("preference")
+    sse = wants_sse(request.headers.get("Accept"))
+
+    print(f"\n===== Streaming per-preference flow: activeCategory='{active_category}', exampleCategory='{example_category}', preference='{preference}' =====")
+
+    def generate():
+        example_response = get_single_example(example_category, preference)
+        seed_examples = example_response.get("recommendations", [])
+
+        if not seed_examples or len(seed_examples) < 2:
+            yield format_event("error", {
+                "message": "Failed to get 2 seed examples",
+                "activeCategory": active_category
+            }, sse)
+            return
+
+        yield format_event("seeds", {"examples": seed_examples, "activeCategory": active_category}, sse)
+
+        active_entity_type = ENTITY_TYPE_MAP.get(active_category.lower())
+        example_entity_type = ENTITY_TYPE_MAP.get(example_category.lower())
+        all_recommendations = []
+
+        for example, recommendations, error in iter_seed_recommendations(
+            seed_examples, example_entity_type, active_entity_type, take=5
+        ):
+            if error:
+                print(f"❌ Failed to get metadata for '{example}': {error}")
+            all_recommendations.extend(recommendations)
+            yield format_event("recommendations", {"seed": example, "recommendations": recommendations}, sse)
+
+        group_info = generate_group_descriptions(active_category, all_recommendations)
+        yield format_event("group", {
+            "title": group_info.get("title", "Curated Selection"),
+            "description": group_info.get("description", "A thoughtfully curated selection for you."),
+            "activeCategory": active_category
+        }, sse)
+        degraded = degraded_parts()
+        yield format_event("done", {"degraded": degraded} if degraded else {}, sse)
+
+    return Response(stream_with_context(generate()), mimetype=stream_mimetype(sse), headers=STREAM_HEADERS)
+
+
 @app.route('/get-item-details', methods=['POST'])
 def get_item_details_endpoint():
     data = request.get_json()
@@ -135,29 +237,8 @@ def daily_recommendations():
     if not mood:
         return jsonify({"status": "error", "message": "Mood is required"}), 400
 
-    recommendations = get_activity_recommendations_by_mood(mood)
-
-    print(f"Recommendations: {recommendations}")
-    
-    # Only try to get preference examples if recommendations is a valid dictionary
-    preference_example = {}
-    if isinstance(recommendations, dict) and not recommendations.get('error'):
-        activity_list = list(recommendations.keys())
-        print(f"Activity list: {activity_list}")
-        
-        filtered_preferences = {k: v for k, v in preferences.items() if k in activity_list and v}
-        print("filtetred preferences is ", filtered_preferences)
-
-        preference_example = get_genre_based_examples(filtered_preferences)
-        print(f"Preference examples: {preference_example}")
-
-    entity_id_result = merge_and_map_entity_ids(recommendations, preference_example)
-    print(entity_id_result)
-
-    entity_id_json = json.dumps(entity_id_result, indent=2)
-    print(entity_id_json)
-
-    recommendations = get_recommendations_for_activities(entity_id_result, activity_list)
+    # Mood, genre examples and per-activity lookups run as overlapping stages
+    recommendations = get_daily_recommendations(mood, preferences)
     print(recommendations)
     return jsonify({
         "status": "success",
@@ -174,11 +255,16 @@ def community_recommendations():
     print(f"\n==== Community recommendations for {archetype} in {category} category ====\n")
     
     try:
-        example = get_community_example(archetype, category)
-        print("exemple is :", example)
         category = category.lower()
         entity_type = ENTITY_TYPE_MAP.get(category)
-        entity_id = find_entity_id(example, entity_type)
+        # Pre-resolved examples skip Gemini and /search; only an empty pool falls back to them
+        pooled = pop_community_example(archetype, category, entity_type)
+        if pooled:
+            example, entity_id = pooled["title"], pooled["entity_id"]
+        else:
+            example = get_community_example(archetype, category)
+            entity_id = find_entity_id(example, entity_type)
+        print("exemple is :", example)
         recommendations = fetch_individual_recommendation(entity_id, entity_type, take=5)
         print(f"API recommendations: {recommendations}")
     except Exception as e:
@@ -201,7 +287,7 @@ def mismatch_walkin_their_shoes_gemini():
 
     # Fetch opposite community journey cards
     try:
-        journey_cards = get_opposite_community_journey_cards(archetype)
+        journey_cards = get_journey_deck(archetype)
         print(f"Journey cards: {journey_cards}")
     except Exception as e:
         print(f"Failed to fetch journey cards: {e}")
@@ -223,8 +309,9 @@ def discover_journey_card_recommendations():
     try:
         category = category.lower()
         entity_type = ENTITY_TYPE_MAP.get(category)
-        entity_id = find_entity_id(item, entity_type)
-        recommendations = fetch_individual_recommendation(entity_id, entity_type, take=1)
+        # Journey cards carry a pre-resolved entity_id; clients that send it back skip /search
+        entity_id = data.get('entityId') or find_entity_id(item, entity_type)
+        recommendations = fetch_pooled_recommendation(entity_id, entity_type, take=1)
         print(f"API recommendations: {recommendations}")
     except Exception as e:
         print(f"Can't get recommendations for {item}: {e}")
@@ -235,9 +322,8 @@ def discover_journey_card_recommendations():
         "recommendations": recommendations
     }), 200
 
-@app.route('/blend-recommendations', methods=['POST'])
-def blend_recommendations():
-    data = request.get_json()
+def build_blend_recommendations(data):
+    """The /blend-recommendations pipeline, also run as a job."""
     user_preferences = data.get('userPreferences')
     friend_preferences = data.get('friendPreferences')
     print("friend preferences is ", friend_preferences)
@@ -255,12 +341,13 @@ def blend_recommendations():
     # Find entity IDs
     category = selectedActivities[0]
     entity_type = ENTITY_TYPE_MAP.get(category.lower())
-    user_preference_entity_id = find_entity_id(user_preference_example, entity_type)
+    user_preference_entity_id, *friend_entity_ids = resolve_entity_id_list(
+        [user_preference_example] + list(friend_preference_examples), entity_type
+    )
     print("user preference entity id is", user_preference_entity_id)
     
     all_entity_ids = user_preference_entity_id
-    for friend_example in friend_preference_examples:
-        friend_entity_id = find_entity_id(friend_example, entity_type)
+    for friend_entity_id in friend_entity_ids:
         if friend_entity_id:
             all_entity_ids += "," + friend_entity_id
      
@@ -269,7 +356,7 @@ def blend_recommendations():
     # Fetch recommendations
     try:
         print(f"Calling API with entity_type: {entity_type}")
-        recommendations = fetch_individual_recommendation(all_entity_ids, entity_type, take=3)
+        recommendations = fetch_pooled_recommendation(all_entity_ids, entity_type, take=3)
         print(f"API recommendations: {recommendations}")
 
         enriched_recommendations = enrich_recommendations_with_details(recommendations, selectedActivities[0])
@@ -278,16 +365,21 @@ def blend_recommendations():
         print(f"Can't get blend recommendations: {e}")
         enriched_recommendations = []
 
-    return jsonify({
+    return {
         "status": "success",
         "recommendations": enriched_recommendations,
         "activity": selectedActivities[0],
         "all_entity_ids": all_entity_ids
-    }), 200
-    
-@app.route('/swap_deck-recommendations', methods=['POST'])
-def swap_deck_recommendations():
-    data = request.get_json()
+    }
+
+
+@app.route('/blend-recommendations', methods=['POST'])
+def blend_recommendations():
+    return jsonify(build_blend_recommendations(request.get_json())), 200
+
+
+def build_swap_deck_recommendations(data):
+    """The /swap_deck-recommendations pipeline, also run as a job."""
     archetype = data.get('archetype')
 
     print(f"\n==== Swap deck recommendations for {archetype} ====\n")
@@ -313,10 +405,112 @@ def swap_deck_recommendations():
     description_with_categories = generate_descriptions_with_categories(all_titles_with_categories)
     print("desctription with categories is ", description_with_categories)
     
-    return jsonify({
+    return {
         "status": "success",
         "archetype": archetype,
         "recommendations": description_with_categories
+    }
+
+
+@app.route('/swap_deck-recommendations', methods=['POST'])
+def swap_deck_recommendations():
+    return jsonify(build_swap_deck_recommendations(request.get_json())), 200
+
+
+# Pipelines that can also be submitted as jobs, by the route they normally run under
+JOB_PIPELINES = {
+    "blend-recommendations": build_blend_recommendations,
+    "swap_deck-recommendations": build_swap_deck_recommendations,
+}
+
+
+@app.route('/jobs/<kind>', methods=['POST'])
+def submit_job(kind):
+    """
+    Run a heavy pipeline in the background. Returns the job at once; poll
+    /jobs/<id> or follow /jobs/<id>/events for its result. Identical
+    submissions share one job.
+    """
+    pipeline = JOB_PIPELINES.get(kind)
+    if pipeline is None:
+        return jsonify({"status": "error", "message": f"Unknown job type '{kind}'"}), 404
+    try:
+        job, _ = job_queue.submit(kind, request.get_json(), pipeline)
+    except JobQueueFull as e:
+        return jsonify({"status": "error", "message": str(e)}), 503
+    return jsonify({"status": "success", "job": job.to_dict()}), 202, {"Location": f"/jobs/{job.id}"}
+
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({"status": "error", "message": "Unknown or expired job"}), 404
+    return jsonify({"status": "success", "job": job.to_dict()}), 200
+
+
+@app.route('/jobs/<job_id>/events', methods=['GET'])
+def job_events(job_id):
+    """
+    Follow a job: a `state` event for each change, then `done` with the
+    finished job. NDJSON by default, SSE when the client accepts text/event-stream.
+    """
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({"status": "error", "message": "Unknown or expired job"}), 404
+    sse = wants_sse(request.headers.get("Accept"))
+
+    def generate():
+        version = None
+        while True:
+            seen, version = version, job.wait(version, JOB_EVENTS_KEEPALIVE)
+            if version == seen:
+                # Nothing changed: keep the stream from idling out, and notice a client that has gone
+                yield SSE_KEEPALIVE if sse else format_event("state", {"id": job.id, "state": job.state}, sse)
+                continue
+            snapshot = job.to_dict()
+            if job.finished:
+                yield format_event("done", snapshot, sse)
+                return
+            yield format_event("state", {"id": job.id, "state": snapshot["state"]}, sse)
+
+    return Response(generate(), mimetype=stream_mimetype(sse), headers=STREAM_HEADERS)
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Prometheus text exposition of latency histograms, error and fallback counters."""
+    return render_metrics(), 200, {"Content-Type": CONTENT_TYPE}
+
+
+@app.route('/cache-stats', methods=['GET'])
+def cache_stats():
+    return jsonify({
+        "status": "success",
+        "entity_ids": entity_cache.get_stats(),
+        "insights": insights_cache.get_stats(),
+        "candidate_pools": candidate_pool.get_stats(),
+        "community_examples": community_example_pool.get_stats(),
+        "journey_decks": journey_deck_store.get_stats(),
+        "mood_examples": mood_example_pool.get_stats(),
+        "gemini": gemini.get_stats(),
+        "coalescing": {
+            "qloo": qloo_flights.get_stats(),
+            "gemini": gemini.get_flight_stats()
+        },
+        "micro_batching": {
+            "group_description": group_description_batcher.get_stats(),
+            "enrichment": enrichment_batcher.get_stats(),
+            "descriptions_with_categories": descriptions_batcher.get_stats()
+        },
+        "gemini_admission": gemini.get_admission_stats(),
+        "qloo_hedging": qloo_hedger.get_stats() if qloo_hedger is not None else None,
+        "circuit_breakers": {
+            "qloo": qloo_breaker.get_stats(),
+            "gemini": gemini.get_breaker_stats()
+        },
+        "jobs": job_queue.get_stats(),
+        "cassette": cassette.get_stats() if cassette is not None else None
     }), 200
 
 
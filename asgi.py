@@ -0,0 +1,471 @@
+import asyncio
+import os
+import time
+
+from quart import Quart, Response, g, request, jsonify
+from quart_cors import cors
+
+from async_recommendation import (
+    get_single_example_async, get_item_details_async, get_daily_recommendations_async,
+    get_community_example_async, find_entity_id_async, resolve_entity_ids_async, resolve_entity_id_list_async,
+    fetch_individual_recommendation_async, fetch_pooled_recommendation_async,
+    get_journey_deck_async, get_examples_for_user_and_friends_async,
+    enrich_recommendations_with_details_async, get_contrasting_examples_async, map_examples_to_entity_ids_async,
+    get_recommendations_from_entity_ids_async, generate_descriptions_with_categories_async,
+    generate_group_descriptions_async, iter_seed_recommendations_async, async_candidate_pool,
+    group_description_batcher_async, enrichment_batcher_async, descriptions_batcher_async
+)
+from qloo_client import async_qloo, qloo_breaker, qloo_hedger
+from jobs import JOB_EVENTS_KEEPALIVE, JobQueueFull, job_queue
+from streaming import STREAM_HEADERS, SSE_KEEPALIVE, format_event, stream_mimetype, wants_sse
+from metrics import CONTENT_TYPE, http_request_duration, render_metrics
+from tracing import end_trace, start_trace, wants_timing_debug
+from deadline import budget_for, degraded_parts, end_deadline, start_deadline, within
+from cassette import cassette
+from recommendation import (
+    entity_cache, insights_cache, gemini, qloo_flights, community_example_pool, pop_community_example,
+    journey_deck_store, mood_example_pool, warm_example_pools, ROUTE_ENTITY_TYPE_MAP as ENTITY_TYPE_MAP
+)
+
+# ASGI version of app.py. Same routes and payloads, but every handler is a
+# coroutine, so a single worker can multiplex many in-flight Qloo and Gemini calls.
+# Run with: hypercorn asgi:app --bind 0.0.0.0:$PORT
+app = cors(Quart(__name__), allow_origin="*")
+
+
+@app.before_serving
+async def start_pool_warming():
+    # Pre-generate community examples, journey decks and mood examples before the first requests ask for them
+    warm_example_pools()
+
+
+@app.after_serving
+async def close_upstream_clients():
+    await async_qloo.aclose()
+
+
+@app.before_request
+async def start_request_trace():
+    g.request_started = time.perf_counter()
+    g.trace, g.trace_token = start_trace()
+    g.deadline, g.deadline_token = start_deadline(budget_for(request.url_rule.rule if request.url_rule else None))
+    if cassette is not None and cassette.recording:
+        cassette.record_inbound(request.method, request.path, await request.get_json(silent=True))
+
+
+@app.after_request
+async def add_server_timing(response):
+    if "request_started" in g:
+        endpoint = request.url_rule.rule if request.url_rule else "unmatched"
+        http_request_duration.observe(
+            time.perf_counter() - g.request_started, endpoint, request.method, response.status_code
+        )
+
+    trace = g.get("trace")
+    if trace is None:
+        return response
+
+    response.headers["Server-Timing"] = trace.server_timing()
+    response.headers["Timing-Allow-Origin"] = "*"
+    # Parts of the response built from cached or default data, e.g. when a stage would have missed the deadline
+    degraded = g.deadline.degraded() if "deadline" in g else []
+    timing = wants_timing_debug(request.args, request.headers)
+    if response.mimetype == "application/json" and (degraded or timing):
+        body = await response.get_json(silent=True)
+        if isinstance(body, dict):
+            if degraded:
+                body["degraded"] = degraded
+            if timing:
+                body["timing"] = {"total_ms": trace.elapsed_ms(), "waterfall": trace.waterfall()}
+            response.set_data(app.json.dumps(body))
+    return response
+
+
+@app.teardown_request
+async def end_request_trace(exc):
+    token = g.pop("trace_token", None)
+    if token is not None:
+        end_trace(token)
+    token = g.pop("deadline_token", None)
+    if token is not None:
+        end_deadline(token)
+
+
+@app.route('/save-preferences', methods=['POST'])
+async def save_preferences():
+    data = await request.get_json()
+    active_category = data.get("activeCategory")
+    example_category = data.get("exampleCategory")
+    preference = data.get("preference")
+
+    print(f"\n===== Per-preference flow: activeCategory='{active_category}', exampleCategory='{example_category}', preference='{preference}' =====")
+
+    example_response = await get_single_example_async(example_category, preference)
+    seed_examples = example_response.get("recommendations", [])
+
+    if not seed_examples or len(seed_examples) < 2:
+        return jsonify({
+            "status": "error",
+            "message": "Failed to get 2 seed examples",
+            "title": "Error",
+            "recommendations": [],
+            "description": "Unable to generate recommendations",
+            "activeCategory": active_category
+        }), 500
+
+    active_entity_type = ENTITY_TYPE_MAP.get(active_category.lower())
+    example_entity_type = ENTITY_TYPE_MAP.get(example_category.lower())
+    all_recommendations = []
+
+    lookups = await resolve_entity_ids_async((example, example_entity_type) for example in seed_examples)
+
+    entity_ids = []
+    for example, lookup in zip(seed_examples, lookups):
+        if lookup["error"]:
+            print(f"❌ Failed to get metadata for '{example}': {lookup['error']}")
+            continue
+        if lookup["entity_id"]:
+            entity_ids.append(lookup["entity_id"])
+
+    batches = await asyncio.gather(
+        *(fetch_pooled_recommendation_async(entity_id, active_entity_type, take=5) for entity_id in entity_ids)
+    )
+    for metadata in batches:
+        if metadata:
+            all_recommendations.extend(metadata)
+
+    group_info = await generate_group_descriptions_async(active_category, all_recommendations)
+
+    return jsonify({
+        "title": group_info.get("title", "Curated Selection"),
+        "recommendations": all_recommendations,
+        "description": group_info.get("description", "A thoughtfully curated selection for you."),
+        "activeCategory": active_category
+    }), 200
+
+
+@app.route('/save-preferences/stream', methods=['POST'])
+async def save_preferences_stream():
+    data = await request.get_json()
+    active_category = data.get("activeCategory")
+    example_category = data.get("exampleCategory")
+    preference = data.get("preference")
+    sse = wants_sse(request.headers.get("Accept"))
+
+    print(f"\n===== Streaming per-preference flow: activeCategory='{active_category}', exampleCategory='{example_category}', preference='{preference}' =====")
+
+    # Quart sends the body outside the context before_request set up, so carry the deadline over
+    deadline = g.deadline
+
+    async def generate():
+        with within(deadline):
+            example_response = await get_single_example_async(example_category, preference)
+            seed_examples = example_response.get("recommendations", [])
+
+            if not seed_examples or len(seed_examples) < 2:
+                yield format_event("error", {
+                    "message": "Failed to get 2 seed examples",
+                    "activeCategory": active_category
+                }, sse)
+                return
+
+            yield format_event("seeds", {"examples": seed_examples, "activeCategory": active_category}, sse)
+
+            active_entity_type = ENTITY_TYPE_MAP.get(active_category.lower())
+            example_entity_type = ENTITY_TYPE_MAP.get(example_category.lower())
+            all_recommendations = []
+
+            async for example, recommendations, error in iter_seed_recommendations_async(
+                seed_examples, example_entity_type, active_entity_type, take=5
+            ):
+                if error:
+                    print(f"❌ Failed to get metadata for '{example}': {error}")
+                all_recommendations.extend(recommendations)
+                yield format_event("recommendations", {"seed": example, "recommendations": recommendations}, sse)
+
+            group_info = await generate_group_descriptions_async(active_category, all_recommendations)
+            yield format_event("group", {
+                "title": group_info.get("title", "Curated Selection"),
+                "description": group_info.get("description", "A thoughtfully curated selection for you."),
+                "activeCategory": active_category
+            }, sse)
+            degraded = degraded_parts()
+            yield format_event("done", {"degraded": degraded} if degraded else {}, sse)
+
+    response = Response(generate(), mimetype=stream_mimetype(sse), headers=STREAM_HEADERS)
+    response.timeout = None
+    return response
+
+
+@app.route('/get-item-details', methods=['POST'])
+async def get_item_details_endpoint():
+    data = await request.get_json()
+    category = data.get('category')
+    name = data.get('name')
+
+    print(f"\n==== Getting details for {name} in category {category} ====\n")
+
+    if not category or not name:
+        return jsonify({"status": "error", "message": "Category and name are required"}), 400
+
+    details = await get_item_details_async(category, name)
+
+    return jsonify({"status": "success", "details": details}), 200
+
+
+@app.route('/daily-recommendations', methods=['POST'])
+async def daily_recommendations():
+    data = await request.get_json()
+    mood = data.get('mood')
+    preferences = data.get('preferences', [])
+
+    print(f"\n==== Getting daily recommendations for mood: {mood} ====\n")
+
+    if not mood:
+        return jsonify({"status": "error", "message": "Mood is required"}), 400
+
+    recommendations = await get_daily_recommendations_async(mood, preferences)
+    return jsonify({
+        "status": "success",
+        "recommendations": recommendations,
+    }), 200
+
+
+@app.route('/community-recommendations', methods=['POST'])
+async def community_recommendations():
+    data = await request.get_json()
+    category = data.get('category', 'movies')
+    archetype = data.get('archetype', 'Taste Explorer')
+
+    print(f"\n==== Community recommendations for {archetype} in {category} category ====\n")
+
+    try:
+        category = category.lower()
+        entity_type = ENTITY_TYPE_MAP.get(category)
+        pooled = pop_community_example(archetype, category, entity_type)
+        if pooled:
+            entity_id = pooled["entity_id"]
+        else:
+            example = await get_community_example_async(archetype, category)
+            entity_id = await find_entity_id_async(example, entity_type)
+        recommendations = await fetch_individual_recommendation_async(entity_id, entity_type, take=5)
+    except Exception as e:
+        print(f"Can't retrive community recommendations: {e}")
+        recommendations = []
+
+    return jsonify({
+        "status": "success",
+        "category": category,
+        "archetype": archetype,
+        "recommendations": recommendations
+    }), 200
+
+
+@app.route('/mismatch-walkin-their-shoes-gemini', methods=['POST'])
+async def mismatch_walkin_their_shoes_gemini():
+    data = await request.get_json()
+    archetype = data.get('archetype', 'Taste Explorer')
+
+    print(f"\n==== Walk in their shoes for {archetype} ====\n")
+
+    try:
+        journey_cards = await get_journey_deck_async(archetype)
+    except Exception as e:
+        print(f"Failed to fetch journey cards: {e}")
+        return jsonify({"status": "error", "message": "Failed to fetch journey cards"}), 500
+
+    return jsonify({
+        "status": "success",
+        "archetype": archetype,
+        "journey_cards": journey_cards
+    }), 200
+
+
+@app.route('/discover-journey-card-recommendations', methods=['POST'])
+async def discover_journey_card_recommendations():
+    data = await request.get_json()
+    item = data.get('item')
+    category = data.get('category')
+
+    try:
+        category = category.lower()
+        entity_type = ENTITY_TYPE_MAP.get(category)
+        entity_id = data.get('entityId') or await find_entity_id_async(item, entity_type)
+        recommendations = await fetch_pooled_recommendation_async(entity_id, entity_type, take=1)
+    except Exception as e:
+        print(f"Can't get recommendations for {item}: {e}")
+        recommendations = []
+
+    return jsonify({
+        "status": "success",
+        "recommendations": recommendations
+    }), 200
+
+
+async def build_blend_recommendations(data):
+    """The /blend-recommendations pipeline, also run as a job."""
+    user_preferences = data.get('userPreferences')
+    friend_preferences = data.get('friendPreferences')
+    selectedActivities = data.get('selectedActivities')
+    preference_example_from_gemini = await get_examples_for_user_and_friends_async(
+        user_preferences, friend_preferences, selectedActivities
+    )
+
+    user_preference_example = preference_example_from_gemini.get('user_preference_example')
+    friend_preference_examples = preference_example_from_gemini.get('friend_preference_example', [])
+
+    category = selectedActivities[0]
+    entity_type = ENTITY_TYPE_MAP.get(category.lower())
+    user_preference_entity_id, *friend_entity_ids = await resolve_entity_id_list_async(
+        [user_preference_example] + list(friend_preference_examples), entity_type
+    )
+
+    all_entity_ids = user_preference_entity_id
+    for friend_entity_id in friend_entity_ids:
+        if friend_entity_id:
+            all_entity_ids += "," + friend_entity_id
+
+    try:
+        recommendations = await fetch_pooled_recommendation_async(all_entity_ids, entity_type, take=3)
+        enriched_recommendations = await enrich_recommendations_with_details_async(recommendations, selectedActivities[0])
+    except Exception as e:
+        print(f"Can't get blend recommendations: {e}")
+        enriched_recommendations = []
+
+    return {
+        "status": "success",
+        "recommendations": enriched_recommendations,
+        "activity": selectedActivities[0],
+        "all_entity_ids": all_entity_ids
+    }
+
+
+@app.route('/blend-recommendations', methods=['POST'])
+async def blend_recommendations():
+    return jsonify(await build_blend_recommendations(await request.get_json())), 200
+
+
+async def build_swap_deck_recommendations(data):
+    """The /swap_deck-recommendations pipeline, also run as a job."""
+    archetype = data.get('archetype')
+
+    print(f"\n==== Swap deck recommendations for {archetype} ====\n")
+
+    contrasting_examples = await get_contrasting_examples_async(archetype)
+    entity_ids = await map_examples_to_entity_ids_async(contrasting_examples)
+    swap_deck_recommendations = await get_recommendations_from_entity_ids_async(entity_ids)
+
+    all_titles_with_categories = []
+    for category, items in swap_deck_recommendations.items():
+        for item in items:
+            if 'name' in item:
+                all_titles_with_categories.append({
+                    "title": item['name'],
+                    "category": category
+                })
+
+    description_with_categories = await generate_descriptions_with_categories_async(all_titles_with_categories)
+
+    return {
+        "status": "success",
+        "archetype": archetype,
+        "recommendations": description_with_categories
+    }
+
+
+@app.route('/swap_deck-recommendations', methods=['POST'])
+async def swap_deck_recommendations():
+    return jsonify(await build_swap_deck_recommendations(await request.get_json())), 200
+
+
+JOB_PIPELINES = {
+    "blend-recommendations": build_blend_recommendations,
+    "swap_deck-recommendations": build_swap_deck_recommendations,
+}
+
+
+@app.route('/jobs/<kind>', methods=['POST'])
+async def submit_job(kind):
+    pipeline = JOB_PIPELINES.get(kind)
+    if pipeline is None:
+        return jsonify({"status": "error", "message": f"Unknown job type '{kind}'"}), 404
+    try:
+        job, _ = await job_queue.submit_async(kind, await request.get_json(), pipeline)
+    except JobQueueFull as e:
+        return jsonify({"status": "error", "message": str(e)}), 503
+    return jsonify({"status": "success", "job": job.to_dict()}), 202, {"Location": f"/jobs/{job.id}"}
+
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+async def get_job(job_id):
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({"status": "error", "message": "Unknown or expired job"}), 404
+    return jsonify({"status": "success", "job": job.to_dict()}), 200
+
+
+@app.route('/jobs/<job_id>/events', methods=['GET'])
+async def job_events(job_id):
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({"status": "error", "message": "Unknown or expired job"}), 404
+    sse = wants_sse(request.headers.get("Accept"))
+
+    async def generate():
+        version = None
+        while True:
+            seen, version = version, await job.wait_async(version, JOB_EVENTS_KEEPALIVE)
+            if version == seen:
+                # Nothing changed: keep the stream from idling out, and notice a client that has gone
+                yield SSE_KEEPALIVE if sse else format_event("state", {"id": job.id, "state": job.state}, sse)
+                continue
+            snapshot = job.to_dict()
+            if job.finished:
+                yield format_event("done", snapshot, sse)
+                return
+            yield format_event("state", {"id": job.id, "state": snapshot["state"]}, sse)
+
+    response = Response(generate(), mimetype=stream_mimetype(sse), headers=STREAM_HEADERS)
+    response.timeout = None
+    return response
+
+
+@app.route('/metrics', methods=['GET'])
+async def metrics():
+    return render_metrics(), 200, {"Content-Type": CONTENT_TYPE}
+
+
+@app.route('/cache-stats', methods=['GET'])
+async def cache_stats():
+    return jsonify({
+        "status": "success",
+        "entity_ids": entity_cache.get_stats(),
+        "insights": insights_cache.get_stats(),
+        "candidate_pools": async_candidate_pool.get_stats(),
+        "community_examples": community_example_pool.get_stats(),
+        "journey_decks": journey_deck_store.get_stats(),
+        "mood_examples": mood_example_pool.get_stats(),
+        "gemini": gemini.get_stats(),
+        "coalescing": {
+            "qloo": qloo_flights.get_stats(),
+            "gemini": gemini.get_flight_stats()
+        },
+        "micro_batching": {
+            "group_description": group_description_batcher_async.get_stats(),
+            "enrichment": enrichment_batcher_async.get_stats(),
+            "descriptions_with_categories": descriptions_batcher_async.get_stats()
+        },
+        "gemini_admission": gemini.get_admission_stats(),
+        "qloo_hedging": qloo_hedger.get_stats() if qloo_hedger is not None else None,
+        "circuit_breakers": {
+            "qloo": qloo_breaker.get_stats(),
+            "gemini": gemini.get_breaker_stats()
+        },
+        "jobs": job_queue.get_stats(),
+        "cassette": cassette.get_stats() if cassette is not None else None
+    }), 200
+
+
+if __name__ == '__main__':
+    port = int(os.environ.get("PORT", 5000))
+    app.run(host='0.0.0.0', port=port)
@@ -0,0 +1,543 @@
+# asyncio versions of the recommendation pipeline in recommendation.py. Qloo calls
+# go through httpx.AsyncClient and Gemini through generate_content_async, so one
+# event loop can keep many upstream calls in flight. Prompts, parsers, fallbacks
+# and caches are shared with the sync module.
+import asyncio
+import copy
+import os
+
+from batching import MicroBatcher
+from cache import MISSING, canonical_params_key
+from deadline import OPTIONAL_STAGE_MIN, QLOO_RESERVE, DeadlineExceeded, affords, degrade, time_left
+from metrics import count_fallback, count_parse_failure
+from pools import CandidatePool
+from qloo_client import async_qloo
+from recommendation import (
+    ENTITY_TYPE_MAP, CANDIDATE_POOL_SIZE, COMMUNITY_EXAMPLE_CONFIG, MOOD_ACTIVITIES_CONFIG, SINGLE_EXAMPLE_CONFIG,
+    GEMINI_BATCH_WINDOW, GEMINI_BATCH_MAX_ITEMS,
+    entity_cache, insights_cache, gemini, qloo_flights, journey_deck_store, known_archetype,
+    canonical_entity_ids, parse_search_entity_id, items_from_insights,
+    single_example_prompt, parse_single_example, single_example_fallback,
+    group_description_prompt, parse_group_description, default_group_info,
+    group_descriptions_batch_prompt, parse_group_descriptions_batch,
+    item_details_prompt, parse_item_details, item_details_fallback,
+    mood_activities_prompt, parse_mood_activities, mood_activities_fallback, local_mood_activities,
+    genre_examples_prompt, mood_and_genre_examples_prompt, parse_mood_and_genre_examples, parse_json_object_or_empty, parse_json_block, speculative_genre_preferences,
+    community_example_prompt, journey_cards_prompt, journey_card_lookups, attach_entity_ids, friend_examples_prompt,
+    enrichment_prompt, enrichment_batch_prompt, parse_enrichment_batch, enriched_item,
+    contrasting_examples_prompt, parse_contrasting_examples,
+    descriptions_with_categories_prompt, parse_descriptions_with_categories, descriptions_with_categories_fallback,
+    descriptions_by_item, assemble_descriptions
+)
+
+
+# ---------- Gemini ----------
+
+async def get_single_example_async(category, preference):
+    try:
+        raw_text = await gemini.generate_text_async(
+            "single_example", single_example_prompt(category, preference), generation_config=SINGLE_EXAMPLE_CONFIG
+        )
+        return parse_single_example(raw_text)
+    except Exception as e:
+        print("Error parsing JSON:", e)
+        return single_example_fallback()
+
+
+async def run_group_descriptions_batch_async(batch_key, groups):
+    text = await gemini.generate_text_async("group_description_batch", group_descriptions_batch_prompt(groups))
+    try:
+        results = parse_group_descriptions_batch(text, groups)
+    except ValueError as e:
+        print(f"Batched group descriptions could not be parsed: {e}")
+        return {}
+
+    for (category, names), info in results.items():
+        gemini.store("group_description", {"category": category, "items": list(names)}, info)
+    return results
+
+
+group_description_batcher_async = MicroBatcher(
+    run_group_descriptions_batch_async, window=GEMINI_BATCH_WINDOW, max_items=GEMINI_BATCH_MAX_ITEMS,
+    name="group_description"
+)
+
+
+async def generate_group_descriptions_async(category, all_recommendations):
+    item_names = [item["name"] for item in all_recommendations if item.get("name")]
+    if not item_names:
+        return default_group_info()
+
+    cached = gemini.get_cached("group_description", {"category": category, "items": item_names})
+    if cached is not MISSING:
+        return cached
+    if not affords(OPTIONAL_STAGE_MIN):
+        degrade("group_description", "deadline")
+        return default_group_info()
+
+    try:
+        [info] = await group_description_batcher_async.submit_async("groups", [(category, tuple(item_names))])
+    except DeadlineExceeded:
+        return default_group_info()
+    except Exception as e:
+        print(f"Gemini API error for {category} group: {e}")
+        return default_group_info()
+    if info is not MISSING:
+        return dict(info)
+
+    try:
+        return await gemini.generate_parsed_async(
+            "group_description", group_description_prompt(category, item_names), parse_group_description,
+            cache_args={"category": category, "items": item_names}
+        )
+    except Exception as e:
+        print(f"Gemini API error for {category} group: {e}")
+        return default_group_info()
+
+
+async def get_item_details_async(category: str, name: str):
+    category = category.lower()
+    try:
+        return await gemini.generate_parsed_async(
+            "item_details", item_details_prompt(category, name), parse_item_details,
+            cache_args={"category": category, "name": name}
+        )
+    except Exception as e:
+        print(f"Error fetching Gemini details for {name} ({category}):", e)
+        return item_details_fallback(name)
+
+
+async def get_gemini_activity_recommendations_by_mood_async(mood: str) -> dict:
+    try:
+        text = await gemini.generate_text_async(
+            "mood_activities", mood_activities_prompt(mood), generation_config=MOOD_ACTIVITIES_CONFIG
+        )
+        return parse_mood_activities(text)
+    except Exception as e:
+        print("Error calling Gemini or parsing response:", e)
+        return mood_activities_fallback(e)
+
+
+async def get_mood_and_genre_examples_async(mood: str, genre_preferences: dict):
+    try:
+        text = await gemini.generate_text_async(
+            "mood_and_genre_examples", mood_and_genre_examples_prompt(mood, genre_preferences),
+            generation_config=MOOD_ACTIVITIES_CONFIG
+        )
+        return parse_mood_and_genre_examples(text)
+    except Exception as e:
+        print("Fused mood and genre call failed, falling back to separate calls:", e)
+        return None
+
+
+async def get_genre_based_examples_async(filtered_preferences: dict) -> dict:
+    try:
+        text = await gemini.generate_text_async("genre_examples", genre_examples_prompt(filtered_preferences))
+    except Exception as e:
+        print(f"Genre examples unavailable: {e}")
+        count_fallback("genre_examples")
+        return {}
+    return parse_json_object_or_empty(text)
+
+
+async def get_community_example_async(community: str, category: str) -> str:
+    try:
+        text = await gemini.generate_text_async(
+            "community_example", community_example_prompt(community, category),
+            generation_config=COMMUNITY_EXAMPLE_CONFIG
+        )
+        return text.strip()
+    except Exception as e:
+        count_fallback("community_example")
+        return f"Error: {str(e)}"
+
+
+async def get_opposite_community_journey_cards_async(community_type: str) -> dict:
+    text = await gemini.generate_text_async("journey_cards", journey_cards_prompt(community_type))
+    return parse_json_object_or_empty(text)
+
+
+async def get_examples_for_user_and_friends_async(user_preferences, co_person_preferences, selected_activities) -> dict:
+    prompt = friend_examples_prompt(user_preferences, co_person_preferences, selected_activities)
+    try:
+        text = await gemini.generate_text_async("friend_examples", prompt)
+    except Exception as e:
+        print(f"Friend examples unavailable: {e}")
+        count_fallback("friend_examples")
+        return {}
+    return parse_json_object_or_empty(text)
+
+
+async def run_enrichment_batch_async(category, names):
+    batch = await gemini.generate_parsed_async(
+        "enrichment_batch", enrichment_batch_prompt(names, category),
+        lambda text: parse_enrichment_batch(text, names)
+    )
+    for name, details in batch.items():
+        gemini.store("enrichment", {"category": category, "name": name}, details)
+    return batch
+
+
+enrichment_batcher_async = MicroBatcher(
+    run_enrichment_batch_async, window=GEMINI_BATCH_WINDOW, max_items=GEMINI_BATCH_MAX_ITEMS, name="enrichment"
+)
+
+
+async def enrich_recommendations_with_details_async(recommendations: list, category: str):
+    names = [item.get("name") for item in recommendations]
+    details_by_name = {}
+
+    uncached = []
+    for name in names:
+        cached = gemini.get_cached("enrichment", {"category": category, "name": name})
+        if cached is not MISSING:
+            details_by_name[name] = cached
+        elif name not in uncached:
+            uncached.append(name)
+
+    enrich = affords(OPTIONAL_STAGE_MIN)
+    if uncached and not enrich:
+        degrade("enrichment", "deadline")
+
+    if uncached and enrich:
+        try:
+            for name, details in zip(uncached, await enrichment_batcher_async.submit_async(category, uncached)):
+                if details is not MISSING:
+                    details_by_name[name] = copy.deepcopy(details)
+        except DeadlineExceeded:
+            # Out of time: the rest keep the default summary rather than each try Gemini on its own
+            enrich = False
+        except Exception as e:
+            print(f"Batched enrichment failed for {category}, falling back per item:", e)
+
+    async def enrich_missing(name):
+        try:
+            details_by_name[name] = await gemini.generate_parsed_async(
+                "enrichment", enrichment_prompt(name, category), parse_json_block,
+                cache_args={"category": category, "name": name}
+            )
+        except Exception as e:
+            print(f"Failed to enrich {name}:", e)
+
+    # Items the batch didn't cover are enriched individually, all at once
+    missing = [name for name in dict.fromkeys(names) if name not in details_by_name] if enrich else []
+    await asyncio.gather(*(enrich_missing(name) for name in missing))
+
+    return [enriched_item(item, details_by_name.get(item.get("name"))) for item in recommendations]
+
+
+async def get_contrasting_examples_async(archetype):
+    try:
+        return parse_contrasting_examples(
+            await gemini.generate_text_async("contrasting_examples", contrasting_examples_prompt(archetype))
+        )
+    except Exception as e:
+        count_fallback("contrasting_examples")
+        return {"error": str(e)}
+
+
+async def run_descriptions_batch_async(batch_key, items):
+    title_category_list = [{"title": title, "category": category} for title, category in items]
+    text = await gemini.generate_text_async(
+        "descriptions_with_categories_batch", descriptions_with_categories_prompt(title_category_list)
+    )
+    try:
+        return descriptions_by_item(parse_descriptions_with_categories(text), items)
+    except ValueError as e:
+        count_parse_failure("descriptions_with_categories")
+        print(f"Batched descriptions could not be parsed: {e}")
+        return {}
+
+
+descriptions_batcher_async = MicroBatcher(
+    run_descriptions_batch_async, window=GEMINI_BATCH_WINDOW, max_items=GEMINI_BATCH_MAX_ITEMS,
+    name="descriptions_with_categories"
+)
+
+
+async def describe_items_async(title_category_list):
+    items = [(item["title"], item["category"]) for item in title_category_list]
+    try:
+        entries = await gemini.generate_parsed_async(
+            "descriptions_with_categories",
+            descriptions_with_categories_prompt(title_category_list),
+            parse_descriptions_with_categories,
+            cache_args={"items": title_category_list}
+        )
+        return descriptions_by_item(entries, items)
+    except Exception as e:
+        print(f"Gemini error: {e}")
+        return {}
+
+
+async def generate_descriptions_with_categories_async(title_category_list):
+    if not title_category_list:
+        return []
+
+    cached = gemini.get_cached("descriptions_with_categories", {"items": title_category_list})
+    if cached is not MISSING:
+        return cached
+    if not affords(OPTIONAL_STAGE_MIN):
+        degrade("descriptions_with_categories", "deadline")
+        return descriptions_with_categories_fallback(title_category_list)
+
+    items = [(item["title"], item["category"]) for item in title_category_list]
+    try:
+        batched = await descriptions_batcher_async.submit_async("descriptions", items)
+    except DeadlineExceeded:
+        return descriptions_with_categories_fallback(title_category_list)
+    except Exception as e:
+        print(f"Gemini error: {e}")
+        return descriptions_with_categories_fallback(title_category_list)
+
+    descriptions = {item: description for item, description in zip(items, batched) if description is not MISSING}
+    missing = [entry for entry, item in zip(title_category_list, items) if item not in descriptions]
+    if missing:
+        descriptions.update(await describe_items_async(missing))
+
+    results = assemble_descriptions(title_category_list, descriptions)
+    if not missing:
+        gemini.store("descriptions_with_categories", {"items": title_category_list}, results)
+    return results
+
+
+# ---------- Qloo ----------
+
+async def search_entity_id_async(query, entity_type):
+    if not query or not query.strip():
+        print(f"[WARN] Empty query received for type '{entity_type}'")
+        return None
+
+    cached = await entity_cache.get_async(query, entity_type)
+    if cached is not MISSING:
+        return cached
+
+    async def search():
+        data = await async_qloo.search(query.strip(), entity_type, limit=1)
+        entity_id = parse_search_entity_id(data, query, entity_type)
+        await entity_cache.set_async(query, entity_type, entity_id)
+        return entity_id
+
+    return await qloo_flights.do_async(("search", entity_cache.make_key(query, entity_type)), search)
+
+
+async def find_entity_id_async(query, entity_type):
+    try:
+        return await search_entity_id_async(query, entity_type)
+    except Exception as e:
+        print(f"[ERROR] Lookup failed for '{query}' ({entity_type}): {e}")
+        return None
+
+
+async def _resolve_one_async(name, entity_type):
+    try:
+        entity_id = await search_entity_id_async(name, entity_type)
+        return {"name": name, "entity_type": entity_type, "entity_id": entity_id, "error": None}
+    except Exception as e:
+        print(f"[ERROR] Lookup failed for '{name}' ({entity_type}): {e}")
+        return {"name": name, "entity_type": entity_type, "entity_id": None, "error": str(e)}
+
+
+async def resolve_entity_ids_async(pairs):
+    """Same contract as recommendation.resolve_entity_ids, with every lookup in flight at once."""
+    return list(await asyncio.gather(*(_resolve_one_async(name, entity_type) for name, entity_type in pairs)))
+
+
+async def resolve_entity_id_list_async(names, entity_type):
+    return [result["entity_id"] for result in await resolve_entity_ids_async((name, entity_type) for name in names)]
+
+
+async def generate_journey_deck_async(community_type: str) -> dict:
+    cards = await get_opposite_community_journey_cards_async(community_type)
+    lookups = journey_card_lookups(cards)
+    if not lookups:
+        return cards
+    results = await resolve_entity_ids_async((item, entity_type) for _, item, entity_type in lookups)
+    return attach_entity_ids(cards, lookups, [result["entity_id"] for result in results])
+
+
+async def get_journey_deck_async(community_type: str) -> dict:
+    archetype = known_archetype(community_type)
+    if archetype is None:
+        return await generate_journey_deck_async(community_type)
+
+    deck = journey_deck_store.pop(archetype)
+    if deck is None:
+        deck = await generate_journey_deck_async(archetype)
+        if deck:
+            journey_deck_store.add(archetype, deck, uses=1)
+    return copy.deepcopy(deck)
+
+
+async def fetch_seed_recommendations_async(example, example_entity_type, active_entity_type, take=5):
+    entity_id = await search_entity_id_async(example, example_entity_type)
+    return await fetch_pooled_recommendation_async(entity_id, active_entity_type, take=take)
+
+
+async def iter_seed_recommendations_async(seed_examples, example_entity_type, active_entity_type, take=5):
+    """Async generator counterpart of recommendation.iter_seed_recommendations."""
+    async def run(example):
+        try:
+            return example, await fetch_seed_recommendations_async(example, example_entity_type, active_entity_type, take), None
+        except Exception as e:
+            return example, [], str(e)
+
+    for next_done in asyncio.as_completed([run(example) for example in seed_examples]):
+        yield await next_done
+
+
+async def map_examples_to_entity_ids_async(contrast_examples):
+    lookups = []
+    for category, example_name in contrast_examples.items():
+        entity_type = ENTITY_TYPE_MAP.get(category.strip().lower())
+        if not entity_type:
+            print(f"[Warning] Unknown category: {category}")
+            continue
+        lookups.append((category, example_name, entity_type))
+
+    results = await resolve_entity_ids_async((example_name, entity_type) for _, example_name, entity_type in lookups)
+    entity_ids = {}
+    for (category, example_name, _), result in zip(lookups, results):
+        if result["entity_id"]:
+            entity_ids[category] = result["entity_id"]
+        else:
+            print(f"[Info] No entity found for {example_name} under {category}")
+    return entity_ids
+
+
+async def fetch_insights_entities_async(params):
+    key = canonical_params_key(params)
+
+    async def insights():
+        return items_from_insights(await async_qloo.insights(params))
+
+    async def fetch():
+        return await qloo_flights.do_async(("insights", key), insights)
+
+    entities = await insights_cache.get_or_fetch_async(key, fetch)
+    return [dict(item) for item in entities]
+
+
+async def fetch_individual_recommendation_async(entity_id, target_entity_type, take):
+    try:
+        return await fetch_insights_entities_async({
+            "filter.type": target_entity_type,
+            "signal.interests.entities": entity_id,
+            "take": take
+        })
+    except Exception as e:
+        print(f"Error for entity {entity_id}: {e}")
+        degrade("recommendations")
+        return []
+
+
+async def fetch_combined_recommendations_async(entity_ids, target_entity_type, take=5):
+    try:
+        return await fetch_insights_entities_async({
+            "filter.type": target_entity_type,
+            "signal.interests.entities": ",".join(entity_ids),
+            "filter.popularity.min": 0.80,
+            "take": take
+        })
+    except Exception as e:
+        print(f"Error fetching combined recommendations for entity IDs: {e}")
+        degrade("recommendations")
+        return []
+
+
+async def _fetch_candidate_page_async(key):
+    entity_ids, target_entity_type = key
+    return await fetch_individual_recommendation_async(entity_ids, target_entity_type, take=CANDIDATE_POOL_SIZE)
+
+
+async_candidate_pool = CandidatePool(
+    None, ttl=int(os.getenv("CANDIDATE_POOL_TTL", "3600")), fetch_page_async=_fetch_candidate_page_async
+)
+
+
+async def fetch_pooled_recommendation_async(entity_id, target_entity_type, take):
+    if not entity_id:
+        return []
+    try:
+        return await async_candidate_pool.take_async((canonical_entity_ids(entity_id), target_entity_type), take)
+    except Exception as e:
+        print(f"Error for pooled entity {entity_id}: {e}")
+        degrade("recommendations")
+        return []
+
+
+async def get_recommendations_from_entity_ids_async(entity_id_map, take=1):
+    categories = []
+    for category, entity_id in entity_id_map.items():
+        entity_type = ENTITY_TYPE_MAP.get(category.strip().lower())
+        if not entity_type:
+            print(f"[Warning] Unknown category '{category}', skipping.")
+            continue
+        categories.append((category, entity_id, entity_type))
+
+    results = await asyncio.gather(*(
+        fetch_individual_recommendation_async(entity_id, entity_type, take)
+        for _, entity_id, entity_type in categories
+    ))
+    return {category: recs for (category, _, _), recs in zip(categories, results)}
+
+
+async def _daily_activity_recommendations_async(activity, mood_example, genre_task, take):
+    entity_type = ENTITY_TYPE_MAP[activity]
+    mood_lookup = None
+    if isinstance(mood_example, str):
+        mood_lookup = asyncio.ensure_future(_resolve_one_async(mood_example, entity_type))
+
+    genre_examples = []
+    if genre_task is not None:
+        try:
+            genre_examples = (await asyncio.wait_for(asyncio.shield(genre_task), time_left(QLOO_RESERVE))).get(activity) or []
+        except asyncio.TimeoutError:
+            print(f"Genre examples for {activity} would miss the deadline, continuing without them")
+            degrade("genre_examples", "deadline")
+        except Exception as e:
+            print(f"Genre examples failed, continuing without them: {e}")
+    if not isinstance(genre_examples, list):
+        genre_examples = []
+
+    lookups = await resolve_entity_ids_async((name, entity_type) for name in genre_examples)
+    if mood_lookup is not None:
+        lookups.insert(0, await mood_lookup)
+
+    entity_ids = [lookup["entity_id"] for lookup in lookups if lookup["entity_id"]]
+    if not entity_ids:
+        return []
+    return await fetch_combined_recommendations_async(entity_ids, entity_type, take)
+
+
+async def get_daily_recommendations_async(mood: str, preferences, take=1) -> dict:
+    """asyncio counterpart of recommendation.get_daily_recommendations."""
+    genre_preferences = speculative_genre_preferences(preferences)
+    genre_task = None
+
+    recommendations = local_mood_activities(mood)
+    if recommendations is None and genre_preferences:
+        fused = await get_mood_and_genre_examples_async(mood, genre_preferences)
+        if fused is not None:
+            recommendations, genre_examples = fused
+            genre_task = asyncio.get_running_loop().create_future()
+            genre_task.set_result(genre_examples)
+
+    if genre_task is None and genre_preferences:
+        genre_task = asyncio.ensure_future(get_genre_based_examples_async(genre_preferences))
+
+    try:
+        if recommendations is None:
+            recommendations = await get_gemini_activity_recommendations_by_mood_async(mood)
+        if not isinstance(recommendations, dict) or recommendations.get("error"):
+            return {}
+
+        activities = [activity for activity in recommendations if activity in ENTITY_TYPE_MAP]
+        results = await asyncio.gather(*(
+            _daily_activity_recommendations_async(activity, recommendations[activity], genre_task, take)
+            for activity in activities
+        ))
+        return {activity: recs for activity, recs in zip(activities, results) if recs}
+    finally:
+        if genre_task is not None and not genre_task.done():
+            genre_task.cancel()
@@ -0,0 +1,175 @@
+import asyncio
+import contextvars
+import threading
+
+from contextlib import contextmanager
+
+from admission import current_priority, priority
+from cache import MISSING
+from deadline import DeadlineExceeded, current_deadline, degrade, shared_deadline, time_left, within
+from tracing import current_trace, mark, shared_trace
+
+
+class _Batch:
+    def __init__(self):
+        self.items = {}
+        self.callers = 0
+        self.full = None
+        self.done = threading.Event()
+        self.results = None
+        self.error = None
+        self.task = None
+        # Deadline, trace and Gemini priority of each caller
+        self.deadlines = []
+        self.traces = []
+        self.priorities = []
+
+    @contextmanager
+    def on_behalf_of_callers(self):
+        """
+        Run the batch under the latest of its callers' deadlines, at the highest
+        of their priorities, recording its spans in every caller's trace.
+        """
+        with within(shared_deadline(self.deadlines)), shared_trace(self.traces), priority(min(self.priorities)):
+            yield
+
+
+class MicroBatcher:
+    """
+    Merges small calls that arrive close together into one batched call.
+
+    submit(batch_key, items) adds items to the open batch for batch_key. A
+    batch waits up to `window` seconds from its first item for others to join,
+    or until it holds max_items, then calls run_batch(batch_key, items) once for
+    everyone with the de-duplicated items. run_batch returns {item: result}.
+    Each caller gets a list of results for its own items, in order, with MISSING
+    for any item the batch left out so it can fall back per item. If run_batch
+    raises, every caller in the batch sees the exception. Items must be hashable.
+
+    The batch runs on a thread (or task) of its own, under the latest of its
+    callers' deadlines, so the caller with the least time left doesn't cut it
+    short for the others. A caller whose own deadline passes first stops
+    waiting, notes `name` as degraded and raises DeadlineExceeded.
+
+    submit_async() is the asyncio counterpart and expects run_batch to be a
+    coroutine function. Use one instance per mode; sync and async callers keep
+    separate open batches.
+    """
+
+    def __init__(self, run_batch, window=0.015, max_items=20, name=None):
+        self.run_batch = run_batch
+        self.window = window
+        self.max_items = max_items
+        self.name = name
+        self._open = {}
+        self._lock = threading.Lock()
+        self.stats = {"submits": 0, "batches": 0, "batched_submits": 0, "items": 0, "max_batch_items": 0,
+                      "expired_waits": 0}
+
+    def _join(self, batch_key, items, new_batch):
+        """Add items to the open batch for batch_key, opening one if needed. Call with the lock held."""
+        batch = self._open.get(batch_key)
+        if batch is None:
+            batch = self._open[batch_key] = new_batch()
+        batch.items.update(dict.fromkeys(items))
+        batch.callers += 1
+        batch.deadlines.append(current_deadline())
+        batch.traces.append(current_trace())
+        batch.priorities.append(current_priority())
+        self.stats["submits"] += 1
+        if len(batch.items) >= self.max_items:
+            # Full: close it to newcomers and run it now
+            del self._open[batch_key]
+            batch.full.set()
+        return batch
+
+    def _close(self, batch_key, batch):
+        with self._lock:
+            if self._open.get(batch_key) is batch:
+                del self._open[batch_key]
+            self.stats["batches"] += 1
+            self.stats["batched_submits"] += batch.callers
+            self.stats["items"] += len(batch.items)
+            self.stats["max_batch_items"] = max(self.stats["max_batch_items"], len(batch.items))
+        mark("micro-batch", self.name, items=len(batch.items), callers=batch.callers)
+        return list(batch.items)
+
+    @staticmethod
+    def _scatter(results, items):
+        return [results.get(item, MISSING) for item in items]
+
+    def submit(self, batch_key, items):
+        def new_batch():
+            batch = _Batch()
+            batch.full = threading.Event()
+            threading.Thread(target=self._run, args=(batch_key, batch), name="micro-batch", daemon=True).start()
+            return batch
+
+        with self._lock:
+            batch = self._join(batch_key, items, new_batch)
+
+        if not batch.done.wait(time_left()):
+            raise self._expired()
+        if batch.error is not None:
+            raise batch.error
+        return self._scatter(batch.results, items)
+
+    async def submit_async(self, batch_key, items):
+        def new_batch():
+            batch = _Batch()
+            batch.full = asyncio.Event()
+            # The batch runs as its own task, outside any one caller's context,
+            # so a cancelled caller doesn't strand the others
+            batch.task = asyncio.get_running_loop().create_task(
+                self._run_async(batch_key, batch), context=contextvars.Context()
+            )
+            # Retrieve the outcome even if every caller was cancelled, so it isn't logged as unhandled
+            batch.task.add_done_callback(lambda task: task.cancelled() or task.exception())
+            return batch
+
+        with self._lock:
+            batch = self._join(batch_key, items, new_batch)
+
+        try:
+            results = await asyncio.wait_for(asyncio.shield(batch.task), time_left())
+        except asyncio.TimeoutError:
+            if batch.task.done():
+                raise
+            raise self._expired() from None
+        return self._scatter(results, items)
+
+    def _expired(self):
+        """A caller gave up on a batch that outlasted its deadline."""
+        with self._lock:
+            self.stats["expired_waits"] += 1
+        mark("micro-batch", self.name, result="deadline")
+        degrade(self.name or "micro-batch", "deadline")
+        return DeadlineExceeded(f"Request deadline passed while waiting on the {self.name or 'micro'} batch")
+
+    def _run(self, batch_key, batch):
+        batch.full.wait(self.window)
+        try:
+            items = self._close(batch_key, batch)
+            with batch.on_behalf_of_callers():
+                batch.results = self.run_batch(batch_key, items)
+        except BaseException as e:
+            batch.error = e
+        finally:
+            batch.done.set()
+
+    async def _run_async(self, batch_key, batch):
+        try:
+            await asyncio.wait_for(batch.full.wait(), self.window)
+        except asyncio.TimeoutError:
+            pass
+        items = self._close(batch_key, batch)
+        with batch.on_behalf_of_callers():
+            return await self.run_batch(batch_key, items)
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self.stats)
+            stats["open_batches"] = len(self._open)
+        stats["calls_saved"] = stats["batched_submits"] - stats["batches"]
+        stats["avg_batch_items"] = round(stats["items"] / stats["batches"], 2) if stats["batches"] else 0.0
+        return stats
@@ -0,0 +1,435 @@
+import asyncio
+import json
+import random
+import re
+import threading
+import time
+import zlib
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from google.api_core import exceptions as google_exceptions
+
+
+class Latency:
+    """
+    A latency distribution, parsed from a spec string:
+      "0" or "fixed:MS"          always MS milliseconds
+      "uniform:LO,HI"            uniform between LO and HI ms
+      "lognormal:MEDIAN,SIGMA"   log-normal with the given median (ms) and shape
+    """
+
+    def __init__(self, kind="fixed", a=0.0, b=0.0):
+        self.kind = kind
+        self.a = a
+        self.b = b
+
+    @classmethod
+    def parse(cls, spec):
+        spec = str(spec).strip()
+        if ":" not in spec:
+            return cls("fixed", float(spec))
+        kind, _, args = spec.partition(":")
+        values = [float(v) for v in args.split(",") if v.strip()]
+        if kind == "fixed" and len(values) == 1:
+            return cls("fixed", values[0])
+        if kind in ("uniform", "lognormal") and len(values) == 2:
+            return cls(kind, values[0], values[1])
+        raise ValueError(f"Bad latency spec '{spec}'")
+
+    def sample(self, rng):
+        """One draw, in seconds."""
+        if self.kind == "uniform":
+            ms = rng.uniform(self.a, self.b)
+        elif self.kind == "lognormal":
+            ms = self.a * rng.lognormvariate(0.0, self.b) if self.a > 0 else 0.0
+        else:
+            ms = self.a
+        return max(ms, 0.0) / 1000
+
+    def __str__(self):
+        if self.kind == "fixed":
+            return f"{self.a:g}ms"
+        return f"{self.kind}({self.a:g},{self.b:g})"
+
+
+class Faults:
+    """Per-call error and malformed-body probabilities, drawn from a seeded RNG."""
+
+    def __init__(self, latency=None, error_rate=0.0, malformed_rate=0.0, seed=None):
+        self.latency = latency or Latency()
+        self.error_rate = error_rate
+        self.malformed_rate = malformed_rate
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def draw(self):
+        """Return (delay_seconds, outcome) with outcome one of "ok", "error" or "malformed"."""
+        with self._lock:
+            delay = self.latency.sample(self._rng)
+            roll = self._rng.random()
+        if roll < self.error_rate:
+            return delay, "error"
+        if roll < self.error_rate + self.malformed_rate:
+            return delay, "malformed"
+        return delay, "ok"
+
+
+class CallCounter:
+    """Thread-safe call counts by operation, e.g. "search" or a Gemini template id."""
+
+    def __init__(self):
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def add(self, operation, outcome="ok"):
+        with self._lock:
+            self._counts[operation] = self._counts.get(operation, 0) + 1
+            if outcome != "ok":
+                self._counts[outcome] = self._counts.get(outcome, 0) + 1
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._counts)
+
+
+def catalogue_name(prefix, rng, size):
+    """A title drawn from a fixed-size catalogue, so caches warm up the way they would in production."""
+    return f"{prefix} {rng.randrange(size)}"
+
+
+def stable_id(text):
+    return "BENCH-%08X" % zlib.crc32(text.lower().encode())
+
+
+def truncate(body):
+    """Cut a JSON body in half so it no longer parses."""
+    return body[:max(1, len(body) // 2)]
+
+
+class FakeQloo:
+    """
+    Local HTTP stand-in for the Qloo /search and /v2/insights endpoints.
+
+    Runs a threaded keep-alive server on 127.0.0.1 so the real QlooClient and
+    AsyncQlooClient are exercised end to end. Errors are returned as HTTP 503,
+    which the clients retry like the real API. Search queries starting with
+    "unknown" return no results.
+    """
+
+    def __init__(self, faults=None, seed=None):
+        self.faults = faults or Faults(seed=seed)
+        self.calls = CallCounter()
+        self._server = None
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self._server.server_port}"
+
+    def start(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                fake._handle(self)
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, name="fake-qloo", daemon=True).start()
+        return self.url
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def _handle(self, handler):
+        url = urlparse(handler.path)
+        params = {name: values[0] for name, values in parse_qs(url.query).items()}
+        operation = url.path.rstrip("/").rsplit("/", 1)[-1]
+
+        delay, outcome = self.faults.draw()
+        self.calls.add(operation, outcome)
+        time.sleep(delay)
+
+        if url.path not in ("/search", "/v2/insights"):
+            status, body = 404, json.dumps({"error": "not found"})
+        elif outcome == "error":
+            status, body = 503, json.dumps({"error": "service unavailable"})
+        else:
+            status = 200
+            body = json.dumps(self.search(params) if operation == "search" else self.insights(params))
+            if outcome == "malformed":
+                body = truncate(body)
+
+        data = body.encode()
+        handler.send_response(status)
+        handler.send_header("Content-Type", "application/json")
+        handler.send_header("Content-Length", str(len(data)))
+        handler.end_headers()
+        handler.wfile.write(data)
+
+    @staticmethod
+    def search(params):
+        query = params.get("query", "")
+        if query.lower().startswith("unknown"):
+            return {"results": []}
+        return {"results": [{"entity_id": stable_id(f"{params.get('filter.type')}:{query}"), "name": query}]}
+
+    @staticmethod
+    def insights(params):
+        take = int(params.get("take", 5))
+        seeds = params.get("signal.interests.entities", "")
+        entity_type = params.get("filter.type", "urn:entity:unknown").rsplit(":", 1)[-1]
+        rng = random.Random(f"{seeds}:{entity_type}")
+        return {
+            "results": {
+                "entities": [
+                    {
+                        "name": catalogue_name(entity_type.replace("_", " ").title(), rng, 500),
+                        "properties": {"image": {"url": f"https://img.example/{entity_type}/{i}.jpg"}}
+                    }
+                    for i in range(take)
+                ]
+            }
+        }
+
+
+class FakeResponse:
+    def __init__(self, text):
+        self.text = text
+
+
+ACTIVITIES = ["movies", "books", "podcast", "videogame", "tv_show", "travel", "music"]
+
+
+class FakeGeminiModel:
+    """
+    In-process stand-in for genai.GenerativeModel.
+
+    generate_content() and generate_content_async() recognise each prompt the
+    backend sends by a phrase unique to its template and answer with JSON of the
+    shape that template's parser expects. Titles come from a catalogue of
+    catalogue_size names per category. Errors are raised as ServiceUnavailable;
+    malformed replies are truncated JSON. With quota_per_minute set, calls over
+    that rate (counted per one-second window) raise ResourceExhausted, like a 429.
+    A call slower than its request_options timeout raises DeadlineExceeded.
+    """
+
+    model_name = "models/bench-fake"
+
+    # Checked in order: the fused mood prompt also contains the mood phrase, and so on
+    TEMPLATE_MARKERS = [
+        ('"genre_examples": {', "mood_and_genre_examples"),
+        ("for the activity type", "mood_examples_batch"),
+        ("is currently feeling", "mood_activities"),
+        ("genre preferences under each activity", "genre_examples"),
+        ("array of exact names/titles", "community_examples_batch"),
+        ("cultural trends expert", "community_example"),
+        ("cultural journey assistant", "journey_cards"),
+        ("friend_preference_example", "friend_examples"),
+        ("For EACH title", "enrichment_batch"),
+        ('"summary": "Brief description"', "enrichment"),
+        ("taste contrast engine", "contrasting_examples"),
+        ("'description' (string)", "descriptions_with_categories"),
+        ("structured knowledge assistant", "item_details"),
+        ("For EACH group", "group_description_batch"),
+        ("Title: <group title>", "group_description"),
+        ('"recommendations": ["example1", "example2"]', "single_example"),
+    ]
+
+    def __init__(self, faults=None, catalogue_size=200, seed=None, quota_per_minute=None):
+        self.faults = faults or Faults(seed=seed)
+        self.catalogue_size = catalogue_size
+        self.quota_per_second = quota_per_minute / 60 if quota_per_minute else None
+        self._window = (0, 0)
+        self.calls = CallCounter()
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def template_for(self, prompt):
+        for marker, template_id in self.TEMPLATE_MARKERS:
+            if marker in prompt:
+                return template_id
+        return "unknown"
+
+    def generate_content(self, prompt, generation_config=None, request_options=None, **kwargs):
+        delay, outcome, template_id = self._draw(prompt)
+        timeout = self._timeout(request_options)
+        time.sleep(min(delay, timeout))
+        return self._respond(prompt, outcome if delay <= timeout else "timeout", template_id)
+
+    async def generate_content_async(self, prompt, generation_config=None, request_options=None, **kwargs):
+        delay, outcome, template_id = self._draw(prompt)
+        timeout = self._timeout(request_options)
+        await asyncio.sleep(min(delay, timeout))
+        return self._respond(prompt, outcome if delay <= timeout else "timeout", template_id)
+
+    @staticmethod
+    def _timeout(request_options):
+        timeout = (request_options or {}).get("timeout")
+        return float("inf") if timeout is None else timeout
+
+    def _draw(self, prompt):
+        template_id = self.template_for(prompt)
+        delay, outcome = self.faults.draw()
+        if self.quota_per_second is not None and self._over_quota():
+            delay, outcome = 0.005, "throttled"
+        self.calls.add(template_id, outcome)
+        return delay, outcome, template_id
+
+    def _over_quota(self):
+        second = int(time.monotonic())
+        with self._lock:
+            start, count = self._window
+            count = count + 1 if start == second else 1
+            self._window = (second, count)
+        return count > self.quota_per_second
+
+    def _respond(self, prompt, outcome, template_id):
+        if outcome == "error":
+            raise google_exceptions.ServiceUnavailable("bench: injected Gemini error")
+        if outcome == "throttled":
+            raise google_exceptions.ResourceExhausted("bench: Gemini quota exceeded")
+        if outcome == "timeout":
+            raise google_exceptions.DeadlineExceeded("bench: Gemini call timed out")
+        with self._lock:
+            text = self.reply(template_id, prompt)
+        if outcome == "malformed":
+            text = truncate(text)
+        return FakeResponse(text)
+
+    def _title(self, category):
+        return catalogue_name(category.replace("_", " ").title(), self._rng, self.catalogue_size)
+
+    def _titles(self, category, count):
+        return list(dict.fromkeys(self._title(category) for _ in range(count)))
+
+    def _mood_activities(self):
+        return self._rng.sample(ACTIVITIES, self._rng.randint(2, 4))
+
+    def reply(self, template_id, prompt):
+        """Reply text for one prompt, in the format its template asks for."""
+        if template_id == "single_example":
+            category = _between(prompt, 'in the category "', '"') or "movies"
+            return json.dumps({"recommendations": self._titles(category, 2)})
+
+        if template_id == "mood_activities":
+            return json.dumps({activity: self._title(activity) for activity in self._mood_activities()})
+
+        if template_id == "mood_examples_batch":
+            activity = _between(prompt, 'activity type "', '"') or "movies"
+            return json.dumps(self._titles(activity, _first_int(prompt, r"Give (\d+) different", 8)))
+
+        if template_id in ("genre_examples", "mood_and_genre_examples"):
+            preferences = _json_after(prompt, "under each activity category:", {})
+            activities = self._mood_activities() if template_id == "mood_and_genre_examples" else list(preferences)
+            genre_examples = {
+                activity: self._titles(activity, len(preferences.get(activity, [])))
+                for activity in activities if preferences.get(activity)
+            }
+            if template_id == "genre_examples":
+                return json.dumps(genre_examples)
+            return json.dumps({
+                "activities": {activity: self._title(activity) for activity in activities},
+                "genre_examples": genre_examples
+            })
+
+        if template_id == "community_examples_batch":
+            category = _between(prompt, 'Category: "', '"') or "movies"
+            return json.dumps(self._titles(category, _first_int(prompt, r"identify (\d+) specific", 8)))
+
+        if template_id == "community_example":
+            return self._title(_between(prompt, 'Category: "', '"') or "movies")
+
+        if template_id == "journey_cards":
+            return json.dumps({
+                slot: {"content": f"A {kind} for your {slot}", "item": self._title(kind), "archetype": "Bench Opposite"}
+                for slot, kind in (("morning", "music"), ("afternoon", "podcast"), ("night", "movies"))
+            })
+
+        if template_id == "friend_examples":
+            activity = _between(prompt, 'selected the activity: "', '"') or "movies"
+            friends = _json_after(prompt, "following preferences and relationships:", [])
+            return json.dumps({
+                "user_preference_example": self._title(activity),
+                "friend_preference_example": self._titles(activity, max(len(friends), 1))
+            })
+
+        if template_id == "enrichment_batch":
+            names = _json_after(prompt, "recommendations:", [])
+            return json.dumps([self._enrichment(name) for name in names])
+
+        if template_id == "enrichment":
+            return json.dumps(self._enrichment(_between(prompt, 'titled: "', '"')))
+
+        if template_id == "contrasting_examples":
+            return json.dumps({category: self._title(category) for category in ("movies", "podcast", "books", "music", "tv_show")})
+
+        if template_id == "descriptions_with_categories":
+            items = _json_after(prompt, "for the following list:", [])
+            return json.dumps([dict(item, description=f"A short description of {item.get('title')}.") for item in items])
+
+        if template_id == "item_details":
+            name = _between(prompt, 'The title is:\n        "', '"') or "Unknown"
+            return json.dumps({
+                "name": name,
+                "release_year": 2000 + self._rng.randrange(25),
+                "genre": "Drama",
+                "platforms_available": [{"name": "Netflix", "icon_url": "https://img.example/netflix.png"}]
+            })
+
+        if template_id == "group_description_batch":
+            groups = _json_after(prompt, "a category and its titles:", [])
+            return json.dumps([
+                {"group": group.get("group"), "title": f"Favourite {group.get('category')}",
+                 "description": "Easy picks that share a warm, unhurried mood."}
+                for group in groups
+            ])
+
+        if template_id == "group_description":
+            return "Title: Late Night Favourites\nDescription: Easy picks that share a warm, unhurried mood."
+
+        return "{}"
+
+    def _enrichment(self, name):
+        return {
+            "name": name,
+            "summary": f"A short summary of {name}.",
+            "rating": f"{self._rng.uniform(3, 5):.1f}",
+            "cost": self._rng.choice(["Free", "Paid"])
+        }
+
+
+def _between(text, start, end):
+    begin = text.find(start)
+    if begin < 0:
+        return None
+    begin += len(start)
+    stop = text.find(end, begin)
+    return text[begin:stop] if stop >= 0 else None
+
+
+def _first_int(text, pattern, default):
+    match = re.search(pattern, text)
+    return int(match.group(1)) if match else default
+
+
+def _json_after(text, marker, default):
+    """Decode the first JSON value that follows marker in a prompt."""
+    begin = text.find(marker)
+    if begin < 0:
+        return default
+    rest = text[begin + len(marker):].lstrip()
+    try:
+        value, _ = json.JSONDecoder().raw_decode(rest)
+    except ValueError:
+        return default
+    return value if isinstance(value, type(default)) else default
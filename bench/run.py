@@ -0,0 +1,369 @@
+"""
+Offline load benchmark for the backend.
+
+Starts a local Qloo stand-in and swaps the Gemini model for an in-process fake
+(see bench/fakes.py), then drives every route of app.py (or asgi.py with
+--app quart) at each concurrency level and reports latency percentiles,
+throughput and upstream calls per request. Nothing leaves the machine.
+
+With --cassette, the fakes are replaced by a recording made with
+UPSTREAM_CASSETTE_MODE=record (see cassette.py): the recorded inbound
+requests are replayed as one mixed batch per concurrency level, and upstream
+calls are answered from the cassette with their recorded timings.
+
+    python -m bench.run --concurrency 1,8,32 --requests 50
+    python -m bench.run --app quart --routes daily,community --gemini-error-rate 0.05
+    python -m bench.run --cassette traffic.jsonl.gz --time-scale 0.5
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+from bench.fakes import Faults, FakeGeminiModel, FakeQloo, Latency
+
+ARCHETYPES = [
+    "Alt Pulse", "Lyrical Romantic", "Culture Hacker", "Minimal Spirit", "Mystic Pulse", "Pop Dreamer",
+    "Zen Zest", "Retro Soul", "Cyber Chill", "Cine Nomad",
+]
+CATEGORIES = ["movies", "books", "podcast", "videogame", "tv_show", "music", "travel"]
+GENRES = {
+    "movies": ["comedy", "thriller", "sci-fi"], "books": ["mystery", "fantasy"], "music": ["pop", "jazz", "lofi"],
+    "podcast": ["true crime"], "tv_show": ["sitcom", "drama"],
+}
+# The last two fall outside the local mood lexicon and take the Gemini path
+MOODS = ["happy", "so tired today", "stressed about work", "feeling romantic", "not happy", "curious", "kind of purple", "meh-ish"]
+
+
+def _preference(rng, category):
+    return f"{category.replace('_', ' ').title()} {rng.randrange(200)}"
+
+
+def _genre_preferences(rng):
+    categories = rng.sample(sorted(GENRES), rng.randint(1, 3))
+    return {category: rng.sample(GENRES[category], rng.randint(1, len(GENRES[category]))) for category in categories}
+
+
+def _save_preferences(rng):
+    category = rng.choice(CATEGORIES)
+    return {"activeCategory": category, "exampleCategory": category, "preference": _preference(rng, category)}
+
+
+# Route -> (method, request body factory). Bodies draw from small vocabularies so
+# repeat requests hit the caches at a realistic rate.
+ROUTES = {
+    "/save-preferences": ("POST", _save_preferences),
+    "/save-preferences/stream": ("POST", _save_preferences),
+    "/get-item-details": ("POST", lambda rng: {"category": rng.choice(CATEGORIES), "name": _preference(rng, "movies")}),
+    "/daily-recommendations": ("POST", lambda rng: {"mood": rng.choice(MOODS), "preferences": _genre_preferences(rng)}),
+    "/community-recommendations": (
+        "POST", lambda rng: {"archetype": rng.choice(ARCHETYPES), "category": rng.choice(CATEGORIES)}
+    ),
+    "/mismatch-walkin-their-shoes-gemini": ("POST", lambda rng: {"archetype": rng.choice(ARCHETYPES)}),
+    "/discover-journey-card-recommendations": (
+        "POST", lambda rng: {"item": _preference(rng, "music"), "category": rng.choice(["music", "podcast", "movies"])}
+    ),
+    "/blend-recommendations": ("POST", lambda rng: {
+        "userPreferences": _genre_preferences(rng),
+        "friendPreferences": [_genre_preferences(rng) for _ in range(rng.randint(1, 3))],
+        "selectedActivities": [rng.choice(CATEGORIES)],
+    }),
+    "/swap_deck-recommendations": ("POST", lambda rng: {"archetype": rng.choice(ARCHETYPES)}),
+    "/cache-stats": ("GET", lambda rng: None),
+    "/metrics": ("GET", lambda rng: None),
+}
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, -(-len(sorted_values) * pct // 100))
+    return sorted_values[int(rank) - 1]
+
+
+def run_flask(app, requests, concurrency):
+    """Send requests through Flask test clients from `concurrency` threads; return (latency, status) pairs."""
+    local = threading.local()
+
+    def send(method, path, body):
+        client = getattr(local, "client", None)
+        if client is None:
+            client = local.client = app.test_client()
+        start = time.perf_counter()
+        response = client.open(path, method=method, json=body)
+        response.get_data()
+        return time.perf_counter() - start, response.status_code
+
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="bench-client") as executor:
+        futures = [executor.submit(send, *request) for request in requests]
+        return [future.result() for future in futures]
+
+
+def run_quart(app, requests, concurrency):
+    """asyncio counterpart of run_flask() for the Quart app, with at most `concurrency` requests in flight."""
+    async def main():
+        async with app.test_app() as test_app:
+            client = test_app.test_client()
+            semaphore = asyncio.Semaphore(concurrency)
+
+            async def send(method, path, body):
+                async with semaphore:
+                    start = time.perf_counter()
+                    response = await client.open(path, method=method, json=body)
+                    await response.get_data()
+                    return time.perf_counter() - start, response.status_code
+
+            return await asyncio.gather(*(send(*request) for request in requests))
+
+    return asyncio.run(main())
+
+
+def fake_upstream_counts(qloo, gemini):
+    """Upstream calls seen by the fakes so far: search, insights, and Gemini per template."""
+    gemini_calls = {
+        template_id: count for template_id, count in gemini.calls.snapshot().items()
+        if template_id not in ("error", "malformed", "throttled")
+    }
+    qloo_calls = qloo.calls.snapshot()
+    return {"search": qloo_calls.get("search", 0), "insights": qloo_calls.get("insights", 0), "gemini": gemini_calls}
+
+
+def cassette_upstream_counts(cassette):
+    """The same counts for exchanges served from a cassette. Gemini is not split by template."""
+    replayed = cassette.get_stats()["replayed_by_operation"]
+    qloo_calls = replayed.get("qloo", {})
+    return {
+        "search": qloo_calls.get("search", 0),
+        "insights": qloo_calls.get("insights", 0),
+        "gemini": replayed.get("gemini", {}),
+    }
+
+
+def measure(runner, app, requests, concurrency, upstream_counts, settle):
+    """Run one batch; return (latency, status) pairs, wall time and upstream calls made during the batch."""
+    before = upstream_counts()
+    started = time.perf_counter()
+    results = runner(app, requests, concurrency)
+    elapsed = time.perf_counter() - started
+    # Let background refills kicked off by this batch finish, so their calls are counted against it
+    time.sleep(settle)
+    after = upstream_counts()
+
+    by_template = {
+        template_id: count - before["gemini"].get(template_id, 0)
+        for template_id, count in after["gemini"].items()
+        if count != before["gemini"].get(template_id, 0)
+    }
+    calls = {
+        "search": after["search"] - before["search"],
+        "insights": after["insights"] - before["insights"],
+        "gemini": sum(by_template.values()),
+        "gemini_by_template": by_template,
+    }
+    return results, elapsed, calls
+
+
+def summarize(route, concurrency, results, elapsed, calls=None):
+    """One report row. calls is None for per-route rows of a mixed run, where calls can't be attributed."""
+    count = len(results)
+    latencies = sorted(latency * 1000 for latency, _ in results)
+    row = {
+        "route": route,
+        "concurrency": concurrency,
+        "requests": count,
+        "errors": sum(1 for _, status in results if status >= 400),
+        "p50_ms": round(percentile(latencies, 50), 1),
+        "p95_ms": round(percentile(latencies, 95), 1),
+        "p99_ms": round(percentile(latencies, 99), 1),
+        "mean_ms": round(sum(latencies) / count, 1) if count else 0.0,
+        "throughput_rps": round(count / elapsed, 1) if elapsed else 0.0,
+        "qloo_search_per_request": None,
+        "qloo_insights_per_request": None,
+        "gemini_per_request": None,
+        "gemini_by_template": None,
+    }
+    if calls is not None and count:
+        row.update({
+            "qloo_search_per_request": round(calls["search"] / count, 2),
+            "qloo_insights_per_request": round(calls["insights"] / count, 2),
+            "gemini_per_request": round(calls["gemini"] / count, 2),
+            "gemini_by_template": calls["gemini_by_template"],
+        })
+    return row
+
+
+def bench_route(runner, app, route, concurrency, count, rng, upstream_counts, settle):
+    method, make_body = ROUTES[route]
+    requests = [(method, route, make_body(rng)) for _ in range(count)]
+    results, elapsed, calls = measure(runner, app, requests, concurrency, upstream_counts, settle)
+    return summarize(route, concurrency, results, elapsed, calls)
+
+
+def bench_mix(runner, app, requests, concurrency, upstream_counts, settle):
+    """Run a recorded request mix as one batch: a row per route, then an "(all)" row with upstream calls."""
+    results, elapsed, calls = measure(runner, app, requests, concurrency, upstream_counts, settle)
+    by_route = {}
+    for (_, path, _), result in zip(requests, results):
+        by_route.setdefault(path, []).append(result)
+    rows = [summarize(path, concurrency, route_results, elapsed) for path, route_results in sorted(by_route.items())]
+    rows.append(summarize("(all)", concurrency, results, elapsed, calls))
+    return rows
+
+
+def _per_request(value):
+    return f"{value:>7.2f}" if value is not None else f"{'-':>7}"
+
+
+def format_table(results):
+    header = (f"{'route':<40} {'conc':>4} {'n':>5} {'err':>4} {'p50':>8} {'p95':>8} {'p99':>8} "
+              f"{'req/s':>7} {'search':>7} {'insight':>7} {'gemini':>7}")
+    lines = [header, "-" * len(header)]
+    for r in results:
+        lines.append(
+            f"{r['route']:<40} {r['concurrency']:>4} {r['requests']:>5} {r['errors']:>4} "
+            f"{r['p50_ms']:>8.1f} {r['p95_ms']:>8.1f} {r['p99_ms']:>8.1f} {r['throughput_rps']:>7.1f} "
+            f"{_per_request(r['qloo_search_per_request'])} {_per_request(r['qloo_insights_per_request'])} "
+            f"{_per_request(r['gemini_per_request'])}"
+        )
+    lines.append("Latencies in ms; search/insight/gemini are upstream calls per request, retries included.")
+    return "\n".join(lines)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the backend against local Qloo and Gemini stand-ins.")
+    parser.add_argument("--app", choices=["flask", "quart"], default="flask", help="app.py (flask) or asgi.py (quart)")
+    parser.add_argument("--concurrency", default="1,8,32", help="comma-separated concurrency levels")
+    parser.add_argument("--requests", type=int, default=40, help="requests per route and concurrency level")
+    parser.add_argument("--warmup", type=int, default=5, help="unmeasured requests per route before the first level")
+    parser.add_argument("--routes", default="", help="comma-separated substrings; only matching routes are run")
+    parser.add_argument("--qloo-latency", default="lognormal:40,0.4", help="fixed:MS, uniform:LO,HI or lognormal:MEDIAN,SIGMA")
+    parser.add_argument("--gemini-latency", default="lognormal:300,0.4", help="same format as --qloo-latency")
+    parser.add_argument("--qloo-error-rate", type=float, default=0.0, help="fraction of Qloo calls answered with 503")
+    parser.add_argument("--qloo-malformed-rate", type=float, default=0.0, help="fraction of Qloo calls with truncated JSON")
+    parser.add_argument("--gemini-error-rate", type=float, default=0.0, help="fraction of Gemini calls that raise")
+    parser.add_argument("--gemini-malformed-rate", type=float, default=0.0, help="fraction of Gemini replies with truncated JSON")
+    parser.add_argument("--gemini-quota", type=float, help="requests per minute the fake Gemini allows before answering 429")
+    parser.add_argument("--catalogue", type=int, default=200, help="distinct titles the fake Gemini draws from per category")
+    parser.add_argument("--settle", type=float, default=0.2, help="seconds to wait after each batch for background work")
+    parser.add_argument("--cassette", help="replay the inbound requests and upstream exchanges recorded in this cassette")
+    parser.add_argument("--time-scale", type=float, default=1.0, help="replayed upstream delays are recorded duration x this")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", dest="json_path", help="also write the results to this file as JSON")
+    parser.add_argument("--verbose", action="store_true", help="keep the app's own log output")
+    return parser.parse_args(argv)
+
+
+def _import_app(kind, verbose=False):
+    if kind == "quart":
+        from asgi import app
+        runner = run_quart
+    else:
+        from app import app
+        runner = run_flask
+    if not verbose:
+        # app.py turns on DEBUG logging for everything; per-request urllib3 and
+        # werkzeug lines would cost more than some of the routes being measured
+        logging.getLogger().setLevel(logging.WARNING)
+    return app, runner
+
+
+def run_fakes(args, levels, routes, out):
+    qloo = FakeQloo(Faults(Latency.parse(args.qloo_latency), args.qloo_error_rate, args.qloo_malformed_rate, args.seed))
+    gemini = FakeGeminiModel(
+        Faults(Latency.parse(args.gemini_latency), args.gemini_error_rate, args.gemini_malformed_rate, args.seed),
+        catalogue_size=args.catalogue, seed=args.seed, quota_per_minute=args.gemini_quota
+    )
+
+    # Point the app at the fakes before it is imported
+    os.environ["QLOO_BASE_URL"] = qloo.start()
+    import recommendation
+    recommendation.model = recommendation.gemini.model = gemini
+    app, runner = _import_app(args.app, args.verbose)
+
+    def upstream_counts():
+        return fake_upstream_counts(qloo, gemini)
+
+    print(f"qloo latency {Latency.parse(args.qloo_latency)}, gemini latency {Latency.parse(args.gemini_latency)}", file=out)
+    results = []
+    rng = random.Random(args.seed)
+    try:
+        for route in routes:
+            if args.warmup:
+                bench_route(runner, app, route, 1, args.warmup, rng, upstream_counts, args.settle)
+            for level in levels:
+                result = bench_route(runner, app, route, level, args.requests, rng, upstream_counts, args.settle)
+                results.append(result)
+                print(f"  {route} x{level}: p50 {result['p50_ms']}ms, {result['throughput_rps']} req/s", file=out)
+    finally:
+        qloo.stop()
+    return results
+
+
+def run_cassette(args, levels, routes, out):
+    os.environ["UPSTREAM_CASSETTE_MODE"] = "replay"
+    os.environ["UPSTREAM_CASSETTE_PATH"] = args.cassette
+    os.environ["UPSTREAM_CASSETTE_TIME_SCALE"] = str(args.time_scale)
+    from cassette import cassette
+    app, runner = _import_app(args.app, args.verbose)
+
+    requests = [request for request in cassette.inbound_requests() if request[1] in routes]
+    if not requests:
+        sys.exit(f"{args.cassette} has no recorded requests for the selected routes")
+
+    def upstream_counts():
+        return cassette_upstream_counts(cassette)
+
+    print(f"replaying {len(requests)} requests from {args.cassette}, upstream time scale {args.time_scale:g}", file=out)
+    results = []
+    for level in levels:
+        rows = bench_mix(runner, app, requests, level, upstream_counts, args.settle)
+        results.extend(rows)
+        print(f"  mix x{level}: p50 {rows[-1]['p50_ms']}ms, {rows[-1]['throughput_rps']} req/s", file=out)
+    misses = cassette.get_stats()["misses"]
+    if misses:
+        print(f"  {misses} upstream calls had no recorded exchange and failed", file=out)
+    return results
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    levels = [int(level) for level in args.concurrency.split(",") if level.strip()]
+    filters = [f.strip() for f in args.routes.split(",") if f.strip()]
+    routes = [route for route in ROUTES if not filters or any(f in route for f in filters)]
+    if not routes:
+        sys.exit(f"No routes match --routes {args.routes!r}")
+
+    # Keep the entity cache in memory so runs start cold and leave no file behind
+    os.environ.setdefault("QLOO_API_KEY", "bench")
+    os.environ.setdefault("GOOGLE_API_KEY", "bench")
+    os.environ["ENTITY_CACHE_PATH"] = ""
+    # Startup pool warming would run during the first route and skew its upstream counts
+    os.environ.setdefault("WARM_EXAMPLE_POOLS", "0")
+
+    out = sys.stdout
+    quiet = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(io.StringIO())
+    with quiet:
+        if args.cassette:
+            results = run_cassette(args, levels, routes, out)
+        else:
+            results = run_fakes(args, levels, routes, out)
+
+    print(format_table(results), file=out)
+    if args.json_path:
+        with open(args.json_path, "w") as f:
+            json.dump({"args": vars(args), "results": results}, f, indent=2)
+        print(f"Wrote {args.json_path}", file=out)
+
+
+if __name__ == "__main__":
+    main()
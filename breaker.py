@@ -0,0 +1,157 @@
+import os
+import threading
+import time
+
+from collections import deque
+from contextlib import contextmanager
+
+from deadline import expired
+from metrics import circuit_rejected, circuit_state
+
+# Outcomes of the last BREAKER_WINDOW calls decide whether an upstream is
+# healthy; nothing is decided before BREAKER_MIN_CALLS of them are in
+BREAKER_WINDOW = int(os.getenv("BREAKER_WINDOW", "20"))
+BREAKER_MIN_CALLS = int(os.getenv("BREAKER_MIN_CALLS", "10"))
+# Share of failed, or of slow, calls in the window that opens the circuit
+BREAKER_ERROR_RATE = float(os.getenv("BREAKER_ERROR_RATE", "0.5"))
+BREAKER_SLOW_RATE = float(os.getenv("BREAKER_SLOW_RATE", "0.8"))
+# How long an open circuit fails fast before a probe call is let through
+BREAKER_OPEN_SECONDS = float(os.getenv("BREAKER_OPEN_SECONDS", "15"))
+
+CLOSED = "closed"
+HALF_OPEN = "half_open"
+OPEN = "open"
+STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+class CircuitOpen(RuntimeError):
+    """An upstream call was refused without being sent because its circuit is open."""
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker for one upstream.
+
+    Closed, calls go through and their outcomes are kept for the last `window`
+    calls. Once at least min_calls are in and error_rate of them failed, or
+    slow_rate of them took longer than slow_call seconds, the circuit opens.
+    Open, every call fails at once with CircuitOpen, so callers fall back to
+    cached or default data without tying up a worker on a dead upstream.
+    After open_for seconds it is half-open: a single probe call goes through
+    while the rest keep failing fast. A probe that succeeds in time closes the
+    circuit; one that fails or is slow opens it again.
+
+    is_failure(exc) decides which exceptions count against the upstream; the
+    rest (e.g. a 404, or a call shed before it was sent) are not recorded.
+    Errors once the request's deadline has passed aren't counted either, as
+    that timeout was ours.
+    """
+
+    def __init__(self, name, window=BREAKER_WINDOW, min_calls=BREAKER_MIN_CALLS, error_rate=BREAKER_ERROR_RATE,
+                 slow_call=10.0, slow_rate=BREAKER_SLOW_RATE, open_for=BREAKER_OPEN_SECONDS, is_failure=None):
+        self.name = name
+        self.min_calls = min_calls
+        self.error_rate = error_rate
+        self.slow_call = slow_call
+        self.slow_rate = slow_rate
+        self.open_for = open_for
+        self.is_failure = is_failure or (lambda exc: isinstance(exc, Exception))
+        self._outcomes = deque(maxlen=window)
+        self._state = CLOSED
+        self._opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+        self.stats = {"opened": 0, "rejected": 0, "probes": 0}
+        circuit_state.set(name, value=STATE_VALUES[CLOSED])
+
+    # ---------- state (call with the lock held) ----------
+
+    def _current_state(self, now):
+        if self._state == OPEN and now >= self._opened_at + self.open_for:
+            self._set_state(HALF_OPEN)
+        return self._state
+
+    def _set_state(self, state):
+        if state == OPEN:
+            self._opened_at = time.monotonic()
+            self.stats["opened"] += 1
+        self._state = state
+        self._outcomes.clear()
+        circuit_state.set(self.name, value=STATE_VALUES[state])
+
+    def _reject(self):
+        self.stats["rejected"] += 1
+        circuit_rejected.inc(self.name)
+        raise CircuitOpen(f"{self.name} circuit is open")
+
+    # ---------- calls ----------
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._current_state(time.monotonic())
+
+    def is_open(self):
+        """True while calls are being refused, i.e. open or half-open."""
+        return self.state != CLOSED
+
+    def check(self):
+        """Raise CircuitOpen if a call made now would be refused. Doesn't take the half-open probe."""
+        with self._lock:
+            state = self._current_state(time.monotonic())
+            if state == OPEN or (state == HALF_OPEN and self._probing):
+                self._reject()
+
+    @contextmanager
+    def guard(self):
+        """Run the enclosed upstream call through the breaker, recording how it went."""
+        with self._lock:
+            state = self._current_state(time.monotonic())
+            if state == OPEN or (state == HALF_OPEN and self._probing):
+                self._reject()
+            probe = state == HALF_OPEN
+            if probe:
+                self._probing = True
+                self.stats["probes"] += 1
+
+        start = time.monotonic()
+        try:
+            yield
+        except BaseException as exc:
+            if isinstance(exc, Exception) and self.is_failure(exc) and not expired():
+                self._record(probe, failed=True, slow=False)
+            elif probe:
+                with self._lock:
+                    self._probing = False
+            raise
+        self._record(probe, failed=False, slow=time.monotonic() - start >= self.slow_call)
+
+    def _record(self, probe, failed, slow):
+        with self._lock:
+            if probe:
+                self._probing = False
+                self._set_state(OPEN if failed or slow else CLOSED)
+                return
+            if self._state != CLOSED:
+                # Calls sent before the circuit opened don't count towards closing it
+                return
+
+            self._outcomes.append((failed, slow))
+            calls = len(self._outcomes)
+            if calls < self.min_calls:
+                return
+            failures = sum(1 for failed, _ in self._outcomes if failed)
+            slow_calls = sum(1 for _, slow in self._outcomes if slow)
+            if failures >= self.error_rate * calls or slow_calls >= self.slow_rate * calls:
+                print(f"[WARN] {self.name} circuit opened: {failures}/{calls} failed, {slow_calls}/{calls} slow")
+                self._set_state(OPEN)
+
+    def get_stats(self):
+        with self._lock:
+            now = time.monotonic()
+            stats = dict(self.stats)
+            stats["state"] = self._current_state(now)
+            stats["recent_calls"] = len(self._outcomes)
+            stats["recent_failures"] = sum(1 for failed, _ in self._outcomes if failed)
+            stats["open_for"] = round(max(self._opened_at + self.open_for - now, 0.0), 2) if stats["state"] == OPEN else 0.0
+        return stats
@@ -0,0 +1,401 @@
+import asyncio
+import contextvars
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from collections import OrderedDict
+
+from breaker import CircuitOpen
+from tracing import mark
+
+# Returned by cache lookups when a key is absent or expired, so that a cached
+# None (e.g. a failed entity lookup) can be told apart from a miss.
+MISSING = object()
+
+
+class TTLCache:
+    """
+    Thread-safe in-memory LRU cache where every entry carries its own TTL.
+    """
+
+    def __init__(self, max_entries=1024, ttl=3600):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return MISSING
+
+            value, expires_at = entry
+            if expires_at <= time.time():
+                del self._entries[key]
+                return MISSING
+
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None, expires_at=None):
+        if expires_at is None:
+            expires_at = time.time() + (self.ttl if ttl is None else ttl)
+
+        with self._lock:
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class SqliteCache:
+    """
+    Small persistent key/value store with per-row expiry, backed by a local SQLite file.
+    Values are stored as text; callers serialize them.
+    """
+
+    def __init__(self, path, table="cache"):
+        self.path = path
+        self.table = table
+        self._lock = threading.Lock()
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            f"CREATE TABLE IF NOT EXISTS {table} (key TEXT PRIMARY KEY, value TEXT, expires_at REAL NOT NULL)"
+        )
+        self._conn.execute(f"DELETE FROM {table} WHERE expires_at <= ?", (time.time(),))
+
+    def get(self, key):
+        """Return (value, expires_at) for a live row, or MISSING."""
+        with self._lock:
+            row = self._conn.execute(
+                f"SELECT value, expires_at FROM {self.table} WHERE key = ?", (key,)
+            ).fetchone()
+
+        if row is None or row[1] <= time.time():
+            return MISSING
+        return row
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._conn.execute(
+                f"INSERT OR REPLACE INTO {self.table} (key, value, expires_at) VALUES (?, ?, ?)",
+                (key, value, time.time() + ttl)
+            )
+
+
+def normalize_query(query):
+    """Lower-case and collapse whitespace so trivially different spellings share a cache entry."""
+    return " ".join(str(query).lower().split())
+
+
+class EntityIdCache:
+    """
+    Two-tier cache for Qloo name -> entity_id lookups.
+
+    Keys are the normalized query plus the Qloo filter.type. The first tier is an
+    in-memory TTLCache, the second a SQLite file that survives restarts. Lookups
+    that found nothing are cached as None with a shorter TTL so they are not
+    retried on every request.
+    """
+
+    def __init__(self, path, max_entries=5000, ttl=7 * 24 * 3600, negative_ttl=3600):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.memory = TTLCache(max_entries=max_entries, ttl=ttl)
+        self.disk = None
+        self._stats_lock = threading.Lock()
+        self.stats = {"memory_hits": 0, "disk_hits": 0, "negative_hits": 0, "misses": 0, "stores": 0}
+
+        if path:
+            try:
+                self.disk = SqliteCache(path, table="entity_ids")
+            except sqlite3.Error as e:
+                print(f"[WARN] Entity cache running memory-only, could not open {path}: {e}")
+
+    @staticmethod
+    def make_key(query, entity_type):
+        return f"{entity_type}|{normalize_query(query)}"
+
+    def _count(self, name):
+        with self._stats_lock:
+            self.stats[name] += 1
+
+    def get(self, query, entity_type, disk=True):
+        """Return the cached entity_id (None for a cached miss), or MISSING. disk=False skips the SQLite tier."""
+        key = self.make_key(query, entity_type)
+
+        value = self.memory.get(key)
+        if value is not MISSING:
+            self._count("memory_hits" if value else "negative_hits")
+            mark("entity-cache", result="memory" if value else "negative")
+            return value
+
+        if disk and self.disk is not None:
+            try:
+                row = self.disk.get(key)
+            except sqlite3.Error as e:
+                print(f"[WARN] Entity cache read failed for '{key}': {e}")
+                row = MISSING
+
+            if row is not MISSING:
+                value = row[0] or None
+                # Promote to memory with the remaining lifetime of the disk row
+                self.memory.set(key, value, expires_at=row[1])
+                self._count("disk_hits" if value else "negative_hits")
+                mark("entity-cache", result="disk" if value else "negative")
+                return value
+
+        self._count("misses")
+        mark("entity-cache", result="miss")
+        return MISSING
+
+    async def get_async(self, query, entity_type):
+        """asyncio counterpart of get(): memory hits are served on the loop, SQLite is read in a worker thread."""
+        if self.disk is None or self.memory.get(self.make_key(query, entity_type)) is not MISSING:
+            return self.get(query, entity_type, disk=False)
+        return await asyncio.to_thread(self.get, query, entity_type)
+
+    def set(self, query, entity_type, entity_id):
+        key, ttl = self._set_memory(query, entity_type, entity_id)
+        self._write_disk(key, entity_id, ttl)
+
+    async def set_async(self, query, entity_type, entity_id):
+        """asyncio counterpart of set(); the SQLite write runs in a worker thread."""
+        key, ttl = self._set_memory(query, entity_type, entity_id)
+        if self.disk is not None:
+            await asyncio.to_thread(self._write_disk, key, entity_id, ttl)
+
+    def _set_memory(self, query, entity_type, entity_id):
+        key = self.make_key(query, entity_type)
+        ttl = self.ttl if entity_id else self.negative_ttl
+        self.memory.set(key, entity_id, ttl=ttl)
+        self._count("stores")
+        return key, ttl
+
+    def _write_disk(self, key, entity_id, ttl):
+        if self.disk is None:
+            return
+        try:
+            self.disk.set(key, entity_id or "", ttl)
+        except sqlite3.Error as e:
+            print(f"[WARN] Entity cache write failed for '{key}': {e}")
+
+    def get_stats(self):
+        with self._stats_lock:
+            stats = dict(self.stats)
+        lookups = stats["memory_hits"] + stats["disk_hits"] + stats["negative_hits"] + stats["misses"]
+        stats["hit_ratio"] = round((lookups - stats["misses"]) / lookups, 4) if lookups else 0.0
+        stats["memory_entries"] = len(self.memory)
+        return stats
+
+
+def canonical_params_key(params, list_params=("signal.interests.entities",)):
+    """
+    Build a stable cache key from request params. Values of list_params are
+    comma-separated IDs and are sorted, so "a,b" and "b,a" map to the same key.
+    """
+    canonical = {}
+    for name, value in params.items():
+        if value is None:
+            continue
+        if name in list_params:
+            if isinstance(value, str):
+                value = value.split(",")
+            value = ",".join(sorted({str(v).strip() for v in value if str(v).strip()}))
+        elif isinstance(value, float):
+            value = repr(value)
+        else:
+            value = str(value)
+        canonical[name] = value
+    return json.dumps(canonical, sort_keys=True, separators=(",", ":"))
+
+
+class ResponseCache:
+    """
+    In-memory LRU cache for upstream responses, bounded by an approximate byte budget.
+
+    Entries are fresh for `ttl` seconds and may then be served stale for another
+    `stale_ttl` seconds while a single background refresh replaces them
+    (stale-while-revalidate). Expired entries stay until evicted, so that when
+    a fetch fails fast because the upstream's circuit is open, the last known
+    good value can be served instead.
+    """
+
+    def __init__(self, ttl=900, stale_ttl=3600, max_bytes=32 * 1024 * 1024, name=None):
+        self.name = name
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self._entries = OrderedDict()
+        self._refreshing = set()
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "stale_hits": 0, "misses": 0, "refreshes": 0, "refresh_errors": 0, "evictions": 0,
+                      "last_good_hits": 0}
+
+    def count(self, name):
+        with self._lock:
+            self.stats[name] += 1
+
+    @staticmethod
+    def _size_of(value):
+        return len(json.dumps(value, default=str))
+
+    def get(self, key):
+        """Return (value, is_stale) for a servable entry, or MISSING."""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return MISSING
+
+            value, size, fresh_until, stale_until = entry
+            if stale_until <= now:
+                return MISSING
+
+            self._entries.move_to_end(key)
+            return value, fresh_until <= now
+
+    def last_good(self, key):
+        """Return the value stored under `key` however old it is, or MISSING."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return MISSING
+            self.stats["last_good_hits"] += 1
+            return entry[0]
+
+    def set(self, key, value, ttl=None):
+        size = self._size_of(value)
+        if size > self.max_bytes:
+            return
+
+        now = time.time()
+        fresh_until = now + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, size, fresh_until, fresh_until + self.stale_ttl)
+            self.current_bytes += size
+            while self.current_bytes > self.max_bytes:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self.stats["evictions"] += 1
+
+    def _remove(self, key):
+        _, size, _, _ = self._entries.pop(key)
+        self.current_bytes -= size
+
+    def get_or_fetch(self, key, fetch):
+        """
+        Serve `key` from the cache, calling fetch() on a miss. A stale hit is
+        returned immediately and refreshed in the background. Exceptions from a
+        synchronous fetch propagate and nothing is cached, except that an open
+        circuit falls back to the last known good value when there is one.
+        """
+        entry = self.get(key)
+        if entry is not MISSING:
+            value, is_stale = entry
+            with self._lock:
+                self.stats["stale_hits" if is_stale else "hits"] += 1
+                start_refresh = is_stale and key not in self._refreshing
+                if start_refresh:
+                    self._refreshing.add(key)
+            if start_refresh:
+                threading.Thread(target=self._refresh, args=(key, fetch), daemon=True).start()
+            self._mark("stale" if is_stale else "hit")
+            return value
+
+        self.count("misses")
+        self._mark("miss")
+        try:
+            value = fetch()
+        except CircuitOpen:
+            value = self.last_good(key)
+            if value is MISSING:
+                raise
+            self._mark("last_good")
+            return value
+        self.set(key, value)
+        return value
+
+    async def get_or_fetch_async(self, key, fetch):
+        """asyncio counterpart of get_or_fetch(); fetch is a coroutine function."""
+        entry = self.get(key)
+        if entry is not MISSING:
+            value, is_stale = entry
+            with self._lock:
+                self.stats["stale_hits" if is_stale else "hits"] += 1
+                start_refresh = is_stale and key not in self._refreshing
+                if start_refresh:
+                    self._refreshing.add(key)
+            if start_refresh:
+                # Outlives the request, so it runs without the request's trace or deadline
+                asyncio.get_running_loop().create_task(self._refresh_async(key, fetch), context=contextvars.Context())
+            self._mark("stale" if is_stale else "hit")
+            return value
+
+        self.count("misses")
+        self._mark("miss")
+        try:
+            value = await fetch()
+        except CircuitOpen:
+            value = self.last_good(key)
+            if value is MISSING:
+                raise
+            self._mark("last_good")
+            return value
+        self.set(key, value)
+        return value
+
+    def _mark(self, result):
+        if self.name:
+            mark(f"{self.name}-cache", result=result)
+
+    async def _refresh_async(self, key, fetch):
+        try:
+            self.set(key, await fetch())
+            self.count("refreshes")
+        except Exception as e:
+            print(f"[WARN] Background refresh failed for {key}: {e}")
+            self.count("refresh_errors")
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
+
+    def _refresh(self, key, fetch):
+        try:
+            self.set(key, fetch())
+            self.count("refreshes")
+        except Exception as e:
+            print(f"[WARN] Background refresh failed for {key}: {e}")
+            self.count("refresh_errors")
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self.stats)
+            stats["entries"] = len(self._entries)
+            stats["bytes"] = self.current_bytes
+        stats["max_bytes"] = self.max_bytes
+        return stats
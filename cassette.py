@@ -0,0 +1,286 @@
+import asyncio
+import atexit
+import collections
+import gzip
+import hashlib
+import json
+import os
+import threading
+import time
+
+import httpx
+import requests
+
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from urllib.parse import parse_qsl, urlsplit
+
+# Record/replay of upstream traffic. Off unless UPSTREAM_CASSETTE_MODE is
+# "record" or "replay"; the cassette is a gzipped JSON-lines file.
+CASSETTE_MODE = os.getenv("UPSTREAM_CASSETTE_MODE", "").lower()
+CASSETTE_PATH = os.getenv("UPSTREAM_CASSETTE_PATH", "upstream.cassette.jsonl.gz")
+# Replay waits recorded duration * scale: 1.0 keeps original timings, 0 replays instantly
+CASSETTE_TIME_SCALE = float(os.getenv("UPSTREAM_CASSETTE_TIME_SCALE", "1.0"))
+
+
+class CassetteMiss(LookupError):
+    """A replayed call has no recorded exchange with the same key."""
+
+
+class ReplayedError(RuntimeError):
+    """An upstream error recorded in the cassette, raised again on replay."""
+
+
+def qloo_key(method, url):
+    """Method, path and sorted query string, so sync and async clients produce the same key."""
+    parts = urlsplit(str(url))
+    query = "&".join(f"{name}={value}" for name, value in sorted(parse_qsl(parts.query, keep_blank_values=True)))
+    return f"{method} {parts.path}?{query}"
+
+
+def gemini_key(prompt, generation_config=None):
+    config = json.dumps(generation_config, sort_keys=True, default=str) if generation_config is not None else ""
+    return hashlib.sha256(f"{prompt}\x00{config}".encode()).hexdigest()
+
+
+class Cassette:
+    """
+    Recorded upstream exchanges, plus the inbound requests that caused them.
+
+    In record mode every exchange is appended to the file as it completes, with
+    its start offset and duration. In replay mode the file is loaded up front and
+    exchanges with the same key are served in recorded order, cycling back to the
+    first once they run out, after sleeping their duration times time_scale.
+    """
+
+    def __init__(self, path, mode, time_scale=1.0):
+        if mode not in ("record", "replay"):
+            raise ValueError(f"Cassette mode must be 'record' or 'replay', not '{mode}'")
+        self.path = path
+        self.mode = mode
+        self.time_scale = time_scale
+        self.started = time.perf_counter()
+        self.stats = {"recorded": 0, "replayed": 0, "misses": 0}
+        self.replayed = {}
+        self._lock = threading.Lock()
+        self._file = None
+        self._exchanges = {}
+        self._inbound = []
+
+        if mode == "record":
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._file = gzip.open(path, "at", encoding="utf-8")
+            atexit.register(self.close)
+        else:
+            self._load()
+
+    @property
+    def recording(self):
+        return self.mode == "record"
+
+    @property
+    def replaying(self):
+        return self.mode == "replay"
+
+    def _load(self):
+        with gzip.open(self.path, "rt", encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                if entry["upstream"] == "inbound":
+                    self._inbound.append(entry)
+                else:
+                    self._exchanges.setdefault((entry["upstream"], entry["key"]), collections.deque()).append(entry)
+        print(f"[INFO] Replaying {sum(map(len, self._exchanges.values()))} upstream exchanges from {self.path}")
+
+    def _write(self, entry):
+        entry["at"] = round(time.perf_counter() - self.started, 4)
+        line = json.dumps(entry, separators=(",", ":"))
+        with self._lock:
+            if self._file is None:
+                return
+            self._file.write(line + "\n")
+            # Sync-flush so a killed worker leaves a readable cassette behind
+            self._file.flush()
+            self.stats["recorded"] += 1
+
+    def record(self, upstream, key, operation, duration, **payload):
+        self._write(dict(payload, upstream=upstream, key=key, operation=operation, duration=round(duration, 4)))
+
+    def record_inbound(self, method, path, body):
+        self._write({"upstream": "inbound", "method": method, "path": path, "body": body})
+
+    def next(self, upstream, key):
+        """The next recorded exchange for this key, rotated to the back of its queue."""
+        with self._lock:
+            queue = self._exchanges.get((upstream, key))
+            if not queue:
+                self.stats["misses"] += 1
+                raise CassetteMiss(f"No recorded {upstream} exchange for {key}")
+            entry = queue.popleft()
+            queue.append(entry)
+            self.stats["replayed"] += 1
+            counts = self.replayed.setdefault(upstream, {})
+            counts[entry["operation"]] = counts.get(entry["operation"], 0) + 1
+        return entry
+
+    def delay(self, entry):
+        return entry["duration"] * self.time_scale
+
+    def inbound_requests(self):
+        """Recorded inbound (method, path, body) triples, in arrival order."""
+        ordered = sorted(self._inbound, key=lambda entry: entry["at"])
+        return [(entry["method"], entry["path"], entry.get("body")) for entry in ordered]
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self.stats, mode=self.mode, path=self.path)
+            stats["replayed_by_operation"] = {upstream: dict(counts) for upstream, counts in self.replayed.items()}
+        return stats
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+def _operation(path):
+    return path.rstrip("/").rsplit("/", 1)[-1]
+
+
+class CassetteAdapter(HTTPAdapter):
+    """requests transport adapter that records responses to, or replays them from, a cassette."""
+
+    def __init__(self, cassette, **kwargs):
+        self.cassette = cassette
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        key = qloo_key(request.method, request.url)
+        operation = _operation(urlsplit(request.url).path)
+        if self.cassette.replaying:
+            entry = self.cassette.next("qloo", key)
+            time.sleep(self.cassette.delay(entry))
+            response = requests.Response()
+            response.status_code = entry["status"]
+            response._content = entry["body"].encode()
+            response.headers = CaseInsensitiveDict({"Content-Type": entry.get("content_type", "application/json")})
+            response.encoding = "utf-8"
+            response.url = request.url
+            response.request = request
+            return response
+
+        start = time.perf_counter()
+        response = super().send(request, **kwargs)
+        self.cassette.record(
+            "qloo", key, operation, time.perf_counter() - start,
+            status=response.status_code, body=response.text,
+            content_type=response.headers.get("Content-Type", "application/json")
+        )
+        return response
+
+
+class AsyncCassetteTransport(httpx.AsyncBaseTransport):
+    """httpx counterpart of CassetteAdapter, wrapping the transport that makes real calls."""
+
+    def __init__(self, cassette, transport):
+        self.cassette = cassette
+        self.transport = transport
+
+    async def handle_async_request(self, request):
+        key = qloo_key(request.method, request.url)
+        operation = _operation(request.url.path)
+        if self.cassette.replaying:
+            entry = self.cassette.next("qloo", key)
+            await asyncio.sleep(self.cassette.delay(entry))
+            return httpx.Response(
+                entry["status"], content=entry["body"].encode(),
+                headers={"Content-Type": entry.get("content_type", "application/json")}, request=request
+            )
+
+        start = time.perf_counter()
+        response = await self.transport.handle_async_request(request)
+        body = await response.aread()
+        self.cassette.record(
+            "qloo", key, operation, time.perf_counter() - start,
+            status=response.status_code, body=body.decode("utf-8", "replace"),
+            content_type=response.headers.get("Content-Type", "application/json")
+        )
+        return httpx.Response(response.status_code, content=body, headers=response.headers, request=request)
+
+    async def aclose(self):
+        await self.transport.aclose()
+
+
+class ReplayedResponse:
+    def __init__(self, text):
+        self.text = text
+
+
+class CassetteModel:
+    """
+    Wraps a Gemini model so generate_content() calls are recorded or replayed.
+    Exchanges are keyed by a hash of the prompt and generation config; the prompt
+    itself is stored alongside for inspection. Errors are recorded and re-raised
+    on replay as ReplayedError.
+    """
+
+    def __init__(self, model, cassette):
+        self.model = model
+        self.cassette = cassette
+        self.model_name = model.model_name
+
+    def generate_content(self, prompt, generation_config=None, **kwargs):
+        key = gemini_key(prompt, generation_config)
+        if self.cassette.replaying:
+            entry = self.cassette.next("gemini", key)
+            time.sleep(self.cassette.delay(entry))
+            return self._replayed(entry)
+
+        start = time.perf_counter()
+        try:
+            if generation_config is None:
+                text = self.model.generate_content(prompt, **kwargs).text
+            else:
+                text = self.model.generate_content(prompt, generation_config=generation_config, **kwargs).text
+        except Exception as e:
+            self._record(key, prompt, start, error=f"{type(e).__name__}: {e}")
+            raise
+        self._record(key, prompt, start, text=text)
+        return ReplayedResponse(text)
+
+    async def generate_content_async(self, prompt, generation_config=None, **kwargs):
+        key = gemini_key(prompt, generation_config)
+        if self.cassette.replaying:
+            entry = self.cassette.next("gemini", key)
+            await asyncio.sleep(self.cassette.delay(entry))
+            return self._replayed(entry)
+
+        start = time.perf_counter()
+        try:
+            if generation_config is None:
+                response = await self.model.generate_content_async(prompt, **kwargs)
+            else:
+                response = await self.model.generate_content_async(prompt, generation_config=generation_config, **kwargs)
+            text = response.text
+        except Exception as e:
+            self._record(key, prompt, start, error=f"{type(e).__name__}: {e}")
+            raise
+        self._record(key, prompt, start, text=text)
+        return ReplayedResponse(text)
+
+    def _record(self, key, prompt, start, **payload):
+        self.cassette.record("gemini", key, "generate_content", time.perf_counter() - start, prompt=prompt, **payload)
+
+    @staticmethod
+    def _replayed(entry):
+        if "error" in entry:
+            raise ReplayedError(entry["error"])
+        return ReplayedResponse(entry["text"])
+
+
+cassette = Cassette(CASSETTE_PATH, CASSETTE_MODE, CASSETTE_TIME_SCALE) if CASSETTE_MODE else None
@@ -0,0 +1,145 @@
+import contextvars
+import os
+import threading
+import time
+
+from contextlib import contextmanager
+
+# Time budget for building one response, in seconds. Streams get longer since
+# the client sees results as they arrive.
+REQUEST_DEADLINE = float(os.getenv("REQUEST_DEADLINE", "10"))
+ROUTE_DEADLINES = {
+    "/save-preferences/stream": float(os.getenv("STREAM_REQUEST_DEADLINE", "20")),
+}
+# Optional Gemini stages (group titles, enrichment, swap-deck descriptions) are
+# skipped in favour of cached or default text when less than this is left
+OPTIONAL_STAGE_MIN = float(os.getenv("DEADLINE_OPTIONAL_STAGE_MIN", "1.5"))
+# Time kept back for the Qloo calls that follow a wait on another stage
+QLOO_RESERVE = float(os.getenv("DEADLINE_QLOO_RESERVE", "1.0"))
+
+# A fallback within this long of the deadline is put down to the deadline, not an error
+_EXPIRY_SLACK = 0.05
+
+# Deadline of the request being handled in this context, or None outside a
+# request. Like the trace, executor work only sees it via submit_in_context().
+_current_deadline = contextvars.ContextVar("current_deadline", default=None)
+
+
+class DeadlineExceeded(TimeoutError):
+    """The request's time budget ran out before this step could start."""
+
+
+class Deadline:
+    """The time budget of one request, and the parts of its response that were degraded."""
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.expires = time.monotonic() + budget
+        self._degraded = {}
+        self._lock = threading.Lock()
+
+    def remaining(self):
+        return max(self.expires - time.monotonic(), 0.0)
+
+    def expired(self):
+        return time.monotonic() >= self.expires
+
+    def degrade(self, part, reason):
+        with self._lock:
+            self._degraded.setdefault(part, reason)
+
+    def degraded(self):
+        with self._lock:
+            return [{"part": part, "reason": reason} for part, reason in self._degraded.items()]
+
+
+def budget_for(rule):
+    return ROUTE_DEADLINES.get(rule, REQUEST_DEADLINE)
+
+
+def start_deadline(budget):
+    """Begin a deadline for the current request; pass the token to end_deadline()."""
+    deadline = Deadline(budget)
+    return deadline, _current_deadline.set(deadline)
+
+
+def end_deadline(token):
+    _current_deadline.reset(token)
+
+
+def current_deadline():
+    return _current_deadline.get()
+
+
+@contextmanager
+def within(deadline):
+    """Run the enclosed block under an existing deadline, e.g. a response body streamed after its handler returned."""
+    token = _current_deadline.set(deadline)
+    try:
+        yield
+    finally:
+        _current_deadline.reset(token)
+
+
+def shared_deadline(deadlines):
+    """
+    Deadline for work done on behalf of several requests: as long as the latest
+    of theirs, so the one with the least time left doesn't cut it short for the
+    rest. None if any of them has no deadline.
+    """
+    if not deadlines or any(deadline is None for deadline in deadlines):
+        return None
+    return Deadline(max(deadline.remaining() for deadline in deadlines))
+
+
+def time_left(reserve=0.0):
+    """Seconds left in the current request's budget less reserve, or None outside a request."""
+    deadline = _current_deadline.get()
+    if deadline is None:
+        return None
+    return max(deadline.remaining() - reserve, 0.0)
+
+
+def affords(seconds):
+    """True unless the current request has less than `seconds` left."""
+    deadline = _current_deadline.get()
+    return deadline is None or deadline.remaining() >= seconds
+
+
+def expired():
+    deadline = _current_deadline.get()
+    return deadline is not None and deadline.expired()
+
+
+def bounded_timeout(timeout):
+    """
+    A timeout in seconds, or a (connect, read) pair, capped at what is left of
+    the current request's budget. Raises DeadlineExceeded if nothing is left.
+    """
+    left = time_left()
+    if left is None:
+        return timeout
+    if left <= 0:
+        raise DeadlineExceeded("Request deadline passed")
+    if isinstance(timeout, tuple):
+        return tuple(min(part, left) for part in timeout)
+    return left if timeout is None else min(timeout, left)
+
+
+def degrade(part, reason=None):
+    """
+    Note that a part of the current response was skipped or built from cached or
+    default data. Without a reason it is put down to the deadline if that has
+    (about) run out, otherwise to an error. A no-op outside a request.
+    """
+    deadline = _current_deadline.get()
+    if deadline is None:
+        return
+    if reason is None:
+        reason = "deadline" if deadline.remaining() <= _EXPIRY_SLACK else "error"
+    deadline.degrade(part, reason)
+
+
+def degraded_parts():
+    deadline = _current_deadline.get()
+    return deadline.degraded() if deadline is not None else []
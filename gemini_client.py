@@ -0,0 +1,236 @@
+import asyncio
+import copy
+import hashlib
+import json
+import os
+
+from google.api_core import exceptions as google_exceptions
+
+from admission import gemini_scheduler
+from breaker import CircuitBreaker
+from cache import MISSING, ResponseCache
+from cassette import ReplayedError
+from deadline import bounded_timeout
+from singleflight import SingleFlight
+from metrics import count_parse_failure, track_upstream
+from tracing import mark, span
+
+# Every prompt template the app sends to Gemini, with how long a successfully
+# parsed result may be reused. Templates that ask for fresh or random picks on
+# each call are opted out with None and always go to Gemini.
+GEMINI_TEMPLATES = {
+    "single_example": None,
+    "mood_activities": None,
+    "mood_examples_batch": None,
+    "mood_and_genre_examples": None,
+    "genre_examples": None,
+    "community_example": None,
+    "community_examples_batch": None,
+    "journey_cards": None,
+    "friend_examples": None,
+    "contrasting_examples": None,
+    "group_description": 24 * 3600,
+    # Batched group descriptions are cached per group under "group_description"
+    "group_description_batch": None,
+    "item_details": 7 * 24 * 3600,
+    "enrichment": 7 * 24 * 3600,
+    # Batched enrichment is cached per item under "enrichment", not as a whole
+    "enrichment_batch": None,
+    "descriptions_with_categories": 7 * 24 * 3600,
+    # Batched descriptions are cached per request's list under "descriptions_with_categories"
+    "descriptions_with_categories_batch": None,
+}
+
+# Longest a single Gemini call may take; shorter when the request's deadline is nearer
+GEMINI_TIMEOUT = float(os.getenv("GEMINI_TIMEOUT", "30"))
+
+# A Gemini call slower than this counts as slow for the circuit breaker
+GEMINI_SLOW_CALL = float(os.getenv("GEMINI_SLOW_CALL", "15"))
+
+GEMINI_CACHE_MAX_BYTES = int(os.getenv("GEMINI_CACHE_MAX_BYTES", str(16 * 1024 * 1024)))
+
+
+def _normalize_args(value):
+    """Collapse whitespace in strings and order dict keys so equivalent arguments hash the same."""
+    if isinstance(value, str):
+        return " ".join(value.split())
+    if isinstance(value, dict):
+        return {str(k): _normalize_args(v) for k, v in sorted(value.items(), key=lambda kv: str(kv[0]))}
+    if isinstance(value, (list, tuple)):
+        return [_normalize_args(v) for v in value]
+    return value
+
+
+def gemini_cache_key(model_name, template_id, args, generation_config=None):
+    """Content address for a Gemini call: hash of model, template, normalized args and config."""
+    payload = json.dumps(
+        [model_name, template_id, _normalize_args(args), _normalize_args(generation_config or {})],
+        sort_keys=True, separators=(",", ":"), default=str
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def is_gemini_failure(exc):
+    """
+    Whether an exception from a Gemini call counts against its circuit: server
+    errors and timeouts. 429s are left to the admission scheduler's backoff.
+    """
+    return isinstance(exc, (google_exceptions.ServerError, TimeoutError, ConnectionError, ReplayedError))
+
+
+gemini_breaker = CircuitBreaker("gemini", slow_call=GEMINI_SLOW_CALL, is_failure=is_gemini_failure)
+
+
+class GeminiClient:
+    """
+    Single entry point for Gemini calls.
+
+    generate_text() sends a prompt and returns the raw response text.
+    generate_parsed() also parses it, and for templates with a TTL in
+    GEMINI_TEMPLATES reuses earlier parsed results for the same inputs.
+    Concurrent cache misses for the same inputs share a single Gemini call.
+    Every call that does go to Gemini is admitted through the scheduler first,
+    and may take up to GEMINI_TIMEOUT or what is left of the request's deadline.
+    While the breaker is open, calls fail fast with CircuitOpen and expired
+    cache entries are served as the last known good results.
+    """
+
+    def __init__(self, model, max_bytes=GEMINI_CACHE_MAX_BYTES, scheduler=gemini_scheduler, breaker=gemini_breaker):
+        self.model = model
+        self.scheduler = scheduler
+        self.breaker = breaker
+        self.cache = ResponseCache(ttl=24 * 3600, stale_ttl=0, max_bytes=max_bytes)
+        self.flights = SingleFlight("gemini")
+
+    def generate_text(self, template_id, prompt, generation_config=None):
+        if template_id not in GEMINI_TEMPLATES:
+            raise KeyError(f"Unknown Gemini template '{template_id}'")
+
+        def call():
+            request_options = {"timeout": bounded_timeout(GEMINI_TIMEOUT)}
+            # Time spent queued for admission is not upstream latency
+            with self.breaker.guard(), span("gemini", template_id), track_upstream("gemini", template_id):
+                if generation_config is None:
+                    return self.model.generate_content(prompt, request_options=request_options).text
+                return self.model.generate_content(
+                    prompt, generation_config=generation_config, request_options=request_options
+                ).text
+
+        # Fail fast rather than queue for admission while the circuit is open
+        self.breaker.check()
+        return self.scheduler.call(call)
+
+    async def generate_text_async(self, template_id, prompt, generation_config=None):
+        if template_id not in GEMINI_TEMPLATES:
+            raise KeyError(f"Unknown Gemini template '{template_id}'")
+
+        async def call():
+            timeout = bounded_timeout(GEMINI_TIMEOUT)
+            request_options = {"timeout": timeout}
+            with self.breaker.guard(), span("gemini", template_id), track_upstream("gemini", template_id):
+                if generation_config is None:
+                    generation = self.model.generate_content_async(prompt, request_options=request_options)
+                else:
+                    generation = self.model.generate_content_async(
+                        prompt, generation_config=generation_config, request_options=request_options
+                    )
+                response = await asyncio.wait_for(generation, timeout)
+                return response.text
+
+        self.breaker.check()
+        return await self.scheduler.call_async(call)
+
+    def generate_parsed(self, template_id, prompt, parse, cache_args=None, generation_config=None):
+        """
+        Return parse(response_text). parse() should raise on malformed output;
+        only results it accepts are cached. cache_args identifies the inputs the
+        prompt was built from.
+        """
+        if GEMINI_TEMPLATES.get(template_id) is None or cache_args is None:
+            text = self.generate_text(template_id, prompt, generation_config)
+            return self._parse(template_id, parse, text)
+
+        cached = self.get_cached(template_id, cache_args, generation_config)
+        if cached is not MISSING:
+            return cached
+
+        def call():
+            text = self.generate_text(template_id, prompt, generation_config)
+            result = self._parse(template_id, parse, text)
+            self.store(template_id, cache_args, result, generation_config)
+            return result
+
+        # Callers that joined an in-flight call share its result, so hand each its own copy
+        return copy.deepcopy(self.flights.do(self._key(template_id, cache_args, generation_config), call))
+
+    async def generate_parsed_async(self, template_id, prompt, parse, cache_args=None, generation_config=None):
+        """asyncio counterpart of generate_parsed(), sharing the same cache."""
+        if GEMINI_TEMPLATES.get(template_id) is None or cache_args is None:
+            text = await self.generate_text_async(template_id, prompt, generation_config)
+            return self._parse(template_id, parse, text)
+
+        cached = self.get_cached(template_id, cache_args, generation_config)
+        if cached is not MISSING:
+            return cached
+
+        async def call():
+            text = await self.generate_text_async(template_id, prompt, generation_config)
+            result = self._parse(template_id, parse, text)
+            self.store(template_id, cache_args, result, generation_config)
+            return result
+
+        key = self._key(template_id, cache_args, generation_config)
+        return copy.deepcopy(await self.flights.do_async(key, call))
+
+    @staticmethod
+    def _parse(template_id, parse, text):
+        with span("parse", template_id):
+            try:
+                return parse(text)
+            except Exception:
+                count_parse_failure(template_id)
+                raise
+
+    def _key(self, template_id, cache_args, generation_config=None):
+        return gemini_cache_key(self.model.model_name, template_id, cache_args, generation_config)
+
+    def get_cached(self, template_id, cache_args, generation_config=None):
+        """Return a cached parsed result for these inputs, or MISSING. An expired one will do while the circuit is open."""
+        if GEMINI_TEMPLATES.get(template_id) is None:
+            return MISSING
+
+        key = self._key(template_id, cache_args, generation_config)
+        entry = self.cache.get(key)
+        if entry is MISSING and self.breaker.is_open():
+            value = self.cache.last_good(key)
+            if value is not MISSING:
+                mark("gemini-cache", template_id, result="last_good")
+                return copy.deepcopy(value)
+        if entry is MISSING:
+            self.cache.count("misses")
+            mark("gemini-cache", template_id, result="miss")
+            return MISSING
+
+        self.cache.count("hits")
+        mark("gemini-cache", template_id, result="hit")
+        return copy.deepcopy(entry[0])
+
+    def store(self, template_id, cache_args, result, generation_config=None):
+        """Cache an already validated result, e.g. one item taken from a batched response."""
+        ttl = GEMINI_TEMPLATES.get(template_id)
+        if ttl is None:
+            return
+
+        self.cache.set(self._key(template_id, cache_args, generation_config), copy.deepcopy(result), ttl=ttl)
+
+    def get_stats(self):
+        return self.cache.get_stats()
+
+    def get_flight_stats(self):
+        return self.flights.get_stats()
+
+    def get_admission_stats(self):
+        return self.scheduler.get_stats()
+
+    def get_breaker_stats(self):
+        return self.breaker.get_stats()
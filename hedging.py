@@ -0,0 +1,153 @@
+import asyncio
+import math
+import threading
+
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from deadline import expired
+from metrics import hedged_requests
+from tracing import submit_in_context
+
+
+class Hedger:
+    """
+    Hedged calls for tail latency.
+
+    call(operation, attempt) runs attempt(False). If it hasn't finished by the
+    `percentile` of recent latencies for that operation, attempt(True) is started
+    alongside it and whichever succeeds first wins; if one fails the other is
+    still waited for. Operations with fewer than min_samples recorded latencies
+    are never hedged.
+
+    Hedges are paid for from a budget: every call earns budget_ratio of a token,
+    up to max_tokens, and every hedge spends one. That caps the extra load at
+    about budget_ratio of calls, even when everything is slow. call_async() is
+    the asyncio counterpart; the loser of an async race is cancelled, while a
+    sync loser runs to completion on the hedging executor.
+    """
+
+    def __init__(self, percentile=95, budget_ratio=0.05, max_tokens=10, min_delay=0.01, min_samples=20,
+                 window=200, max_workers=32):
+        self.percentile = percentile
+        self.budget_ratio = budget_ratio
+        self.max_tokens = max_tokens
+        self.min_delay = min_delay
+        self.min_samples = min_samples
+        self.window = window
+        self.tokens = float(max_tokens)
+        self._latencies = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="qloo-hedge")
+        self.stats = {"calls": 0, "hedged": 0, "hedge_won": 0, "primary_won": 0, "over_budget": 0}
+
+    def observe(self, operation, seconds):
+        """Record the latency of a successful attempt."""
+        with self._lock:
+            samples = self._latencies.get(operation)
+            if samples is None:
+                samples = self._latencies[operation] = deque(maxlen=self.window)
+            samples.append(seconds)
+
+    def delay_for(self, operation):
+        """How long the first attempt gets before a hedge starts, or None while there is too little data."""
+        with self._lock:
+            samples = self._latencies.get(operation)
+            if samples is None or len(samples) < self.min_samples:
+                return None
+            ordered = sorted(samples)
+        index = min(len(ordered) - 1, math.ceil(len(ordered) * self.percentile / 100) - 1)
+        return max(ordered[index], self.min_delay)
+
+    def _start(self, operation):
+        """Count a call and earn budget for it; returns the hedge delay, or None to run the call unhedged."""
+        with self._lock:
+            self.stats["calls"] += 1
+            self.tokens = min(self.max_tokens, self.tokens + self.budget_ratio)
+        return self.delay_for(operation)
+
+    def _spend(self, operation):
+        """Take a token for a hedge. False when the budget is spent or the request's deadline has passed."""
+        if expired():
+            return False
+        with self._lock:
+            if self.tokens < 1:
+                self.stats["over_budget"] += 1
+                allowed = False
+            else:
+                self.tokens -= 1
+                self.stats["hedged"] += 1
+                allowed = True
+        if not allowed:
+            hedged_requests.inc(operation, "over_budget")
+        return allowed
+
+    def _record_winner(self, operation, hedge_won):
+        with self._lock:
+            self.stats["hedge_won" if hedge_won else "primary_won"] += 1
+        hedged_requests.inc(operation, "hedge_won" if hedge_won else "primary_won")
+
+    def call(self, operation, attempt):
+        delay = self._start(operation)
+        if delay is None:
+            return attempt(False)
+
+        primary = submit_in_context(self._executor, attempt, False)
+        wait([primary], timeout=delay)
+        if primary.done() or not self._spend(operation):
+            return primary.result()
+
+        hedge = submit_in_context(self._executor, attempt, True)
+        pending = {primary, hedge}
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    self._record_winner(operation, future is hedge)
+                    return future.result()
+                error = future.exception()
+        raise error
+
+    async def call_async(self, operation, attempt):
+        """asyncio counterpart of call(); attempt(hedge) returns a coroutine."""
+        delay = self._start(operation)
+        if delay is None:
+            return await attempt(False)
+
+        primary = asyncio.ensure_future(attempt(False))
+        hedge = None
+        try:
+            done, _ = await asyncio.wait({primary}, timeout=delay)
+            if done or not self._spend(operation):
+                return await primary
+
+            hedge = asyncio.ensure_future(attempt(True))
+            pending = {primary, hedge}
+            error = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        self._record_winner(operation, task is hedge)
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in (primary, hedge):
+                if task is not None and not task.done():
+                    task.cancel()
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self.stats)
+            stats["tokens"] = round(float(self.tokens), 2)
+            operations = list(self._latencies)
+        stats["hedge_delay_ms"] = {}
+        for operation in operations:
+            delay = self.delay_for(operation)
+            stats["hedge_delay_ms"][operation] = round(delay * 1000, 1) if delay is not None else None
+        hedged = stats["hedge_won"] + stats["primary_won"]
+        stats["hedge_win_ratio"] = round(stats["hedge_won"] / hedged, 4) if hedged else 0.0
+        return stats
+
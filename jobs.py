@@ -0,0 +1,264 @@
+import asyncio
+import contextvars
+import hashlib
+import json
+import os
+import threading
+import time
+import uuid
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from deadline import end_deadline, start_deadline
+from metrics import jobs_total
+
+# Pipelines run as jobs at most JOB_WORKERS at a time per worker process;
+# beyond JOB_QUEUE_MAX queued or running jobs new ones are turned away
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "4"))
+JOB_QUEUE_MAX = int(os.getenv("JOB_QUEUE_MAX", "100"))
+# Time budget for one job, in seconds, and how long its result is kept afterwards
+JOB_DEADLINE = float(os.getenv("JOB_DEADLINE", "60"))
+JOB_RESULT_TTL = float(os.getenv("JOB_RESULT_TTL", "300"))
+# Longest a job's event stream goes without sending anything
+JOB_EVENTS_KEEPALIVE = float(os.getenv("JOB_EVENTS_KEEPALIVE", "15"))
+
+QUEUED = "queued"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+
+
+class JobQueueFull(RuntimeError):
+    """Too many jobs are queued or running to accept another."""
+
+
+def job_key(kind, payload):
+    """Jobs of the same kind with equal JSON payloads share a key, whatever the key order."""
+    body = json.dumps([kind, payload], sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(body.encode("utf-8")).hexdigest()
+
+
+class Job:
+    """
+    One run of a pipeline. `version` goes up on every state change, so a
+    watcher can wait for the next one with wait() or wait_async().
+    """
+
+    def __init__(self, kind, key):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.key = key
+        self.state = QUEUED
+        self.result = None
+        self.error = None
+        self.degraded = []
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.expires_at = None
+        self.version = 0
+        self._cond = threading.Condition()
+        self._async_waiters = []
+
+    @property
+    def finished(self):
+        return self.state in (SUCCEEDED, FAILED)
+
+    def update(self, **fields):
+        with self._cond:
+            for name, value in fields.items():
+                setattr(self, name, value)
+            self.version += 1
+            self._cond.notify_all()
+            waiters, self._async_waiters = self._async_waiters, []
+        for loop, future in waiters:
+            loop.call_soon_threadsafe(_resolve, future)
+
+    def wait(self, seen_version, timeout=None):
+        """Block until the job changes from seen_version (or timeout); returns the current version."""
+        with self._cond:
+            self._cond.wait_for(lambda: self.version != seen_version, timeout)
+            return self.version
+
+    async def wait_async(self, seen_version, timeout=None):
+        loop = asyncio.get_running_loop()
+        with self._cond:
+            if self.version != seen_version:
+                return self.version
+            future = loop.create_future()
+            self._async_waiters.append((loop, future))
+        try:
+            await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            with self._cond:
+                if (loop, future) in self._async_waiters:
+                    self._async_waiters.remove((loop, future))
+        return self.version
+
+    def to_dict(self):
+        with self._cond:
+            job = {
+                "id": self.id,
+                "kind": self.kind,
+                "state": self.state,
+                "created_at": self.created_at,
+                "started_at": self.started_at,
+                "finished_at": self.finished_at,
+                "expires_at": self.expires_at,
+            }
+            if self.state == SUCCEEDED:
+                job["result"] = self.result
+            elif self.state == FAILED:
+                job["error"] = self.error
+            if self.degraded:
+                job["degraded"] = self.degraded
+        return job
+
+
+def _resolve(future):
+    if not future.done():
+        future.set_result(None)
+
+
+class JobQueue:
+    """
+    Runs heavy pipelines off the request path.
+
+    submit(kind, payload, fn) returns (job, created) at once and runs
+    fn(payload) on a small thread pool; submit_async() does the same for a
+    coroutine function, as a task on the running event loop. A job with the
+    same kind and payload as one that is queued, running or finished within
+    result_ttl is not run again: the existing job is returned instead. Failed
+    jobs are not reused. Each job gets its own deadline, since it outlives the
+    request that submitted it, and finished jobs are dropped once their
+    result_ttl is up.
+    """
+
+    def __init__(self, workers=JOB_WORKERS, max_pending=JOB_QUEUE_MAX, deadline=JOB_DEADLINE,
+                 result_ttl=JOB_RESULT_TTL):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.deadline = deadline
+        self.result_ttl = result_ttl
+        self._jobs = OrderedDict()
+        self._by_key = {}
+        self._pending = 0
+        self._lock = threading.Lock()
+        self._executor = None
+        self._semaphore = None
+        self._loop = None
+        self._tasks = set()
+        self.stats = {"submitted": 0, "deduplicated": 0, "rejected": 0, "succeeded": 0, "failed": 0, "expired": 0}
+
+    def _prune(self, now):
+        """Drop finished jobs whose results have expired (call with the lock held)."""
+        for job_id in [job_id for job_id, job in self._jobs.items() if job.expires_at and job.expires_at <= now]:
+            job = self._jobs.pop(job_id)
+            if self._by_key.get(job.key) is job:
+                del self._by_key[job.key]
+            self.stats["expired"] += 1
+
+    def _create(self, kind, payload):
+        """Return (job, created): an existing job for the same inputs, or a new queued one."""
+        key = job_key(kind, payload)
+        with self._lock:
+            self._prune(time.time())
+            job = self._by_key.get(key)
+            if job is not None:
+                self.stats["deduplicated"] += 1
+                outcome = "deduplicated"
+            elif self._pending >= self.max_pending:
+                self.stats["rejected"] += 1
+                outcome = "rejected"
+            else:
+                job = Job(kind, key)
+                self._jobs[job.id] = job
+                self._by_key[key] = job
+                self._pending += 1
+                self.stats["submitted"] += 1
+                outcome = "submitted"
+        jobs_total.inc(kind, outcome)
+        if outcome == "rejected":
+            raise JobQueueFull(f"{self.max_pending} jobs already queued or running")
+        return job, outcome == "submitted"
+
+    def submit(self, kind, payload, fn):
+        job, created = self._create(kind, payload)
+        if created:
+            if self._executor is None:
+                with self._lock:
+                    if self._executor is None:
+                        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="job")
+            # Not submit_in_context(): the job outlives the request, so it runs without its trace or deadline
+            self._executor.submit(self._run, job, fn, payload)
+        return job, created
+
+    async def submit_async(self, kind, payload, fn):
+        """asyncio counterpart of submit(); fn is a coroutine function."""
+        job, created = self._create(kind, payload)
+        if created:
+            loop = asyncio.get_running_loop()
+            if self._semaphore is None or self._loop is not loop:
+                self._semaphore = asyncio.Semaphore(self.workers)
+                self._loop = loop
+            task = loop.create_task(self._run_async(job, fn, payload), context=contextvars.Context())
+            # The loop only keeps weak references to tasks
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        return job, created
+
+    def _run(self, job, fn, payload):
+        deadline, token = start_deadline(self.deadline)
+        job.update(state=RUNNING, started_at=time.time())
+        try:
+            result = fn(payload)
+        except Exception as e:
+            print(f"[WARN] {job.kind} job {job.id} failed: {e}")
+            self._finish(job, FAILED, error=str(e), degraded=deadline.degraded())
+        else:
+            self._finish(job, SUCCEEDED, result=result, degraded=deadline.degraded())
+        finally:
+            end_deadline(token)
+
+    async def _run_async(self, job, fn, payload):
+        async with self._semaphore:
+            deadline, token = start_deadline(self.deadline)
+            job.update(state=RUNNING, started_at=time.time())
+            try:
+                result = await fn(payload)
+            except Exception as e:
+                print(f"[WARN] {job.kind} job {job.id} failed: {e}")
+                self._finish(job, FAILED, error=str(e), degraded=deadline.degraded())
+            else:
+                self._finish(job, SUCCEEDED, result=result, degraded=deadline.degraded())
+            finally:
+                end_deadline(token)
+
+    def _finish(self, job, state, **fields):
+        now = time.time()
+        with self._lock:
+            self._pending -= 1
+            self.stats[state] += 1
+            if state == FAILED and self._by_key.get(job.key) is job:
+                # Let the next identical submission try again
+                del self._by_key[job.key]
+        job.update(state=state, finished_at=now, expires_at=now + self.result_ttl, **fields)
+        jobs_total.inc(job.kind, state)
+
+    def get(self, job_id):
+        """Return the job, or None if it is unknown or its result has expired."""
+        with self._lock:
+            self._prune(time.time())
+            return self._jobs.get(job_id)
+
+    def get_stats(self):
+        with self._lock:
+            self._prune(time.time())
+            stats = dict(self.stats)
+            stats["pending"] = self._pending
+            stats["stored"] = len(self._jobs)
+        return stats
+
+
+job_queue = JobQueue()
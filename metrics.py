@@ -0,0 +1,213 @@
+import functools
+import threading
+import time
+
+from contextlib import contextmanager
+
+from deadline import degrade
+
+# Latency buckets in seconds, from cache-speed to slow Gemini generations
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values)) + list(extra or [])
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    type_name = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if len(labels) != len(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {labels}")
+        return tuple(str(label) for label in labels)
+
+    def expose(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type_name}"]
+        with self._lock:
+            items = sorted(self._values.items())
+            lines.extend(self._sample_lines(items))
+        return lines
+
+    def _sample_lines(self, items):
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}" for key, value in items]
+
+
+class Counter(_Metric):
+    type_name = "counter"
+
+    def inc(self, *labels, amount=1):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    type_name = "gauge"
+
+    def inc(self, *labels, amount=1):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+
+    def set(self, *labels, value):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(_Metric):
+    """Cumulative-bucket histogram; each labelled series stores per-bucket counts, sum and count."""
+
+    type_name = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, seconds, *labels):
+        key = self._key(labels)
+        index = len(self.buckets)
+        for i, bound in enumerate(self.buckets):
+            if seconds <= bound:
+                index = i
+                break
+
+        with self._lock:
+            series = self._values.get(key)
+            if series is None:
+                series = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += seconds
+            series[2] += 1
+
+    def _sample_lines(self, items):
+        lines = []
+        for key, (bucket_counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), bucket_counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.labelnames, key, [("le", _format_value(float(bound)))])
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+http_request_duration = Histogram(
+    "taste_http_request_duration_seconds", "Time to build a response, by route.", ("endpoint", "method", "status")
+)
+upstream_duration = Histogram(
+    "taste_upstream_request_duration_seconds",
+    "Latency of upstream calls. Operation is the Qloo endpoint or the Gemini prompt template.",
+    ("upstream", "operation")
+)
+upstream_errors = Counter(
+    "taste_upstream_errors_total", "Upstream calls that raised or returned an error status.", ("upstream", "operation")
+)
+upstream_in_flight = Gauge("taste_upstream_in_flight", "Upstream calls currently in progress.", ("upstream",))
+parse_failures = Counter(
+    "taste_parse_failures_total", "Upstream responses that could not be parsed into the expected shape.", ("parser",)
+)
+fallback_responses = Counter(
+    "taste_fallback_responses_total", "Responses built from a canned fallback instead of generated content.", ("kind",)
+)
+gemini_admission_shed = Counter(
+    "taste_gemini_admission_shed_total", "Gemini calls rejected before being sent, to stay within quota.",
+    ("priority", "reason")
+)
+gemini_throttled = Counter("taste_gemini_throttled_total", "Gemini calls answered with 429 Too Many Requests.")
+hedged_requests = Counter(
+    "taste_qloo_hedges_total",
+    "Slow Qloo calls that were hedged, by which attempt answered first, or skipped as over budget.",
+    ("operation", "outcome")
+)
+circuit_state = Gauge(
+    "taste_circuit_state", "Circuit breaker state per upstream: 0 closed, 1 half-open, 2 open.", ("upstream",)
+)
+circuit_rejected = Counter(
+    "taste_circuit_rejected_total", "Upstream calls failed fast because the circuit was open.", ("upstream",)
+)
+jobs_total = Counter(
+    "taste_jobs_total", "Background jobs by kind and outcome: submitted, deduplicated, rejected, succeeded or failed.",
+    ("kind", "outcome")
+)
+
+REGISTRY = [
+    http_request_duration, upstream_duration, upstream_errors, upstream_in_flight, parse_failures, fallback_responses,
+    gemini_admission_shed, gemini_throttled, hedged_requests, circuit_state, circuit_rejected, jobs_total
+]
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+@contextmanager
+def track_upstream(upstream, operation):
+    """Record latency, errors and in-flight count for one upstream call."""
+    upstream_in_flight.inc(upstream)
+    start = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        upstream_errors.inc(upstream, operation)
+        raise
+    finally:
+        upstream_duration.observe(time.perf_counter() - start, upstream, operation)
+        upstream_in_flight.dec(upstream)
+
+
+def count_fallback(kind):
+    """Count a canned fallback, and mark that part of the current response as degraded."""
+    fallback_responses.inc(kind)
+    degrade(kind)
+
+
+def count_parse_failure(parser):
+    parse_failures.inc(parser)
+
+
+def counts_parse_failures(fn):
+    """Decorator for parse_* functions: count exceptions under the parser's name and re-raise."""
+    parser = fn.__name__.replace("parse_", "", 1)
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        try:
+            return fn(*args, **kwargs)
+        except Exception:
+            count_parse_failure(parser)
+            raise
+    return wrapper
+
+
+def render_metrics():
+    """All registered metrics in the Prometheus text exposition format."""
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.expose())
+    return "\n".join(lines) + "\n"
+
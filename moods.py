@@ -0,0 +1,145 @@
+import re
+
+# Mood clusters the daily flow knows about: the words that point to each one and
+# the activity types that suit it. Activity names match the keys of
+# ENTITY_TYPE_MAP in recommendation.py.
+MOOD_CLUSTERS = {
+    "happy": {
+        "keywords": [
+            "happy", "joy", "joyful", "cheerful", "glad", "great", "good", "excited", "upbeat", "energetic",
+            "pumped", "hyped", "ecstatic", "elated", "fun", "playful", "silly", "optimistic", "grateful", "amazing",
+        ],
+        "activities": ["music", "movies", "videogame", "tv_show"],
+    },
+    "calm": {
+        "keywords": [
+            "calm", "relax", "relaxed", "chill", "peaceful", "serene", "mellow", "content", "cozy", "cosy", "lazy",
+            "tranquil", "zen", "easygoing", "comfortable", "rested",
+        ],
+        "activities": ["books", "music", "podcast", "travel"],
+    },
+    "sad": {
+        "keywords": [
+            "sad", "down", "blue", "depressed", "unhappy", "gloomy", "heartbroken", "lonely", "melancholy",
+            "melancholic", "miserable", "upset", "crying", "grieving", "hurt", "low", "empty", "nostalgic",
+        ],
+        "activities": ["movies", "music", "books", "tv_show"],
+    },
+    "stressed": {
+        "keywords": [
+            "stressed", "stress", "anxious", "nervous", "worry", "worried", "overwhelmed", "tense", "panicked", "restless",
+            "frazzled", "burnt", "burned", "burnout", "pressured", "uneasy", "scared", "afraid",
+        ],
+        "activities": ["music", "podcast", "books", "travel"],
+    },
+    "angry": {
+        "keywords": [
+            "angry", "mad", "furious", "annoyed", "irritated", "frustrated", "pissed", "rage", "grumpy",
+            "bitter",
+        ],
+        "activities": ["videogame", "music", "movies"],
+    },
+    "tired": {
+        "keywords": [
+            "tired", "exhausted", "sleepy", "drained", "fatigued", "worn", "weary", "bored", "meh", "sluggish",
+        ],
+        "activities": ["tv_show", "podcast", "music", "movies"],
+    },
+    "romantic": {
+        "keywords": [
+            "romantic", "love", "loved", "loving", "inlove", "affectionate", "flirty", "passionate", "dreamy",
+            "crush",
+        ],
+        "activities": ["movies", "music", "books", "travel"],
+    },
+    "adventurous": {
+        "keywords": [
+            "adventurous", "curious", "bold", "brave", "wanderlust", "inspired", "creative", "motivated",
+            "ambitious", "determined", "focused", "productive", "confident",
+        ],
+        "activities": ["travel", "podcast", "books", "videogame"],
+    },
+}
+
+# Words that flip the meaning of a mood word up to NEGATION_WINDOW words after
+# them ("not happy", "not feeling happy")
+NEGATIONS = {"not", "no", "never", "hardly", "barely", "isnt", "dont", "didnt", "cant", "aint"}
+NEGATION_WINDOW = 2
+NEGATED_CLUSTERS = {"happy": "sad", "calm": "stressed", "sad": "happy", "stressed": "calm", "tired": "happy"}
+
+# Multi-word expressions, matched before the single words in them: the cluster
+# each points to, or None where its words would otherwise read as a mood
+# ("down to earth" is not sad)
+PHRASES = {
+    ("down", "to", "earth"): None,
+    ("down", "for"): None,
+    ("fed", "up"): "angry",
+    ("on", "edge"): "stressed",
+    ("under", "the", "weather"): "tired",
+}
+_LONGEST_PHRASE = max(len(phrase) for phrase in PHRASES)
+
+_KEYWORD_INDEX = {
+    keyword: cluster for cluster, spec in MOOD_CLUSTERS.items() for keyword in spec["keywords"]
+}
+
+
+def _tokens(text):
+    return re.findall(r"[a-z]+", str(text).lower().replace("'", ""))
+
+
+def _lookup(token):
+    """Match a token against the lexicon, allowing common suffixes ("sadder", "relaxing")."""
+    if token in _KEYWORD_INDEX:
+        return _KEYWORD_INDEX[token]
+    for suffix in ("ness", "ing", "est", "ish", "er", "ed", "ly", "s"):
+        if token.endswith(suffix) and len(token) - len(suffix) >= 3:
+            stem = token[:-len(suffix)]
+            # "sadder" -> "sadd" -> "sad", "happiest" -> "happi" -> "happy"
+            candidates = [stem, stem[:-1] if stem[-1] == stem[-2] else None, stem[:-1] + "y" if stem[-1] == "i" else None]
+            for candidate in candidates:
+                if candidate in _KEYWORD_INDEX:
+                    return _KEYWORD_INDEX[candidate]
+    return None
+
+
+def _phrase_at(tokens, i):
+    """Return (length, cluster) for the longest phrase starting at tokens[i], or (0, None)."""
+    for length in range(min(_LONGEST_PHRASE, len(tokens) - i), 1, -1):
+        phrase = tuple(tokens[i:i + length])
+        if phrase in PHRASES:
+            return length, PHRASES[phrase]
+    return 0, None
+
+
+def classify_mood(mood):
+    """
+    Map a free-text mood to a key of MOOD_CLUSTERS by counting lexicon hits
+    (phrases first, then single words), or return None when no known mood word
+    appears.
+    """
+    scores = {}
+    tokens = _tokens(mood)
+    i = 0
+    while i < len(tokens):
+        length, cluster = _phrase_at(tokens, i)
+        if not length:
+            length, cluster = 1, _lookup(tokens[i])
+        negated = any(token in NEGATIONS for token in tokens[max(i - NEGATION_WINDOW, 0):i])
+        i += length
+        if cluster is None:
+            continue
+        if negated:
+            cluster = NEGATED_CLUSTERS.get(cluster)
+            if cluster is None:
+                continue
+        scores[cluster] = scores.get(cluster, 0) + 1
+
+    if not scores:
+        return None
+    # Ties go to the cluster listed first in MOOD_CLUSTERS
+    return max(MOOD_CLUSTERS, key=lambda cluster: scores.get(cluster, 0))
+
+
+def activities_for_mood(cluster):
+    return list(MOOD_CLUSTERS[cluster]["activities"])
@@ -0,0 +1,254 @@
+import asyncio
+import contextvars
+import queue
+import random
+import threading
+import time
+
+from collections import OrderedDict, deque
+
+from admission import PRIORITY_BACKGROUND, priority
+from tracing import mark
+
+
+class CandidatePool:
+    """
+    Over-fetches a page of candidates once per key and hands out non-repeating
+    slices of it on later calls.
+
+    `fetch_page(key)` must return a list. When a pool is used up (or older than
+    `ttl`) it keeps serving from the start of the old page while one background
+    refill replaces it.
+    """
+
+    def __init__(self, fetch_page, max_keys=2000, ttl=3600, fetch_page_async=None):
+        self.fetch_page = fetch_page
+        self.fetch_page_async = fetch_page_async
+        self.max_keys = max_keys
+        self.ttl = ttl
+        self._pools = OrderedDict()
+        self._refilling = set()
+        self._lock = threading.Lock()
+        self.stats = {"served": 0, "page_fetches": 0, "refills": 0}
+
+    def _get_pool(self, key):
+        with self._lock:
+            pool = self._pools.get(key)
+            if pool is not None:
+                self._pools.move_to_end(key)
+            return pool
+
+    def _new_pool(self, key, items):
+        with self._lock:
+            self.stats["page_fetches"] += 1
+        if not items:
+            return None
+        pool = {"items": items, "cursor": 0, "fetched_at": time.time()}
+        self._store(key, pool)
+        return pool
+
+    def _slice(self, key, pool, n):
+        """Return (batch, start_refill) and advance the pool cursor."""
+        with self._lock:
+            items = pool["items"]
+            start = pool["cursor"]
+            # Wrap around once the page is used up so callers always get n items
+            batch = [items[(start + i) % len(items)] for i in range(min(n, len(items)))]
+            pool["cursor"] = start + len(batch)
+
+            exhausted = pool["cursor"] + n > len(items)
+            expired = time.time() - pool["fetched_at"] > self.ttl
+            start_refill = (exhausted or expired) and key not in self._refilling
+            if start_refill:
+                self._refilling.add(key)
+            self.stats["served"] += 1
+
+        return [dict(item) if isinstance(item, dict) else item for item in batch], start_refill
+
+    def take(self, key, n):
+        pool = self._get_pool(key)
+        mark("candidate-pool", result="hit" if pool is not None else "miss")
+        if pool is None:
+            pool = self._new_pool(key, self.fetch_page(key))
+            if pool is None:
+                return []
+
+        batch, start_refill = self._slice(key, pool, n)
+        if start_refill:
+            threading.Thread(target=self._refill, args=(key,), daemon=True).start()
+        return batch
+
+    async def take_async(self, key, n):
+        """asyncio counterpart of take(); uses fetch_page_async and refills on the event loop."""
+        pool = self._get_pool(key)
+        mark("candidate-pool", result="hit" if pool is not None else "miss")
+        if pool is None:
+            pool = self._new_pool(key, await self.fetch_page_async(key))
+            if pool is None:
+                return []
+
+        batch, start_refill = self._slice(key, pool, n)
+        if start_refill:
+            # Outlives the request, so it runs without the request's trace or deadline
+            asyncio.get_running_loop().create_task(self._refill_async(key), context=contextvars.Context())
+        return batch
+
+    def _store(self, key, pool):
+        with self._lock:
+            self._pools[key] = pool
+            self._pools.move_to_end(key)
+            while len(self._pools) > self.max_keys:
+                self._pools.popitem(last=False)
+
+    def _replace_pool(self, key, items):
+        if items:
+            # Re-fetched pages usually come back in the same ranked order, so
+            # shuffle them to keep the next round of slices varied
+            items = list(items)
+            random.shuffle(items)
+            self._store(key, {"items": items, "cursor": 0, "fetched_at": time.time()})
+            with self._lock:
+                self.stats["refills"] += 1
+
+    def _refill(self, key):
+        try:
+            self._replace_pool(key, self.fetch_page(key))
+        except Exception as e:
+            print(f"[WARN] Candidate pool refill failed for {key}: {e}")
+        finally:
+            with self._lock:
+                self._refilling.discard(key)
+
+    async def _refill_async(self, key):
+        try:
+            self._replace_pool(key, await self.fetch_page_async(key))
+        except Exception as e:
+            print(f"[WARN] Candidate pool refill failed for {key}: {e}")
+        finally:
+            with self._lock:
+                self._refilling.discard(key)
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self.stats)
+            stats["pools"] = len(self._pools)
+        return stats
+
+
+class ExamplePool:
+    """
+    Per-key queues of pre-generated items, topped up by a few background workers.
+
+    `generate(key)` must return a list of new items. pop(key) hands out the item
+    at the front of the queue and never blocks: it returns None when the queue
+    is empty, so the caller can fall back to generating inline. Each item is
+    served up to `max_uses` times, rotating to the back of the queue in between,
+    and is then retired. Whenever a queue holds fewer than `low_water` items the
+    key is refilled in the background until it is back above the mark. Keys are
+    created on first use, or up front with warm(), and the least recently used
+    ones are dropped beyond `max_keys`. Up to `workers` keys are refilled at
+    once, so warming many keys doesn't leave the last ones empty for long.
+    """
+
+    def __init__(self, generate, low_water=3, max_uses=1, max_keys=500, workers=4):
+        self.generate = generate
+        self.low_water = low_water
+        self.max_uses = max_uses
+        self.max_keys = max_keys
+        self.workers = workers
+        self._queues = OrderedDict()
+        self._pending = set()
+        self._refill_queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._workers = []
+        self.stats = {"hits": 0, "misses": 0, "refills": 0, "refill_errors": 0, "generated": 0, "retired": 0}
+
+    def _queue_for(self, key):
+        """Return the queue for key, creating it if needed. Caller holds the lock."""
+        entries = self._queues.get(key)
+        if entries is None:
+            entries = self._queues[key] = deque()
+            while len(self._queues) > self.max_keys:
+                self._queues.popitem(last=False)
+        self._queues.move_to_end(key)
+        return entries
+
+    def pop(self, key):
+        with self._lock:
+            entries = self._queue_for(key)
+            item = None
+            if entries:
+                entry = entries.popleft()
+                item = entry[0]
+                entry[1] += 1
+                if entry[1] < self.max_uses:
+                    entries.append(entry)
+                else:
+                    self.stats["retired"] += 1
+            self.stats["hits" if item is not None else "misses"] += 1
+            needs_refill = len(entries) < self.low_water
+
+        if needs_refill:
+            self.request_refill(key)
+        return item
+
+    def add(self, key, item, uses=0):
+        """Put an item generated outside the pool (e.g. on a miss) into rotation."""
+        with self._lock:
+            if uses < self.max_uses:
+                self._queue_for(key).append([item, uses])
+
+    def warm(self, keys):
+        """Create the queues for keys and fill them in the background, ahead of their first request."""
+        for key in keys:
+            with self._lock:
+                self._queue_for(key)
+            self.request_refill(key)
+
+    def request_refill(self, key):
+        """Queue a background top-up for key, unless one is already pending."""
+        with self._lock:
+            if key in self._pending:
+                return
+            self._pending.add(key)
+            self._workers = [worker for worker in self._workers if worker.is_alive()]
+            # One more worker per queued key, up to the limit
+            if len(self._workers) < min(self.workers, len(self._pending)):
+                worker = threading.Thread(target=self._run, name="example-pool", daemon=True)
+                worker.start()
+                self._workers.append(worker)
+        self._refill_queue.put(key)
+
+    def _run(self):
+        while True:
+            key = self._refill_queue.get()
+            refill_again = False
+            try:
+                # Refills are background work; requests waiting on Gemini go first
+                with priority(PRIORITY_BACKGROUND):
+                    items = self.generate(key)
+                with self._lock:
+                    entries = self._queues.get(key)
+                    if entries is not None:
+                        entries.extend([item, 0] for item in items)
+                        refill_again = bool(items) and len(entries) < self.low_water
+                    self.stats["refills"] += 1
+                    self.stats["generated"] += len(items)
+            except Exception as e:
+                print(f"[WARN] Example pool refill failed for {key}: {e}")
+                with self._lock:
+                    self.stats["refill_errors"] += 1
+            finally:
+                with self._lock:
+                    self._pending.discard(key)
+            if refill_again:
+                self.request_refill(key)
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self.stats)
+            stats["keys"] = len(self._queues)
+            stats["queued_items"] = sum(len(entries) for entries in self._queues.values())
+            stats["pending_refills"] = len(self._pending)
+            stats["workers"] = len(self._workers)
+        return stats
@@ -0,0 +1,257 @@
+import asyncio
+import os
+import random
+import time
+import httpx
+import requests
+
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from breaker import CircuitBreaker
+from cassette import AsyncCassetteTransport, CassetteAdapter, cassette
+from deadline import affords, bounded_timeout, expired
+from hedging import Hedger
+from metrics import track_upstream
+from tracing import span
+
+QLOO_API_KEY = os.getenv("QLOO_API_KEY")
+
+QLOO_BASE_URL = os.getenv("QLOO_BASE_URL", "https://hackathon.api.qloo.com")
+
+# One pool per worker process. Size it to at least the number of threads that
+# can talk to Qloo at once, otherwise urllib3 discards the extra connections.
+QLOO_POOL_SIZE = int(os.getenv("QLOO_POOL_SIZE", "16"))
+QLOO_CONNECT_TIMEOUT = float(os.getenv("QLOO_CONNECT_TIMEOUT", "3.05"))
+QLOO_READ_TIMEOUT = float(os.getenv("QLOO_READ_TIMEOUT", "10"))
+QLOO_MAX_RETRIES = int(os.getenv("QLOO_MAX_RETRIES", "2"))
+
+# Hedging is opt-in: QLOO_HEDGE=1 sends a second, identical request when the
+# first is slower than QLOO_HEDGE_PERCENTILE of recent calls to the same
+# endpoint. QLOO_HEDGE_BUDGET caps hedges as a fraction of all calls.
+QLOO_HEDGE = os.getenv("QLOO_HEDGE", "0") == "1"
+QLOO_HEDGE_PERCENTILE = float(os.getenv("QLOO_HEDGE_PERCENTILE", "95"))
+QLOO_HEDGE_BUDGET = float(os.getenv("QLOO_HEDGE_BUDGET", "0.05"))
+QLOO_HEDGE_MIN_DELAY = float(os.getenv("QLOO_HEDGE_MIN_DELAY_MS", "10")) / 1000
+
+# A Qloo call slower than this counts as slow for the circuit breaker
+QLOO_SLOW_CALL = float(os.getenv("QLOO_SLOW_CALL", "3"))
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+RETRY_BACKOFF_FACTOR = 0.25
+RETRY_BACKOFF_JITTER = 0.25
+
+
+class DeadlineRetry(Retry):
+    """Retry policy that gives up once the current request's deadline has passed."""
+
+    def is_exhausted(self):
+        return super().is_exhausted() or expired()
+
+
+def is_qloo_failure(exc):
+    """Whether an exception from a Qloo call counts against its circuit: transport errors, 5xx, 429 and bad JSON."""
+    if isinstance(exc, (requests.HTTPError, httpx.HTTPStatusError)) and exc.response is not None:
+        status = exc.response.status_code
+        return status >= 500 or status == 429
+    return isinstance(exc, (requests.RequestException, httpx.HTTPError, ValueError))
+
+
+def operation_name(path):
+    """Metric and span label for a Qloo endpoint: /search -> search, /v2/insights -> insights."""
+    return path.rstrip("/").rsplit("/", 1)[-1]
+
+
+class QlooClient:
+    """
+    Shared Qloo HTTP client.
+
+    Keeps a keep-alive connection pool to QLOO_BASE_URL so repeated /search and
+    /v2/insights calls skip the TCP and TLS handshake, applies the same timeout to
+    every call and retries idempotent GETs a bounded number of times with jittered
+    exponential backoff. Inside a request, timeouts are capped at what is left of
+    its deadline and no retry starts after it has passed. With a hedger, slow
+    calls are raced against a second identical request. While the breaker is
+    open, calls fail fast with CircuitOpen.
+    """
+
+    def __init__(self, base_url=QLOO_BASE_URL, api_key=QLOO_API_KEY, pool_size=QLOO_POOL_SIZE,
+                 timeout=(QLOO_CONNECT_TIMEOUT, QLOO_READ_TIMEOUT), max_retries=QLOO_MAX_RETRIES, hedger=None, breaker=None):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self.hedger = hedger
+        self.breaker = breaker or CircuitBreaker("qloo", slow_call=QLOO_SLOW_CALL, is_failure=is_qloo_failure)
+
+        retry = DeadlineRetry(
+            total=max_retries,
+            backoff_factor=RETRY_BACKOFF_FACTOR,
+            backoff_jitter=RETRY_BACKOFF_JITTER,
+            status_forcelist=RETRY_STATUSES,
+            allowed_methods=frozenset(["GET"]),
+            respect_retry_after_header=True,
+            raise_on_status=False
+        )
+        if cassette is not None:
+            adapter = CassetteAdapter(cassette, pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+        else:
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+
+        self.session = requests.Session()
+        self.session.headers.update({"x-api-key": api_key or ""})
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def get(self, path, params, timeout=None):
+        """GET a Qloo endpoint and return the decoded JSON body."""
+        operation = operation_name(path)
+        with self.breaker.guard():
+            if self.hedger is None:
+                return self._get(path, params, timeout)
+            return self.hedger.call(operation, lambda hedge: self._get(path, params, timeout, hedge))
+
+    def _get(self, path, params, timeout=None, hedge=False):
+        operation = operation_name(path)
+        # Out of time is our own doing, not an upstream error: raise before the call is tracked
+        request_timeout = bounded_timeout(timeout or self.timeout)
+        with span(f"qloo-{operation}", "hedge" if hedge else None) as attrs, track_upstream("qloo", operation):
+            start = time.perf_counter()
+            response = self.session.get(
+                f"{self.base_url}{path}",
+                params=params,
+                timeout=request_timeout
+            )
+            attrs["status"] = response.status_code
+            response.raise_for_status()
+            body = response.json()
+        if self.hedger is not None:
+            self.hedger.observe(operation, time.perf_counter() - start)
+        return body
+
+    def search(self, query, entity_type, limit=1):
+        return self.get("/search", {
+            "query": query,
+            "filter.type": entity_type,
+            "limit": limit
+        })
+
+    def insights(self, params):
+        return self.get("/v2/insights", params)
+
+
+class AsyncQlooClient:
+    """
+    asyncio counterpart of QlooClient built on httpx.AsyncClient, with the same
+    pool size, timeouts, retry policy, hedging and circuit breaker. The underlying client is
+    created on first use so it binds to the running event loop.
+    """
+
+    def __init__(self, base_url=QLOO_BASE_URL, api_key=QLOO_API_KEY, pool_size=QLOO_POOL_SIZE,
+                 timeout=(QLOO_CONNECT_TIMEOUT, QLOO_READ_TIMEOUT), max_retries=QLOO_MAX_RETRIES, hedger=None, breaker=None):
+        self.base_url = base_url.rstrip("/")
+        self.hedger = hedger
+        self.breaker = breaker or CircuitBreaker("qloo", slow_call=QLOO_SLOW_CALL, is_failure=is_qloo_failure)
+        self.api_key = api_key
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self._client = None
+        self._loop = None
+
+    def _get_client(self):
+        loop = asyncio.get_running_loop()
+        if self._client is None or self._loop is not loop:
+            connect_timeout, read_timeout = self.timeout
+            limits = httpx.Limits(max_connections=self.pool_size, max_keepalive_connections=self.pool_size)
+            transport = None
+            if cassette is not None:
+                transport = AsyncCassetteTransport(cassette, httpx.AsyncHTTPTransport(limits=limits))
+            self._client = httpx.AsyncClient(
+                base_url=self.base_url,
+                headers={"x-api-key": self.api_key or ""},
+                timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+                limits=limits,
+                transport=transport
+            )
+            self._loop = loop
+        return self._client
+
+    @staticmethod
+    def _httpx_timeout(timeout):
+        if isinstance(timeout, tuple):
+            return httpx.Timeout(timeout[1], connect=timeout[0])
+        return httpx.Timeout(timeout)
+
+    @staticmethod
+    def _backoff(attempt, response=None):
+        if response is not None and response.headers.get("Retry-After", "").isdigit():
+            return float(response.headers["Retry-After"])
+        return RETRY_BACKOFF_FACTOR * (2 ** attempt) + random.uniform(0, RETRY_BACKOFF_JITTER)
+
+    async def get(self, path, params, timeout=None):
+        """GET a Qloo endpoint and return the decoded JSON body."""
+        params = {name: value for name, value in params.items() if value is not None}
+        with self.breaker.guard():
+            if self.hedger is None:
+                return await self._get(path, params, timeout)
+            return await self.hedger.call_async(
+                operation_name(path), lambda hedge: self._get(path, params, timeout, hedge)
+            )
+
+    async def _get(self, path, params, timeout=None, hedge=False):
+        client = self._get_client()
+        operation = operation_name(path)
+        # Out of time is our own doing, not an upstream error: raise before the call is tracked
+        bounded_timeout(timeout or self.timeout)
+        with span(f"qloo-{operation}", "hedge" if hedge else None) as attrs, track_upstream("qloo", operation):
+            start = time.perf_counter()
+            for attempt in range(self.max_retries + 1):
+                # Retries only back off when affords() leaves time for another attempt
+                attempt_timeout = self._httpx_timeout(bounded_timeout(timeout or self.timeout))
+                try:
+                    response = await client.get(path, params=params, timeout=attempt_timeout)
+                except httpx.TransportError:
+                    backoff = self._backoff(attempt)
+                    if attempt >= self.max_retries or not affords(backoff):
+                        raise
+                    await asyncio.sleep(backoff)
+                    continue
+
+                if response.status_code in RETRY_STATUSES and attempt < self.max_retries:
+                    backoff = self._backoff(attempt, response)
+                    if affords(backoff):
+                        await asyncio.sleep(backoff)
+                        continue
+
+                attrs["status"] = response.status_code
+                attrs["attempts"] = attempt + 1
+                response.raise_for_status()
+                body = response.json()
+                if self.hedger is not None:
+                    self.hedger.observe(operation, time.perf_counter() - start)
+                return body
+
+    async def search(self, query, entity_type, limit=1):
+        return await self.get("/search", {
+            "query": query,
+            "filter.type": entity_type,
+            "limit": limit
+        })
+
+    async def insights(self, params):
+        return await self.get("/v2/insights", params)
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+
+# Sync and async clients share latency history, the hedge budget and the
+# circuit breaker, since they talk to the same upstream
+qloo_hedger = Hedger(
+    percentile=QLOO_HEDGE_PERCENTILE, budget_ratio=QLOO_HEDGE_BUDGET, min_delay=QLOO_HEDGE_MIN_DELAY,
+    max_workers=QLOO_POOL_SIZE * 2
+) if QLOO_HEDGE else None
+qloo_breaker = CircuitBreaker("qloo", slow_call=QLOO_SLOW_CALL, is_failure=is_qloo_failure)
+qloo = QlooClient(hedger=qloo_hedger, breaker=qloo_breaker)
+async_qloo = AsyncQlooClient(hedger=qloo_hedger, breaker=qloo_breaker)
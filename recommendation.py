@@ -1,3 +1,4 @@
+import copy
 import re
 import google.generativeai as genai
 import requests
@@ -6,7 +7,19 @@ import random
 import firebase_admin
 import os
 
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeout, as_completed
 from firebase_admin import credentials, firestore
+from qloo_client import qloo
+from cache import MISSING, EntityIdCache, ResponseCache, canonical_params_key
+from pools import CandidatePool, ExamplePool
+from gemini_client import GeminiClient
+from cassette import CassetteModel, cassette
+from singleflight import SingleFlight
+from batching import MicroBatcher
+from moods import MOOD_CLUSTERS, activities_for_mood, classify_mood
+from metrics import count_fallback, count_parse_failure, counts_parse_failures
+from tracing import submit_in_context, traced
+from deadline import OPTIONAL_STAGE_MIN, QLOO_RESERVE, DeadlineExceeded, affords, degrade, time_left
 
 GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
 QLOO_API_KEY = os.getenv("QLOO_API_KEY")
@@ -17,12 +30,6 @@ print("Qloo API Key is:", QLOO_API_KEY)
 # Configure Gemini API
 genai.configure(api_key=GOOGLE_API_KEY)
 
-QLOO_BASE_URL = "https://hackathon.api.qloo.com"
-
-QLOO_Headers = {
-    "x-api-key": QLOO_API_KEY
-}
-
 ENTITY_TYPE_MAP = {                         
     "movies": "urn:entity:movie",
     "books": "urn:entity:book",
@@ -36,8 +43,56 @@ ENTITY_TYPE_MAP = {
     "album":"urn:entity:album"
 }
 
+# Category names as the app's routes receive them. Unlike ENTITY_TYPE_MAP, the
+# routes map "music" to albums and take "artist" for artists.
+ROUTE_ENTITY_TYPE_MAP = {
+    "movies": "urn:entity:movie",
+    "books": "urn:entity:book",
+    "travel": "urn:entity:place",
+    "podcast":"urn:entity:podcast",
+    "videogame":"urn:entity:videogame",
+    "video games":"urn:entity:videogame",
+    "tv_show":"urn:entity:tv_show",
+    "tv shows":"urn:entity:tv_show",
+    "artist":"urn:entity:artist",
+    "music":"urn:entity:album"
+}
+
+# Shared worker pool for concurrent Qloo /search lookups. Keep it no larger than
+# the Qloo connection pool so every worker gets a keep-alive connection.
+ENTITY_LOOKUP_WORKERS = int(os.getenv("ENTITY_LOOKUP_WORKERS", "8"))
+_lookup_executor = ThreadPoolExecutor(max_workers=ENTITY_LOOKUP_WORKERS, thread_name_prefix="entity-lookup")
+
+# name -> entity_id cache: memory LRU in front of a SQLite file that survives restarts
+entity_cache = EntityIdCache(
+    os.getenv("ENTITY_CACHE_PATH", "entity_cache.sqlite3"),
+    max_entries=int(os.getenv("ENTITY_CACHE_MAX_ENTRIES", "5000")),
+    ttl=int(os.getenv("ENTITY_CACHE_TTL", str(7 * 24 * 3600))),
+    negative_ttl=int(os.getenv("ENTITY_CACHE_NEGATIVE_TTL", "3600"))
+)
+
+# /v2/insights responses keyed on the canonical parameter set (entity IDs sorted)
+insights_cache = ResponseCache(
+    ttl=int(os.getenv("INSIGHTS_CACHE_TTL", "900")),
+    stale_ttl=int(os.getenv("INSIGHTS_CACHE_STALE_TTL", "3600")),
+    max_bytes=int(os.getenv("INSIGHTS_CACHE_MAX_BYTES", str(32 * 1024 * 1024))),
+    name="insights"
+)
+
+# Identical Qloo calls already in flight (same search key or same canonical
+# insights params) are made once and shared by every concurrent caller
+qloo_flights = SingleFlight("qloo")
+
+# Small Gemini description prompts from concurrent requests that arrive within
+# this window of each other are merged into one multi-item call
+GEMINI_BATCH_WINDOW = float(os.getenv("GEMINI_BATCH_WINDOW_MS", "15")) / 1000
+GEMINI_BATCH_MAX_ITEMS = int(os.getenv("GEMINI_BATCH_MAX_ITEMS", "20"))
+
 # Create a model instance
 model = genai.GenerativeModel("gemini-2.5-flash")
+if cassette is not None:
+    model = CassetteModel(model, cassette)
+gemini = GeminiClient(model)
 
 # def get_examples(preferences):
 #     prompt = f"""
@@ -116,8 +171,15 @@ model = genai.GenerativeModel("gemini-2.5-flash")
 
 import json
 
-def get_single_example(category, preference):
-    prompt = f"""
+SINGLE_EXAMPLE_CONFIG = {
+    "temperature": 1.3,  # Add randomness
+    "top_p": 1.0,
+    "top_k": 40
+}
+
+
+def single_example_prompt(category, preference):
+    return f"""
 You are a recommendation system that specializes in Western cultural preferences.
 
 The user has selected one preference in the category "{category}":
@@ -141,60 +203,53 @@ Output format:
 - No markdown, no code blocks, no extra formatting
 """
 
-    try:
-        response = model.generate_content(
-            prompt,
-            generation_config={
-                "temperature": 1.3,  # Add randomness
-                "top_p": 1.0,
-                "top_k": 40
-            }
-        )
 
-        json_text = response.text.strip()
+@traced("parse")
+@counts_parse_failures
+def parse_single_example(text):
+    json_text = text.strip()
 
-        # Clean and extract JSON
-        if "```json" in json_text:
-            json_text = json_text.split("```json")[-1].split("```")[0].strip()
-        elif "```" in json_text:
-            json_text = json_text.split("```")[-2].strip()
+    # Clean and extract JSON
+    if "```json" in json_text:
+        json_text = json_text.split("```json")[-1].split("```")[0].strip()
+    elif "```" in json_text:
+        json_text = json_text.split("```")[-2].strip()
 
-        print("Cleaned JSON text:", json_text)
-        result = json.loads(json_text)
+    print("Cleaned JSON text:", json_text)
+    result = json.loads(json_text)
 
-        # Validate structure
-        if not isinstance(result.get("recommendations"), list) or len(result["recommendations"]) != 2:
-            return { "recommendations": ["Invalid", "Try again"] }
+    # Validate structure
+    if not isinstance(result.get("recommendations"), list) or len(result["recommendations"]) != 2:
+        count_parse_failure("single_example")
+        count_fallback("single_example")
+        return { "recommendations": ["Invalid", "Try again"] }
+
+    return result
 
-        return result
+
+def single_example_fallback():
+    count_fallback("single_example")
+    return {
+        "recommendations": ["No recommendation", "Try again later"]
+    }
+
+
+def get_single_example(category, preference):
+    try:
+        raw_text = gemini.generate_text(
+            "single_example",
+            single_example_prompt(category, preference),
+            generation_config=SINGLE_EXAMPLE_CONFIG
+        )
+        return parse_single_example(raw_text)
 
     except Exception as e:
         print("Error parsing JSON:", e)
-        print("Raw response:", response.text if 'response' in locals() else '')
+        print("Raw response:", raw_text if 'raw_text' in locals() else '')
 
-        return {
-            "recommendations": ["No recommendation", "Try again later"]
-        }
+        return single_example_fallback()
 
     
-def find_entity_id(query, entity_type):
-    """Search for an entity by name and return its entity_id"""
-    response = requests.get(
-        f"{QLOO_BASE_URL}/search",
-        headers={"x-api-key": QLOO_API_KEY},
-        params={
-            "query": query,
-            "filter.type": entity_type,
-            "limit": 1
-        }
-    )
-    response.raise_for_status()
-    data = response.json()
-    results = data.get("results", [])
-    if results:
-        return results[0].get("entity_id")
-    return None
-
 def map_names_to_entity_ids(recommendation_json):
     """
     Convert recommendation names to entity_ids, preserving nested list structure.
@@ -208,13 +263,9 @@ def map_names_to_entity_ids(recommendation_json):
         if not entity_type:
             continue
 
-        converted_category = []
-        for sublist in nested_list:
-            converted_sublist = []
-            for name in sublist:
-                entity_id = find_entity_id(name, entity_type)
-                converted_sublist.append(entity_id)
-            converted_category.append(converted_sublist)
+        # Resolve the whole category in one batch, then rebuild the nested lists
+        flat_ids = iter(resolve_entity_id_list([name for sublist in nested_list for name in sublist], entity_type))
+        converted_category = [[next(flat_ids) for _ in sublist] for sublist in nested_list]
 
         entity_id_json[category] = converted_category
 
@@ -222,6 +273,36 @@ def map_names_to_entity_ids(recommendation_json):
 
 
 
+def fetch_insights_entities(params):
+    """
+    Call Qloo /v2/insights and return [{name, image}, ...], served from insights_cache
+    when the same canonical parameter set was fetched recently.
+    """
+    key = canonical_params_key(params)
+    entities = insights_cache.get_or_fetch(
+        key, lambda: qloo_flights.do(("insights", key), lambda: items_from_insights(qloo.insights(params)))
+    )
+    # Hand out copies so callers can't mutate cached entries
+    return [dict(item) for item in entities]
+
+
+@traced("parse")
+def items_from_insights(data):
+    entities = data.get("results", {}).get("entities", [])
+    return [
+        {
+            "name": item.get("name", "Unknown"),
+            "image": item.get("properties", {}).get("image", {}).get("url", "")
+        }
+        for item in entities
+    ]
+
+
+def canonical_entity_ids(entity_id):
+    """Sort and de-duplicate a comma-separated entity ID string."""
+    return ",".join(sorted({eid.strip() for eid in entity_id.split(",") if eid.strip()}))
+
+
 def fetch_individual_recommendation(entity_id, target_entity_type, take):
     """
     Fetch structured recommendations (name and image) for a single entity ID.
@@ -232,28 +313,39 @@ def fetch_individual_recommendation(entity_id, target_entity_type, take):
             "signal.interests.entities": entity_id,
             "take": take
         }
-        response = requests.get(
-            f"{QLOO_BASE_URL}/v2/insights",
-            headers=QLOO_Headers,
-            params=params
-        )
-        response.raise_for_status()
-        data = response.json()
-
-        entities = data.get("results", {}).get("entities", [])
-
-        return [
-            {
-                "name": item.get("name", "Unknown"),
-                "image": item.get("properties", {}).get("image", {}).get("url", "")
-            }
-            for item in entities
-        ]
+        return fetch_insights_entities(params)
 
     except Exception as e:
         print(f"Error for entity {entity_id}: {e}")
+        degrade("recommendations")
         return []
     
+def _fetch_candidate_page(key):
+    entity_ids, target_entity_type = key
+    return fetch_individual_recommendation(entity_ids, target_entity_type, take=CANDIDATE_POOL_SIZE)
+
+
+# Over-fetched insights pages per (sorted entity IDs, target type)
+CANDIDATE_POOL_SIZE = int(os.getenv("CANDIDATE_POOL_SIZE", "30"))
+candidate_pool = CandidatePool(_fetch_candidate_page, ttl=int(os.getenv("CANDIDATE_POOL_TTL", "3600")))
+
+
+def fetch_pooled_recommendation(entity_id, target_entity_type, take):
+    """
+    Like fetch_individual_recommendation, but serves `take` items from a larger
+    candidate page fetched once, giving a different slice on each call.
+    """
+    if not entity_id:
+        return []
+
+    try:
+        return candidate_pool.take((canonical_entity_ids(entity_id), target_entity_type), take)
+    except Exception as e:
+        print(f"Error for pooled entity {entity_id}: {e}")
+        degrade("recommendations")
+        return []
+
+
 def get_recommendations(target_category, entity_id_json, take=3):
     """
     For a given target category (e.g., 'movies'),
@@ -275,20 +367,16 @@ def get_recommendations(target_category, entity_id_json, take=3):
 
     return {target_category: grouped_recommendations}
 
-def generate_group_descriptions(category, all_recommendations):
-    """
-    Generate a single group title and description for the given recommendations.
-    Returns a dict with 'title' and 'description' keys.
-    """
-    item_names = [item["name"] for item in all_recommendations if item.get("name")]
-    
-    if not item_names:
-        return {
-            "title": "Curated Selection",
-            "description": "A thoughtfully curated selection for you."
-        }
+def default_group_info():
+    count_fallback("group_description")
+    return {
+        "title": "Curated Selection",
+        "description": "A thoughtfully curated selection for you."
+    }
 
-    prompt = f"""You are a smart recommendation assistant.
+
+def group_description_prompt(category, item_names):
+    return f"""You are a smart recommendation assistant.
 
 Here is a group of {category.replace('_', ' ')} titles:
 {json.dumps(item_names, indent=2)}
@@ -305,39 +393,133 @@ Don't list the names again.
 Be warm and natural. Avoid dry or overly technical language.
 """
 
+
+def parse_group_description(text):
+    # Parse Title and Description from Gemini response
+    title = ""
+    description = ""
+    for line in text.strip().splitlines():
+        if line.lower().startswith("title:"):
+            title = line.split(":", 1)[1].strip()
+        elif line.lower().startswith("description:"):
+            description = line.split(":", 1)[1].strip()
+
+    if not title or not description:
+        raise ValueError("Could not parse Gemini response.")
+
+    return {
+        "title": title,
+        "description": description
+    }
+
+
+def group_descriptions_batch_prompt(groups):
+    listing = [
+        {"group": i, "category": category.replace('_', ' '), "titles": list(names)}
+        for i, (category, names) in enumerate(groups)
+    ]
+    return f"""You are a smart recommendation assistant.
+
+Here are several groups of titles. Each has a group number, a category and its titles:
+{json.dumps(listing, indent=2)}
+
+For EACH group:
+1. Analyze the **tone, genre, vibe, or emotional theme** its titles share.
+2. Write a **short, catchy group title** that captures that shared feeling or category. (Max 5–7 words)
+3. Write a **1–2 sentence description** that explains what the experience is like when someone consumes this group — emotionally, stylistically, or narratively.
+
+Don't list the names again.
+Be warm and natural. Avoid dry or overly technical language.
+
+Return only a valid JSON array with one object per group, no markdown:
+[
+  {{"group": 0, "title": "<group title>", "description": "<group description>"}}
+]
+"""
+
+
+@traced("parse")
+@counts_parse_failures
+def parse_group_descriptions_batch(text, groups):
+    """Map a batched response to {group: {"title", "description"}}, skipping incomplete entries."""
+    entries = parse_json_block(text, pattern=r"\[[\s\S]*\]")
+    if not isinstance(entries, list):
+        raise ValueError("Batched group description response is not a list")
+
+    results = {}
+    for entry in entries:
+        if not isinstance(entry, dict) or not isinstance(entry.get("group"), int):
+            continue
+        title, description = entry.get("title"), entry.get("description")
+        if 0 <= entry["group"] < len(groups) and isinstance(title, str) and title.strip() \
+                and isinstance(description, str) and description.strip():
+            results.setdefault(groups[entry["group"]], {"title": title.strip(), "description": description.strip()})
+    return results
+
+
+def run_group_descriptions_batch(batch_key, groups):
+    """
+    Micro-batch runner: describe the groups of every waiting request with one call
+    and cache each description. An unparseable response leaves every group out.
+    """
+    text = gemini.generate_text("group_description_batch", group_descriptions_batch_prompt(groups))
     try:
-        response = model.generate_content(prompt)
-        raw_text = response.text.strip()
-
-        # Parse Title and Description from Gemini response
-        title = ""
-        description = ""
-        for line in raw_text.splitlines():
-            if line.lower().startswith("title:"):
-                title = line.split(":", 1)[1].strip()
-            elif line.lower().startswith("description:"):
-                description = line.split(":", 1)[1].strip()
-
-        if not title or not description:
-            raise ValueError("Could not parse Gemini response.")
-
-        return {
-            "title": title,
-            "description": description
-        }
+        results = parse_group_descriptions_batch(text, groups)
+    except ValueError as e:
+        print(f"Batched group descriptions could not be parsed: {e}")
+        return {}
 
+    for (category, names), info in results.items():
+        gemini.store("group_description", {"category": category, "items": list(names)}, info)
+    return results
+
+
+group_description_batcher = MicroBatcher(
+    run_group_descriptions_batch, window=GEMINI_BATCH_WINDOW, max_items=GEMINI_BATCH_MAX_ITEMS, name="group_description"
+)
+
+
+def generate_group_descriptions(category, all_recommendations):
+    """
+    Generate a single group title and description for the given recommendations.
+    Returns a dict with 'title' and 'description' keys. Groups from concurrent
+    requests are described together; a group the batch left out gets its own call.
+    Uncached groups get the default title when the request is short of time.
+    """
+    item_names = [item["name"] for item in all_recommendations if item.get("name")]
+    
+    if not item_names:
+        return default_group_info()
+
+    cached = gemini.get_cached("group_description", {"category": category, "items": item_names})
+    if cached is not MISSING:
+        return cached
+    if not affords(OPTIONAL_STAGE_MIN):
+        degrade("group_description", "deadline")
+        return default_group_info()
+
+    try:
+        [info] = group_description_batcher.submit("groups", [(category, tuple(item_names))])
+    except DeadlineExceeded:
+        return default_group_info()
     except Exception as e:
         print(f"Gemini API error for {category} group: {e}")
-        return {
-            "title": "Curated Selection",
-            "description": "A thoughtfully curated selection for you."
-        }
+        return default_group_info()
+    if info is not MISSING:
+        return dict(info)
 
-def get_item_details(category: str, name: str):
-    
-    category = category.lower()
+    try:
+        return gemini.generate_parsed(
+            "group_description", group_description_prompt(category, item_names), parse_group_description,
+            cache_args={"category": category, "items": item_names}
+        )
 
-    prompt = f"""
+    except Exception as e:
+        print(f"Gemini API error for {category} group: {e}")
+        return default_group_info()
+
+def item_details_prompt(category: str, name: str):
+    return f"""
         You are a structured knowledge assistant.
 
         The user has selected a {category}. The title is:
@@ -425,45 +607,63 @@ def get_item_details(category: str, name: str):
         """
 
 
-    try:
-        response = model.generate_content(prompt)
-        raw = response.text.strip()
+def parse_item_details(text):
+    raw = text.strip()
 
-        # Remove ```json or ``` if present
-        if "```json" in raw:
-            raw = raw.split("```json")[-1].split("```")[0].strip()
-        elif "```" in raw:
-            raw = raw.split("```")[1].strip()
+    # Remove ```json or ``` if present
+    if "```json" in raw:
+        raw = raw.split("```json")[-1].split("```")[0].strip()
+    elif "```" in raw:
+        raw = raw.split("```")[1].strip()
 
-        return json.loads(raw)
+    return json.loads(raw)
+
+
+def item_details_fallback(name):
+    count_fallback("item_details")
+    return {
+        "name": name,
+        "error": "Failed to retrieve detailed info. Please try again."
+    }
+
+
+def get_item_details(category: str, name: str):
+    
+    category = category.lower()
+
+    try:
+        return gemini.generate_parsed(
+            "item_details", item_details_prompt(category, name), parse_item_details,
+            cache_args={"category": category, "name": name}
+        )
 
     except Exception as e:
         print(f"Error fetching Gemini details for {name} ({category}):", e)
-        return {
-            "name": name,
-            "error": "Failed to retrieve detailed info. Please try again."
-        }
+        return item_details_fallback(name)
 
-def get_activity_recommendations_by_mood(mood: str) -> dict:
-    """
-    Based on the user's current mood, return a set of different activity recommendations
-    from Western culture across suitable categories, with varied results on each call.
-    """
+MOOD_ACTIVITIES_CONFIG = {
+    "temperature": 1.2,  # Encourage diversity
+    "top_p": 1.0,
+    "top_k": 40
+}
+
+
+# Activity types the mood prompts offer Gemini, in the order they are listed
+MOOD_ACTIVITY_TYPES = ["movies", "books", "podcast", "videogame", "tv_show", "travel", "artist", "music"]
 
-    prompt = f"""
+
+def mood_activity_type_list() -> str:
+    return "\n".join(f"- {activity}" for activity in MOOD_ACTIVITY_TYPES)
+
+
+def mood_activities_prompt(mood: str) -> str:
+    return f"""
 You are a recommendation system that specializes in Western cultural preferences.
 
 A user is currently feeling **{mood}**.
 
 From the following activity types:
-- movies
-- books
-- podcast
-- videogame
-- tv_show
-- travel
-- artist
-- music
+{mood_activity_type_list()}
 
 Select the activity types that best match the user's current mood. For each selected activity type, generate **one highly popular and culturally relevant example** from Western culture.
 
@@ -488,41 +688,158 @@ Return only valid raw JSON in the following format:
 - Do NOT include any explanation, commentary, or markdown. Only raw JSON output.
 """
 
-    try:
-        response = model.generate_content(
-            prompt,
-            generation_config={
-                "temperature": 1.2,  # Encourage diversity
-                "top_p": 1.0,
-                "top_k": 40
-            }
-        )
 
-        json_text = response.text.strip()
+@traced("parse")
+@counts_parse_failures
+def parse_mood_activities(text: str) -> dict:
+    json_text = text.strip()
 
-        # Handle code blocks if present
-        if json_text.startswith("```json"):
-            json_text = json_text.split("```json")[-1].split("```")[0].strip()
-        elif json_text.startswith("```"):
-            json_text = json_text.split("```")[-1].strip()
+    # Handle code blocks if present
+    if json_text.startswith("```json"):
+        json_text = json_text.split("```json")[-1].split("```")[0].strip()
+    elif json_text.startswith("```"):
+        json_text = json_text.split("```")[-1].strip()
 
-        result = json.loads(json_text)
+    result = json.loads(json_text)
+
+    if isinstance(result, dict) and len(result) >= 2:
+        return result
+    else:
+        raise ValueError("Less than 2 valid activity types returned")
+
+
+def mood_activities_fallback(error) -> dict:
+    count_fallback("mood_activities")
+    return {
+        "error": "Failed to fetch recommendations from Gemini",
+        "details": str(error)
+    }
+
+
+# Background refills each example pool runs at once
+EXAMPLE_POOL_WORKERS = int(os.getenv("EXAMPLE_POOL_WORKERS", "4"))
+# Fill the example pools for every known key when the app starts, rather than on first request
+WARM_EXAMPLE_POOLS = os.getenv("WARM_EXAMPLE_POOLS", "1") == "1"
+MOOD_POOL_BATCH_SIZE = int(os.getenv("MOOD_POOL_BATCH_SIZE", "8"))
+
+
+def mood_examples_prompt(cluster: str, activity: str, count: int) -> str:
+    return f"""
+You are a recommendation system that specializes in Western cultural preferences.
+
+A user is currently feeling **{cluster}**.
+
+Give {count} different, highly popular and culturally relevant examples from Western culture
+for the activity type "{activity}" that match this mood.
+
+Randomize the selection. No duplicates.
+
+Return only valid raw JSON: an array of exact names/titles.
+
+Output format:
+["example1", "example2", ...]
+"""
+
+
+def generate_mood_examples(key):
+    """
+    Example pool generator for a (mood cluster, activity) pair: one Gemini call
+    for a batch of titles, resolved up front so the daily flow finds their
+    entity IDs in entity_cache. Titles Qloo can't match are dropped.
+    """
+    cluster, activity = key
+    titles = gemini.generate_parsed(
+        "mood_examples_batch",
+        mood_examples_prompt(cluster, activity, MOOD_POOL_BATCH_SIZE),
+        parse_example_list,
+        generation_config=MOOD_ACTIVITIES_CONFIG
+    )
+    random.shuffle(titles)
+    entity_ids = resolve_entity_id_list(titles, ENTITY_TYPE_MAP[activity])
+    return [title for title, entity_id in zip(titles, entity_ids) if entity_id]
+
+
+mood_example_pool = ExamplePool(
+    generate_mood_examples, low_water=int(os.getenv("MOOD_POOL_LOW_WATER", "3")), workers=EXAMPLE_POOL_WORKERS
+)
+
+
+def local_mood_activities(mood: str):
+    """
+    Answer the mood -> {activity: example} step without Gemini: classify the mood
+    locally and take one pooled example per activity of its cluster. Returns None
+    for moods the lexicon doesn't know, or while the cluster's pools are still
+    too empty to cover two activities.
+    """
+    cluster = classify_mood(mood)
+    if cluster is None:
+        return None
+
+    result = {}
+    for activity in activities_for_mood(cluster):
+        example = mood_example_pool.pop((cluster, activity))
+        if example:
+            result[activity] = example
+
+    print(f"Mood '{mood}' classified as '{cluster}', pooled examples: {result}")
+    return result if len(result) >= 2 else None
 
-        if isinstance(result, dict) and len(result) >= 2:
-            return result
-        else:
-            raise ValueError("Less than 2 valid activity types returned")
+
+def get_activity_recommendations_by_mood(mood: str) -> dict:
+    """
+    Based on the user's current mood, return a set of different activity recommendations
+    from Western culture across suitable categories, with varied results on each call.
+    Known moods are served from mood_example_pool; Gemini handles the rest.
+    """
+    local = local_mood_activities(mood)
+    if local:
+        return local
+    return get_gemini_activity_recommendations_by_mood(mood)
+
+
+def get_gemini_activity_recommendations_by_mood(mood: str) -> dict:
+    """The Gemini half of get_activity_recommendations_by_mood, for callers that already tried the pools."""
+    try:
+        text = gemini.generate_text(
+            "mood_activities", mood_activities_prompt(mood), generation_config=MOOD_ACTIVITIES_CONFIG
+        )
+        return parse_mood_activities(text)
 
     except Exception as e:
         print("Error calling Gemini or parsing response:", e)
-        return {
-            "error": "Failed to fetch recommendations from Gemini",
-            "details": str(e)
-        }
+        return mood_activities_fallback(e)
     
-def get_genre_based_examples(filtered_preferences: dict) -> dict:
 
-    prompt = f"""
+def parse_json_block(text, pattern=r"\{[\s\S]*\}"):
+    """Strip markdown fences and parse the first JSON object (or array, via pattern) in text."""
+    text = text.strip()
+
+    if text.startswith("```json"):
+        text = text[len("```json"):].strip("`\n ")
+    elif text.startswith("```"):
+        text = text[3:].strip("`\n ")
+
+    match = re.search(pattern, text)
+    if match:
+        json_text = match.group()
+        return json.loads(json_text)
+    return json.loads(text)
+
+
+@traced("parse")
+def parse_json_object_or_empty(text: str) -> dict:
+    """Parse the JSON object in a Gemini response, returning {} if there isn't a valid one."""
+    try:
+        return parse_json_block(text)
+    except Exception as e:
+        count_parse_failure("json_object")
+        print("Failed to parse Gemini response as JSON:", e)
+        print("Raw response:", text)
+        return {}
+
+
+def genre_examples_prompt(filtered_preferences: dict) -> str:
+    return f"""
 You are a cultural recommendation system that specializes in Western culture (e.g., US, UK, Europe).
 
 The user has the following genre preferences under each activity category:
@@ -549,57 +866,147 @@ Output format:
 """
 
 
-    response = model.generate_content(prompt)
-    text = response.text.strip()
-
-    # Clean up any markdown or code block formatting
-    if text.startswith("```json"):
-        text = text[len("```json"):].strip("`\n ")
-    elif text.startswith("```"):
-        text = text[3:].strip("`\n ")
-
-    # Extract JSON from the response (handles if extra text included)
+def get_genre_based_examples(filtered_preferences: dict) -> dict:
     try:
-        match = re.search(r"\{[\s\S]*\}", text)
-        if match:
-            json_text = match.group()
-            return json.loads(json_text)
-        else:
-            # fallback to direct json.loads if no extra text
-            return json.loads(text)
+        text = gemini.generate_text("genre_examples", genre_examples_prompt(filtered_preferences))
     except Exception as e:
-        print("Failed to parse Gemini response as JSON:", e)
-        print("Raw response:", text)
+        print(f"Genre examples unavailable: {e}")
+        count_fallback("genre_examples")
         return {}
-    
-def find_entity_id(query, entity_type):
-    """Search Qloo for an entity name and return its entity_id."""
+    return parse_json_object_or_empty(text)
+
+
+def mood_and_genre_examples_prompt(mood: str, genre_preferences: dict) -> str:
+    return f"""
+You are a recommendation system that specializes in Western cultural preferences.
+
+A user is currently feeling **{mood}**.
+
+The user also has the following genre preferences under each activity category:
+
+{json.dumps(genre_preferences, indent=2)}
+
+Your task has two parts.
+
+1. From the following activity types:
+{mood_activity_type_list()}
+
+Select the activity types that best match the user's current mood (at least two). For each selected
+activity type, give **one highly popular and culturally relevant example** from Western culture.
+
+2. For each selected activity type that also appears in the genre preferences above, recommend
+exactly ONE **highly popular** and **widely recognized** example per genre. The number of examples
+must match the number of genres for that activity.
+
+🌀 Randomize the selection each time. Do NOT repeat the same outputs across calls.
+
+Return only valid raw JSON in the following format:
+{{
+  "activities": {{
+    "movies": "Example movie",
+    "music": "Example song"
+  }},
+  "genre_examples": {{
+    "music": ["Jazz example", "Rock example"]
+  }}
+}}
+
+⚠️ Requirements:
+- Include only activity types relevant to the mood.
+- All examples must be popular and recognizable in Western culture.
+- No explanation, commentary or markdown. Only raw JSON output.
+"""
+
+
+@traced("parse")
+@counts_parse_failures
+def parse_mood_and_genre_examples(text: str):
+    """
+    Split a fused response into (activities, genre_examples), shaped like the
+    outputs of parse_mood_activities and get_genre_based_examples. Raises
+    ValueError when either part is malformed.
+    """
+    result = parse_json_block(text)
+    activities = result.get("activities") if isinstance(result, dict) else None
+    genre_examples = result.get("genre_examples", {}) if isinstance(result, dict) else None
+
+    if not isinstance(activities, dict) or len(activities) < 2:
+        raise ValueError("Less than 2 valid activity types returned")
+    if not all(isinstance(example, str) and example.strip() for example in activities.values()):
+        raise ValueError("Activity examples must be non-empty strings")
+    if not isinstance(genre_examples, dict):
+        raise ValueError("genre_examples must be an object")
+
+    genre_examples = {
+        activity: [example for example in examples if isinstance(example, str) and example.strip()]
+        for activity, examples in genre_examples.items()
+        if isinstance(examples, list)
+    }
+    return activities, genre_examples
+
+
+def get_mood_and_genre_examples(mood: str, genre_preferences: dict):
+    """
+    One Gemini call in place of the mood -> activities call followed by the
+    genre examples call. Returns (activities, genre_examples), or None if the
+    response didn't validate so the caller can fall back to the two calls.
+    """
     try:
-        if not query or not query.strip():
-            print(f"[WARN] Empty query received for type '{entity_type}'")
-            return None
-
-        response = requests.get(
-            f"{QLOO_BASE_URL}/search",
-            headers={"x-api-key": QLOO_API_KEY},
-            params={
-                "query": query.strip(),
-                "filter.type": entity_type,
-                "limit": 1
-            },
-            timeout=10  # Always add a timeout to avoid hanging
+        text = gemini.generate_text(
+            "mood_and_genre_examples", mood_and_genre_examples_prompt(mood, genre_preferences),
+            generation_config=MOOD_ACTIVITIES_CONFIG
         )
-        response.raise_for_status()
+        return parse_mood_and_genre_examples(text)
+    except Exception as e:
+        print("Fused mood and genre call failed, falling back to separate calls:", e)
+        return None
+
+
+def search_entity_id(query, entity_type):
+    """
+    Search Qloo for an entity name and return its entity_id, or None if nothing matched.
+    Answers come from entity_cache when possible; request errors are raised to the
+    caller and never cached.
+    """
+    if not query or not query.strip():
+        print(f"[WARN] Empty query received for type '{entity_type}'")
+        return None
+
+    cached = entity_cache.get(query, entity_type)
+    if cached is not MISSING:
+        return cached
+
+    return qloo_flights.do(
+        ("search", entity_cache.make_key(query, entity_type)),
+        lambda: entity_id_from_search(qloo.search(query.strip(), entity_type, limit=1), query, entity_type)
+    )
+
+
+def entity_id_from_search(data, query, entity_type):
+    """Pick the entity_id out of a /search response and cache the outcome, including a miss."""
+    entity_id = parse_search_entity_id(data, query, entity_type)
+    entity_cache.set(query, entity_type, entity_id)
+    return entity_id
+
 
-        data = response.json()
-        results = data.get("results", [])
+@traced("parse")
+def parse_search_entity_id(data, query, entity_type):
+    """The entity_id of the top /search result, or None."""
+    results = data.get("results", [])
+
+    if results and "entity_id" in results[0]:
+        entity_id = results[0]["entity_id"]
+        if entity_id and isinstance(entity_id, str):
+            return entity_id
+
+    print(f"[WARN] No valid entity_id found for query '{query}' ({entity_type})")
+    return None
 
-        if results and "entity_id" in results[0]:
-            entity_id = results[0]["entity_id"]
-            if entity_id and isinstance(entity_id, str):
-                return entity_id
 
-        print(f"[WARN] No valid entity_id found for query '{query}' ({entity_type})")
+def find_entity_id(query, entity_type):
+    """Search Qloo for an entity name and return its entity_id."""
+    try:
+        return search_entity_id(query, entity_type)
     except requests.exceptions.RequestException as e:
         print(f"[ERROR] Request error for '{query}' ({entity_type}): {e}")
     except Exception as e:
@@ -608,6 +1015,58 @@ def find_entity_id(query, entity_type):
     return None
 
 
+def _resolve_one(name, entity_type):
+    try:
+        return {"name": name, "entity_type": entity_type, "entity_id": search_entity_id(name, entity_type), "error": None}
+    except Exception as e:
+        print(f"[ERROR] Lookup failed for '{name}' ({entity_type}): {e}")
+        return {"name": name, "entity_type": entity_type, "entity_id": None, "error": str(e)}
+
+
+def resolve_entity_ids(pairs):
+    """
+    Resolve a list of (name, entity_type) pairs to Qloo entity IDs concurrently.
+
+    Returns a list in the same order as the input, one dict per pair:
+        {"name": ..., "entity_type": ..., "entity_id": <id or None>, "error": <message or None>}
+    """
+    pairs = list(pairs)
+    if len(pairs) <= 1:
+        return [_resolve_one(name, entity_type) for name, entity_type in pairs]
+
+    futures = [submit_in_context(_lookup_executor, _resolve_one, name, entity_type) for name, entity_type in pairs]
+    return [future.result() for future in futures]
+
+
+def resolve_entity_id_list(names, entity_type):
+    """Resolve names of one entity type concurrently, returning entity IDs (or None) in input order."""
+    return [result["entity_id"] for result in resolve_entity_ids((name, entity_type) for name in names)]
+
+
+def fetch_seed_recommendations(example, example_entity_type, active_entity_type, take=5):
+    """Resolve one seed example and return `take` pooled recommendations for it. Lookup errors are raised."""
+    entity_id = search_entity_id(example, example_entity_type)
+    return fetch_pooled_recommendation(entity_id, active_entity_type, take=take)
+
+
+def iter_seed_recommendations(seed_examples, example_entity_type, active_entity_type, take=5):
+    """
+    Run fetch_seed_recommendations for every seed concurrently and yield
+    (example, recommendations, error) as each one finishes, fastest first.
+    """
+    futures = {
+        submit_in_context(
+            _lookup_executor, fetch_seed_recommendations, example, example_entity_type, active_entity_type, take
+        ): example
+        for example in seed_examples
+    }
+    for future in as_completed(futures):
+        try:
+            yield futures[future], future.result(), None
+        except Exception as e:
+            yield futures[future], [], str(e)
+
+
 def merge_and_map_entity_ids(recommendations: dict, preference_examples: dict) -> dict:
     """
     Combine recommendation and preference example names under each activity,
@@ -618,6 +1077,7 @@ def merge_and_map_entity_ids(recommendations: dict, preference_examples: dict) -
     """
 
     combined_ids = {}
+    lookups = []
 
     # Merge all keys from both sources
     all_keys = set(recommendations.keys()) | set(preference_examples.keys())
@@ -637,12 +1097,14 @@ def merge_and_map_entity_ids(recommendations: dict, preference_examples: dict) -
         if category in preference_examples and isinstance(preference_examples[category], list):
             names.extend(preference_examples[category])
 
-        entity_ids = []
-        for name in names:
-            entity_id = find_entity_id(name, entity_type)
-            entity_ids.append(entity_id)
+        lookups.append((category, entity_type, names))
 
-        combined_ids[category] = entity_ids
+    # Resolve every name across all categories in one concurrent batch
+    results = iter(resolve_entity_ids(
+        (name, entity_type) for _, entity_type, names in lookups for name in names
+    ))
+    for category, _, names in lookups:
+        combined_ids[category] = [next(results)["entity_id"] for _ in names]
 
     return combined_ids
 
@@ -673,6 +1135,99 @@ def get_recommendations_for_activities(entity_id_json, activity_list, take=1):
     return all_recommendations
 
 
+# Stages of the daily flow run here rather than on _lookup_executor: a stage
+# waits on entity lookups submitted to that pool, so sharing it could deadlock
+# once every lookup worker is a stage waiting for a lookup.
+DAILY_STAGE_WORKERS = int(os.getenv("DAILY_STAGE_WORKERS", "16"))
+_stage_executor = ThreadPoolExecutor(max_workers=DAILY_STAGE_WORKERS, thread_name_prefix="daily-stage")
+
+
+def speculative_genre_preferences(preferences) -> dict:
+    """Every non-empty preference category the daily flow could pick, before the mood call decides."""
+    if not isinstance(preferences, dict):
+        return {}
+    return {k: v for k, v in preferences.items() if k in ENTITY_TYPE_MAP and v}
+
+
+def _daily_activity_recommendations(activity, mood_example, genre_future, take):
+    """
+    One activity of the daily flow: resolve its mood example right away and its
+    genre examples once they arrive, then fetch combined insights for both.
+    """
+    entity_type = ENTITY_TYPE_MAP[activity]
+    mood_lookup = None
+    if isinstance(mood_example, str):
+        mood_lookup = submit_in_context(_lookup_executor, _resolve_one, mood_example, entity_type)
+
+    genre_examples = []
+    if genre_future is not None:
+        try:
+            # Leave time to resolve and fetch whatever examples there are
+            genre_examples = genre_future.result(timeout=time_left(QLOO_RESERVE)).get(activity) or []
+        except FutureTimeout:
+            print(f"Genre examples for {activity} would miss the deadline, continuing without them")
+            degrade("genre_examples", "deadline")
+        except Exception as e:
+            print(f"Genre examples failed, continuing without them: {e}")
+    if not isinstance(genre_examples, list):
+        genre_examples = []
+
+    lookups = resolve_entity_ids((name, entity_type) for name in genre_examples)
+    if mood_lookup is not None:
+        lookups.insert(0, mood_lookup.result())
+
+    entity_ids = [lookup["entity_id"] for lookup in lookups if lookup["entity_id"]]
+    if not entity_ids:
+        return []
+    return fetch_combined_recommendations(entity_ids, entity_type, take)
+
+
+def get_daily_recommendations(mood: str, preferences, take=1) -> dict:
+    """
+    The /daily-recommendations flow run as overlapping stages. Known moods come
+    from the local pools; unknown ones get activities and genre examples from a
+    single fused Gemini call. If that fails, the two separate calls run side by
+    side, with genre examples generated speculatively for every preference
+    category. Once the activities are known, each one resolves its names and
+    fetches insights on its own, so latency follows the slowest activity, not
+    the sum. Genre examples for categories the mood didn't pick are discarded.
+    """
+    genre_preferences = speculative_genre_preferences(preferences)
+    genre_future = None
+
+    recommendations = local_mood_activities(mood)
+    if recommendations is None and genre_preferences:
+        # Unknown mood with preferences: one fused Gemini call covers both steps
+        fused = get_mood_and_genre_examples(mood, genre_preferences)
+        if fused is not None:
+            recommendations, genre_examples = fused
+            genre_future = Future()
+            genre_future.set_result(genre_examples)
+
+    if genre_future is None and genre_preferences:
+        genre_future = submit_in_context(_stage_executor, get_genre_based_examples, genre_preferences)
+    try:
+        if recommendations is None:
+            recommendations = get_gemini_activity_recommendations_by_mood(mood)
+        print(f"Recommendations: {recommendations}")
+        if not isinstance(recommendations, dict) or recommendations.get("error"):
+            return {}
+
+        activities = [activity for activity in recommendations if activity in ENTITY_TYPE_MAP]
+        futures = {
+            activity: submit_in_context(
+                _stage_executor, _daily_activity_recommendations, activity, recommendations[activity], genre_future, take
+            )
+            for activity in activities
+        }
+        results = {activity: future.result() for activity, future in futures.items()}
+        return {activity: recs for activity, recs in results.items() if recs}
+    finally:
+        # Nothing reads the speculative genre examples once we return; drop them
+        # if they haven't started (a call already in flight runs to completion)
+        if genre_future is not None:
+            genre_future.cancel()
+
 
 def fetch_combined_recommendations(entity_ids, target_entity_type, take=5):
     try:
@@ -686,36 +1241,36 @@ def fetch_combined_recommendations(entity_ids, target_entity_type, take=5):
             "take": take
         }
 
-        response = requests.get(
-            f"{QLOO_BASE_URL}/v2/insights",
-            headers=QLOO_Headers,
-            params=params
-        )
-        response.raise_for_status()
-        data = response.json()
-
-        entities = data.get("results", {}).get("entities", [])
-
-        return [
-            {
-                "name": item.get("name", "Unknown"),
-                "image": item.get("properties", {}).get("image", {}).get("url", "")
-            }
-            for item in entities
-        ]
+        return fetch_insights_entities(params)
 
     except Exception as e:
         print(f"Error fetching combined recommendations for entity IDs: {e}")
+        degrade("recommendations")
         return []
 
-def get_community_example(community: str, category: str) -> str:
-    """
-    Returns the name of one randomly selected Western-culture-based example from the given category
-    that aligns with the preferences of the specified community.
-    Each call is designed to return a different example.
-    """
+COMMUNITY_EXAMPLE_CONFIG = {"temperature": 1.1}
+
 
-    prompt = f"""
+# The taste archetypes users are assigned. Only these get pre-generated example
+# pools and journey decks; any other name is served inline without pooling.
+ARCHETYPES = [
+    'Alt Pulse', 'Lyrical Romantic', 'Culture Hacker', 'Berry Bloom', 'Minimal Spirit', 'Mystic Pulse', 'Pop Dreamer',
+    'Zen Zest', 'Hidden Flame', 'Wander Muse', 'Sunset Rebel', 'Cottage Noir', 'Neon Thinker', 'Kaleido Crafter',
+    'Earth Artisan', 'Retro Soul', 'Cyber Chill', 'Tropic Vibist', 'Hyper Connector', 'Cine Nomad', 'Cloudwalker',
+    'Vintage Flâneur', 'Joy Alchemist', 'Sunkissed Soul'
+]
+_ARCHETYPES_BY_NAME = {name.lower(): name for name in ARCHETYPES}
+
+
+def known_archetype(name):
+    """The canonical spelling of a known archetype, ignoring case and extra spaces, or None."""
+    if not isinstance(name, str):
+        return None
+    return _ARCHETYPES_BY_NAME.get(" ".join(name.split()).lower())
+
+
+def community_example_prompt(community: str, category: str) -> str:
+    return f"""
 You are a cultural trends expert.
 
 Your task is to identify one specific example from Western culture that matches the interests
@@ -736,27 +1291,125 @@ Output format:
 [example_name_only]
 """
 
+
+def get_community_example(community: str, category: str) -> str:
+    """
+    Returns the name of one randomly selected Western-culture-based example from the given category
+    that aligns with the preferences of the specified community.
+    Each call is designed to return a different example.
+    """
     try:
-        response = model.generate_content(prompt, generation_config={"temperature": 1.1})
-        return response.text.strip()
+        return gemini.generate_text(
+            "community_example", community_example_prompt(community, category),
+            generation_config=COMMUNITY_EXAMPLE_CONFIG
+        ).strip()
     except Exception as e:
+        count_fallback("community_example")
         return f"Error: {str(e)}"
 
 
-def get_opposite_community_journey_cards(community_type: str) -> dict:
+COMMUNITY_POOL_BATCH_SIZE = int(os.getenv("COMMUNITY_POOL_BATCH_SIZE", "8"))
+
+
+def community_examples_prompt(community: str, category: str, count: int) -> str:
+    return f"""
+You are a cultural trends expert.
+
+Your task is to identify {count} specific examples from Western culture that match the interests
+of a community.
+
+Community: "{community}"
+Category: "{category}"
+
+Constraints:
+- Every example must belong to the given category.
+- They must be well-known or relevant in Western culture (e.g., US, UK, or Europe).
+- Pick a varied, random selection of culturally aligned examples. No duplicates.
+- Do not explain or add context.
+
+Return only valid raw JSON: an array of exact names/titles.
+
+Output format:
+["example1", "example2", ...]
+"""
+
+
+def parse_example_list(text):
+    examples = parse_json_block(text, r"\[[\s\S]*\]")
+    if not isinstance(examples, list):
+        raise ValueError("Expected a JSON array of examples")
+    return list(dict.fromkeys(str(example).strip() for example in examples if str(example).strip()))
+
+
+def generate_community_examples(key):
+    """
+    Example pool generator: one Gemini call for a batch of examples for
+    (archetype, category), each resolved to an entity ID of entity_type up front.
+    Unresolvable titles are dropped.
+    """
+    archetype, category, entity_type = key
+    if not entity_type:
+        return []
+
+    titles = gemini.generate_parsed(
+        "community_examples_batch",
+        community_examples_prompt(archetype, category, COMMUNITY_POOL_BATCH_SIZE),
+        parse_example_list,
+        generation_config=COMMUNITY_EXAMPLE_CONFIG
+    )
+    random.shuffle(titles)
+    entity_ids = resolve_entity_id_list(titles, entity_type)
+    return [
+        {"title": title, "entity_id": entity_id}
+        for title, entity_id in zip(titles, entity_ids) if entity_id
+    ]
+
+
+# Pre-resolved (title, entity_id) examples per (archetype, category, entity_type), refilled in the background
+community_example_pool = ExamplePool(
+    generate_community_examples, low_water=int(os.getenv("COMMUNITY_POOL_LOW_WATER", "3")),
+    workers=EXAMPLE_POOL_WORKERS
+)
+
+
+def pop_community_example(archetype: str, category: str, entity_type: str):
+    """
+    Next pre-resolved {"title", "entity_id"} for the archetype and category, or
+    None if its pool is still empty. Unknown archetypes and categories are never
+    pooled, so they always get None.
+    """
+    archetype = known_archetype(archetype)
+    if archetype is None or not entity_type:
+        return None
+    return community_example_pool.pop((archetype, category.lower(), entity_type))
+
+
+def community_pool_keys():
+    """Every (archetype, category, entity_type) /community-recommendations can pool, one category name per entity type."""
+    categories = {}
+    for category, entity_type in ROUTE_ENTITY_TYPE_MAP.items():
+        categories.setdefault(entity_type, category)
+    return [(archetype, category, entity_type) for archetype in ARCHETYPES for entity_type, category in categories.items()]
+
+
+def warm_example_pools():
+    """Start filling the example pools for all known keys in the background. Called once at startup."""
+    if not WARM_EXAMPLE_POOLS:
+        return
+    community_example_pool.warm(community_pool_keys())
+    journey_deck_store.warm(ARCHETYPES)
+    mood_example_pool.warm((cluster, activity) for cluster in MOOD_CLUSTERS for activity in activities_for_mood(cluster))
+
 
-    prompt = f"""
+def journey_cards_prompt(community_type: str) -> str:
+    return f"""
 You are a cultural journey assistant.
 
 The user belongs to the following community: "{community_type}".
 
 Your task:
 - Choose any random community from the following:
-  [
-    'Alt Pulse','Lyrical Romantic', 'Culture Hacker', 'Berry Bloom', 'Minimal Spirit', 'Mystic Pulse', 'Pop Dreamer', 
-    'Zen Zest', 'Hidden Flame', 'Wander Muse', 'Sunset Rebel', 'Cottage Noir', 'Neon Thinker', 'Kaleido Crafter', 
-    'Earth Artisan', 'Retro Soul', 'Cyber Chill', 'Tropic Vibist', 'Hyper Connector', 'Cine Nomad', 'Cloudwalker', 
-    'Vintage Flâneur', 'Joy Alchemist', 'Sunkissed Soul']
+  [{", ".join(f"'{name}'" for name in ARCHETYPES)}]
 
 
 Then:
@@ -794,36 +1447,81 @@ Return only a JSON dictionary in this format:
 Only return raw JSON. No extra text. No markdown. No explanation.
 """
 
-    response = model.generate_content(prompt)
-    text = response.text.strip()
 
-    # Remove code formatting if present
-    if text.startswith("```json"):
-        text = text[len("```json"):].strip("`\n ")
-    elif text.startswith("```"):
-        text = text[3:].strip("`\n ")
+def get_opposite_community_journey_cards(community_type: str) -> dict:
+    text = gemini.generate_text("journey_cards", journey_cards_prompt(community_type))
+    return parse_json_object_or_empty(text)
 
-    try:
-        match = re.search(r"\{[\s\S]*\}", text)
-        if match:
-            json_text = match.group()
-            return json.loads(json_text)
-        else:
-            return json.loads(text)
-    except Exception as e:
-        print("Failed to parse Gemini response as JSON:", e)
-        print("Raw response:", text)
-        return {}
-    
 
-def get_examples_for_user_and_friends(user_preferences, co_person_preferences, selected_activities) -> dict:
+# Category of the item each journey card slot asks for
+JOURNEY_CARD_CATEGORIES = {"morning": "music", "afternoon": "podcast", "night": "movies"}
+JOURNEY_DECKS_PER_ARCHETYPE = int(os.getenv("JOURNEY_DECKS_PER_ARCHETYPE", "5"))
+JOURNEY_DECK_MAX_USES = int(os.getenv("JOURNEY_DECK_MAX_USES", "3"))
+
+
+def journey_card_lookups(cards: dict):
+    """(slot, item, entity_type) for every card whose item can be resolved."""
+    lookups = []
+    for slot, category in JOURNEY_CARD_CATEGORIES.items():
+        card = cards.get(slot)
+        if isinstance(card, dict) and card.get("item"):
+            lookups.append((slot, card["item"], ENTITY_TYPE_MAP[category]))
+    return lookups
+
+
+def attach_entity_ids(cards: dict, lookups, entity_ids) -> dict:
+    """Add category and the resolved entity_id to each card, so the client can pass it back as entityId."""
+    for (slot, _, _), entity_id in zip(lookups, entity_ids):
+        cards[slot]["category"] = JOURNEY_CARD_CATEGORIES[slot]
+        cards[slot]["entity_id"] = entity_id
+    return cards
+
+
+def generate_journey_deck(community_type: str) -> dict:
+    """One set of morning/afternoon/night cards with every item resolved to a Qloo entity ID ({} if unparseable)."""
+    cards = get_opposite_community_journey_cards(community_type)
+    lookups = journey_card_lookups(cards)
+    if not lookups:
+        return cards
+    entity_ids = [result["entity_id"] for result in resolve_entity_ids((item, entity_type) for _, item, entity_type in lookups)]
+    return attach_entity_ids(cards, lookups, entity_ids)
+
+
+# Ready-made decks per source archetype. Each deck is shown JOURNEY_DECK_MAX_USES
+# times in rotation before it is retired and a fresh one is generated in the background.
+journey_deck_store = ExamplePool(
+    lambda community_type: [deck for deck in [generate_journey_deck(community_type)] if deck],
+    low_water=JOURNEY_DECKS_PER_ARCHETYPE,
+    max_uses=JOURNEY_DECK_MAX_USES,
+    workers=EXAMPLE_POOL_WORKERS
+)
+
+
+def get_journey_deck(community_type: str) -> dict:
+    """
+    Next journey card deck for the archetype, generating one inline only while
+    its store is empty. Unknown archetypes always get a fresh, unstored deck.
+    """
+    archetype = known_archetype(community_type)
+    if archetype is None:
+        return generate_journey_deck(community_type)
+
+    deck = journey_deck_store.pop(archetype)
+    if deck is None:
+        deck = generate_journey_deck(archetype)
+        if deck:
+            journey_deck_store.add(archetype, deck, uses=1)
+    return copy.deepcopy(deck)
+
+
+def friend_examples_prompt(user_preferences, co_person_preferences, selected_activities) -> str:
     
     if not selected_activities:
         raise ValueError("You must provide at least one selected activity.")
     
     activity = selected_activities[0]
 
-    prompt = f"""
+    return f"""
         You are a cultural recommendation assistant.
 
         The user's preferences are:
@@ -854,35 +1552,23 @@ def get_examples_for_user_and_friends(user_preferences, co_person_preferences, s
         ⚠️ Do not include markdown, explanation, or commentary. Just the JSON.
             """.strip()
 
-    response = model.generate_content(prompt)
-    text = response.text.strip()
-
-    # Remove any accidental markdown or formatting
-    if text.startswith("```json"):
-        text = text[len("```json"):].strip("`\n ")
-    elif text.startswith("```"):
-        text = text[3:].strip("`\n ")
 
+def get_examples_for_user_and_friends(user_preferences, co_person_preferences, selected_activities) -> dict:
+    prompt = friend_examples_prompt(user_preferences, co_person_preferences, selected_activities)
     try:
-        match = re.search(r"\{[\s\S]*\}", text)
-        if match:
-            json_text = match.group()
-            return json.loads(json_text)
-        else:
-            return json.loads(text)
+        text = gemini.generate_text("friend_examples", prompt)
     except Exception as e:
-        print("Failed to parse Gemini response as JSON:", e)
-        print("Raw response:", text)
+        print(f"Friend examples unavailable: {e}")
+        count_fallback("friend_examples")
         return {}
-    
-def enrich_recommendations_with_details(recommendations: list, category: str):
-    enriched_recommendations = []
-    
-    for item in recommendations:
-        name = item.get("name")
-        image = item.get("image")
-        
-        prompt = f"""
+    return parse_json_object_or_empty(text)
+
+def _is_valid_enrichment(details):
+    return isinstance(details, dict) and isinstance(details.get("summary"), str) and details["summary"].strip()
+
+
+def enrichment_prompt(name: str, category: str) -> str:
+    return f"""
         The user received a {category} recommendation titled: "{name}".
 
         Your task is to return valid JSON with:
@@ -898,49 +1584,151 @@ def enrich_recommendations_with_details(recommendations: list, category: str):
         }}
         """
 
+
+def enrichment_batch_prompt(names: list, category: str) -> str:
+    return f"""
+        The user received these {category} recommendations:
+        {json.dumps(names, indent=2)}
+
+        For EACH title, return:
+        - "name": the title exactly as given
+        - "summary": a short summary (within 2 lines)
+        - "rating": an appropriate rating ( e.g for movies from imdb, books from Goodreads)
+        - "cost": cost estimate ("Free", "Paid")
+
+        Return response strictly as a JSON array with one object per title, in the same order:
+        [
+          {{
+            "name": "Title",
+            "summary": "Brief description",
+            "rating": "4.2",
+            "cost": "$$"
+          }}
+        ]
+        """
+
+
+def parse_enrichment_batch(text: str, names: list) -> dict:
+    """Map a batched enrichment response back to {name: details}, dropping missing or malformed entries."""
+    entries = parse_json_block(text, pattern=r"\[[\s\S]*\]")
+    if isinstance(entries, dict):
+        # Accept {"Title": {...}} as well as a list
+        entries = [dict(details, name=title) for title, details in entries.items() if isinstance(details, dict)]
+    if not isinstance(entries, list):
+        raise ValueError("Batched enrichment response is not a list")
+
+    wanted = {str(name).strip().lower(): name for name in names}
+    details_by_name = {}
+    for entry in entries:
+        if not _is_valid_enrichment(entry):
+            continue
+        name = wanted.get(str(entry.get("name", "")).strip().lower())
+        if name is not None and name not in details_by_name:
+            details_by_name[name] = {key: entry[key] for key in ("summary", "rating", "cost") if key in entry}
+    return details_by_name
+
+
+def enriched_item(item: dict, details: dict = None) -> dict:
+    """Build one enriched recommendation, falling back to the default summary, rating and cost."""
+    if not details:
+        count_fallback("enrichment")
+    details = details or {}
+    return {
+        "name": item.get("name"),
+        "image": item.get("image"),
+        "summary": details.get("summary", "Great recommendation for you"),
+        "rating": details.get("rating", "4.0"),
+        "cost": details.get("cost", "$$")
+    }
+
+
+def enrich_single_recommendation(name: str, category: str) -> dict:
+    """Ask Gemini for summary, rating and cost of one item. Raises if the response can't be parsed."""
+    return gemini.generate_parsed(
+        "enrichment", enrichment_prompt(name, category), parse_json_block,
+        cache_args={"category": category, "name": name}
+    )
+
+
+def enrich_batch(names: list, category: str) -> dict:
+    """
+    Enrich several items with one Gemini call.
+    Returns {name: details} for the items that came back well-formed; the rest are left out.
+    """
+    return gemini.generate_parsed(
+        "enrichment_batch", enrichment_batch_prompt(names, category),
+        lambda text: parse_enrichment_batch(text, names)
+    )
+
+
+def run_enrichment_batch(category, names):
+    """Micro-batch runner: enrich the names of every waiting request in a category with one call, caching each."""
+    batch = enrich_batch(names, category)
+    for name, details in batch.items():
+        gemini.store("enrichment", {"category": category, "name": name}, details)
+    return batch
+
+
+enrichment_batcher = MicroBatcher(
+    run_enrichment_batch, window=GEMINI_BATCH_WINDOW, max_items=GEMINI_BATCH_MAX_ITEMS, name="enrichment"
+)
+
+
+def enrich_recommendations_with_details(recommendations: list, category: str):
+    """
+    Add summary, rating and cost to each recommendation. Cached items are reused,
+    the rest are enriched with one batched Gemini call shared with concurrent
+    requests for the same category, and only items missing or malformed in that
+    response fall back to a per-item call.
+    """
+    names = [item.get("name") for item in recommendations]
+    details_by_name = {}
+
+    uncached = []
+    for name in names:
+        cached = gemini.get_cached("enrichment", {"category": category, "name": name})
+        if cached is not MISSING:
+            details_by_name[name] = cached
+        elif name not in uncached:
+            uncached.append(name)
+
+    # Short of time, uncached items keep the default summary rather than wait on Gemini
+    enrich = affords(OPTIONAL_STAGE_MIN)
+    if uncached and not enrich:
+        degrade("enrichment", "deadline")
+
+    if uncached and enrich:
+        try:
+            for name, details in zip(uncached, enrichment_batcher.submit(category, uncached)):
+                if details is not MISSING:
+                    details_by_name[name] = copy.deepcopy(details)
+        except DeadlineExceeded:
+            # Out of time: the rest keep the default summary rather than each try Gemini on its own
+            enrich = False
+        except Exception as e:
+            print(f"Batched enrichment failed for {category}, falling back per item:", e)
+
+    enriched_recommendations = []
+    
+    for item in recommendations:
+        name = item.get("name")
+
         try:
-            response = model.generate_content(prompt)
-            text = response.text.strip()
-
-            if text.startswith("```json"):
-                text = text[len("```json"):].strip("`\n ")
-            elif text.startswith("```"):
-                text = text[3:].strip("`\n ")
-
-            match = re.search(r"\{[\s\S]*\}", text)
-            if match:
-                json_text = match.group()
-                details = json.loads(json_text)
-            else:
-                details = json.loads(text)
+            details = details_by_name.get(name)
+            if details is None and enrich:
+                details = enrich_single_recommendation(name, category)
+                details_by_name[name] = details
                 
-            enriched_recommendations.append({
-                "name": name,
-                "image": image,
-                "summary": details.get("summary", "Great recommendation for you"),
-                "rating": details.get("rating", "4.0"),
-                "cost": details.get("cost", "$$")
-            })
+            enriched_recommendations.append(enriched_item(item, details))
             
         except Exception as e:
             print(f"Failed to enrich {name}:", e)
-            enriched_recommendations.append({
-                "name": name,
-                "image": image,
-                "summary": "Great recommendation for you",
-                "rating": "4.0",
-                "cost": "$$"
-            })
+            enriched_recommendations.append(enriched_item(item))
     
     return enriched_recommendations
 
-def get_contrasting_examples(archetype):
-    """
-    Given a taste archetype, call Gemini API and return contrasting recommendations
-    across movie, podcast, book, music, and TV.
-    """
-
-    prompt = f"""
+def contrasting_examples_prompt(archetype):
+    return f"""
 You are a taste contrast engine. Your job is to recommend cultural content that **strongly contrasts**
 with the taste archetype provided. The contrast should be in tone, worldview, energy, or theme.
 
@@ -971,19 +1759,32 @@ Return ONLY valid JSON in this exact format — no explanations, markdown, or ex
 """
 
 
+@traced("parse")
+@counts_parse_failures
+def parse_contrasting_examples(text):
+    text = text.strip()
+
+    # Clean markdown formatting like ```json ... ```
+    cleaned = re.sub(r"^```json|^```|```$", "", text, flags=re.MULTILINE).strip()
+
     try:
-        response = model.generate_content(prompt)
-        text = response.text.strip()
+        return json.loads(cleaned)
+    except json.JSONDecodeError:
+        return {"raw_text": text, "error": "Failed to parse JSON"}
 
-        # Clean markdown formatting like ```json ... ```
-        cleaned = re.sub(r"^```json|^```|```$", "", text.strip(), flags=re.MULTILINE).strip()
 
-        try:
-            return json.loads(cleaned)
-        except json.JSONDecodeError:
-            return {"raw_text": text, "error": "Failed to parse JSON"}
+def get_contrasting_examples(archetype):
+    """
+    Given a taste archetype, call Gemini API and return contrasting recommendations
+    across movie, podcast, book, music, and TV.
+    """
+    try:
+        return parse_contrasting_examples(
+            gemini.generate_text("contrasting_examples", contrasting_examples_prompt(archetype))
+        )
 
     except Exception as e:
+        count_fallback("contrasting_examples")
         return {"error": str(e)}
 
 def map_examples_to_entity_ids(contrast_examples):
@@ -992,6 +1793,7 @@ def map_examples_to_entity_ids(contrast_examples):
     and returns a new dictionary mapping each category to its entity_id.
     """
     entity_ids = {}
+    lookups = []
 
     for category, example_name in contrast_examples.items():
         # Normalize category name to match ENTITY_TYPE_MAP keys
@@ -1001,11 +1803,14 @@ def map_examples_to_entity_ids(contrast_examples):
         if not entity_type:
             print(f"[Warning] Unknown category: {category}")
             continue
-        
-        # Call the entity lookup
-        entity_id = find_entity_id(example_name, entity_type)
-        if entity_id:
-            entity_ids[category] = entity_id
+
+        lookups.append((category, example_name, entity_type))
+
+    # Look up every category concurrently
+    results = resolve_entity_ids((example_name, entity_type) for _, example_name, entity_type in lookups)
+    for (category, example_name, _), result in zip(lookups, results):
+        if result["entity_id"]:
+            entity_ids[category] = result["entity_id"]
         else:
             print(f"[Info] No entity found for {example_name} under {category}")
     
@@ -1041,14 +1846,8 @@ def get_recommendations_from_entity_ids(entity_id_map, take=1):
 
     return recommendations
 
-def generate_descriptions_with_categories(title_category_list):
-    """
-    Uses Gemini to generate 2-line factual descriptions for each title in the list.
-    Returns a list of dicts with 'title', 'category', and 'description'.
-    """
-    
-
-    prompt = (
+def descriptions_with_categories_prompt(title_category_list):
+    return (
         "You are given a list of items, where each item is a dictionary with two fields:\n"
         "- 'title': the name of a movie, book, podcast, music artist, or similar item\n"
         "- 'category': the category it belongs to (e.g., 'movies', 'podcast', 'books', 'music')\n\n"
@@ -1076,23 +1875,126 @@ def generate_descriptions_with_categories(title_category_list):
         f"{json.dumps(title_category_list, indent=2)}"
     )
 
+
+def parse_descriptions_with_categories(text):
+    content = text.strip()
+
+    # Fix common Gemini mistakes if needed
+    if content.startswith("```json"):
+        content = content.replace("```json", "").replace("```", "").strip()
+
+    return json.loads(content)
+
+
+def descriptions_with_categories_fallback(title_category_list):
+    count_fallback("descriptions_with_categories")
+    return [
+        {
+            "category": item['category'],
+            "title": item['title'],
+            "description": "Description unavailable."
+        }
+        for item in title_category_list
+    ]
+
+
+def _description_key(title, category):
+    return str(title).strip().lower(), str(category).strip().lower()
+
+
+def descriptions_by_item(entries, items):
+    """Match parsed description entries to (title, category) items: {item: description}."""
+    wanted = {_description_key(title, category): (title, category) for title, category in items}
+    results = {}
+    for entry in entries if isinstance(entries, list) else []:
+        if not isinstance(entry, dict) or not isinstance(entry.get("description"), str):
+            continue
+        item = wanted.get(_description_key(entry.get("title", ""), entry.get("category", "")))
+        if item is not None:
+            results.setdefault(item, entry["description"])
+    return results
+
+
+def run_descriptions_batch(batch_key, items):
+    """Micro-batch runner: describe the (title, category) items of every waiting request with one call."""
+    title_category_list = [{"title": title, "category": category} for title, category in items]
+    text = gemini.generate_text(
+        "descriptions_with_categories_batch", descriptions_with_categories_prompt(title_category_list)
+    )
     try:
-        response = model.generate_content(prompt)
-        content = response.text.strip()
+        return descriptions_by_item(parse_descriptions_with_categories(text), items)
+    except ValueError as e:
+        count_parse_failure("descriptions_with_categories")
+        print(f"Batched descriptions could not be parsed: {e}")
+        return {}
+
 
-        # Fix common Gemini mistakes if needed
-        if content.startswith("```json"):
-            content = content.replace("```json", "").replace("```", "").strip()
+descriptions_batcher = MicroBatcher(
+    run_descriptions_batch, window=GEMINI_BATCH_WINDOW, max_items=GEMINI_BATCH_MAX_ITEMS,
+    name="descriptions_with_categories"
+)
 
-        return json.loads(content)
 
+def describe_items(title_category_list):
+    """One Gemini call for just these items: {(title, category): description}. Used for items a batch left out."""
+    items = [(item["title"], item["category"]) for item in title_category_list]
+    try:
+        entries = gemini.generate_parsed(
+            "descriptions_with_categories",
+            descriptions_with_categories_prompt(title_category_list),
+            parse_descriptions_with_categories,
+            cache_args={"items": title_category_list}
+        )
+        return descriptions_by_item(entries, items)
     except Exception as e:
         print(f"Gemini error: {e}")
-        return [
-            {
-                "category": item['category'],
-                "title": item['title'],
-                "description": "Description unavailable."
-            }
-            for item in title_category_list
-        ]
+        return {}
+
+
+def assemble_descriptions(title_category_list, descriptions):
+    """Build the response list in input order; items without a description get the fallback text."""
+    results = []
+    for item in title_category_list:
+        description = descriptions.get((item["title"], item["category"]))
+        if description is None:
+            count_fallback("descriptions_with_categories")
+            description = "Description unavailable."
+        results.append({"title": item["title"], "category": item["category"], "description": description})
+    return results
+
+
+def generate_descriptions_with_categories(title_category_list):
+    """
+    Uses Gemini to generate 2-line factual descriptions for each title in the list.
+    Returns a list of dicts with 'title', 'category', and 'description'. Titles
+    from concurrent requests are described together in one call; any the batch
+    left out get a call of their own.
+    """
+    if not title_category_list:
+        return []
+
+    cached = gemini.get_cached("descriptions_with_categories", {"items": title_category_list})
+    if cached is not MISSING:
+        return cached
+    if not affords(OPTIONAL_STAGE_MIN):
+        degrade("descriptions_with_categories", "deadline")
+        return descriptions_with_categories_fallback(title_category_list)
+
+    items = [(item["title"], item["category"]) for item in title_category_list]
+    try:
+        batched = descriptions_batcher.submit("descriptions", items)
+    except DeadlineExceeded:
+        return descriptions_with_categories_fallback(title_category_list)
+    except Exception as e:
+        print(f"Gemini error: {e}")
+        return descriptions_with_categories_fallback(title_category_list)
+
+    descriptions = {item: description for item, description in zip(items, batched) if description is not MISSING}
+    missing = [entry for entry, item in zip(title_category_list, items) if item not in descriptions]
+    if missing:
+        descriptions.update(describe_items(missing))
+
+    results = assemble_descriptions(title_category_list, descriptions)
+    if not missing:
+        gemini.store("descriptions_with_categories", {"items": title_category_list}, results)
+    return results
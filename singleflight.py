@@ -0,0 +1,98 @@
+import asyncio
+import threading
+
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+
+from deadline import DeadlineExceeded, degrade, time_left
+
+
+class SingleFlight:
+    """
+    Coalesces identical in-flight calls.
+
+    do(key, fn) runs fn() unless a call with the same key is already running,
+    in which case it waits for that call and returns its result (or raises its
+    exception). Nothing is remembered once the call finishes; caching is left to
+    the caller. do_async() is the asyncio counterpart; sync and async callers
+    keep separate in-flight tables.
+
+    A caller that joined another's call waits no longer than its own request's
+    deadline; it then notes `name` as degraded and raises DeadlineExceeded.
+    """
+
+    def __init__(self, name="upstream"):
+        self.name = name
+        self._calls = {}
+        self._async_calls = {}
+        self._lock = threading.Lock()
+        self.stats = {"calls": 0, "collapsed": 0}
+
+    def _expired(self):
+        degrade(self.name, "deadline")
+        return DeadlineExceeded(f"Request deadline passed while waiting on a shared {self.name} call")
+
+    def do(self, key, fn):
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = self._calls[key] = Future()
+                self.stats["calls"] += 1
+            else:
+                self.stats["collapsed"] += 1
+
+        if not leader:
+            try:
+                return future.result(timeout=time_left())
+            except FutureTimeout:
+                raise self._expired() from None
+
+        try:
+            result = fn()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+    async def do_async(self, key, fn):
+        """
+        fn is a coroutine function. The shared call runs as a task of its own,
+        so cancelling any caller, including the one that started it, leaves it
+        running for the others.
+        """
+        with self._lock:
+            task = self._async_calls.get(key)
+            if task is None:
+                task = self._async_calls[key] = asyncio.ensure_future(fn())
+                task.add_done_callback(lambda done: self._finished(key, done))
+                self.stats["calls"] += 1
+            else:
+                self.stats["collapsed"] += 1
+
+        try:
+            return await asyncio.wait_for(asyncio.shield(task), time_left())
+        except asyncio.TimeoutError:
+            if task.done():
+                raise
+            raise self._expired() from None
+
+    def _finished(self, key, task):
+        with self._lock:
+            if self._async_calls.get(key) is task:
+                del self._async_calls[key]
+        if not task.cancelled():
+            # Retrieve it here so an error nobody waited on isn't logged as unhandled
+            task.exception()
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self.stats)
+            stats["in_flight"] = len(self._calls) + len(self._async_calls)
+        total = stats["calls"] + stats["collapsed"]
+        stats["collapsed_ratio"] = round(stats["collapsed"] / total, 4) if total else 0.0
+        return stats
@@ -0,0 +1,26 @@
+import json
+
+NDJSON_MIMETYPE = "application/x-ndjson"
+SSE_MIMETYPE = "text/event-stream"
+
+# Stop proxies (nginx, Render's edge) from buffering the stream until it ends
+STREAM_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+# SSE comment frame sent on idle streams so proxies don't drop them
+SSE_KEEPALIVE = ": ping\n\n"
+
+
+def wants_sse(accept_header):
+    """Server-Sent Events when the client asks for text/event-stream, NDJSON otherwise."""
+    return SSE_MIMETYPE in (accept_header or "")
+
+
+def stream_mimetype(sse):
+    return SSE_MIMETYPE if sse else NDJSON_MIMETYPE
+
+
+def format_event(event, data, sse=False):
+    """Encode one event as an SSE frame or as an NDJSON line of {"event": ..., "data": ...}."""
+    if sse:
+        return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+    return json.dumps({"event": event, "data": data}) + "\n"
+
@@ -0,0 +1,31 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Importing the apps must not start pool warming against the real upstreams or write the entity cache to disk
+os.environ.setdefault("WARM_EXAMPLE_POOLS", "0")
+os.environ.setdefault("ENTITY_CACHE_PATH", "")
+
+
+class FakeClock:
+    """Stands in for the `time` module of the code under test; only moves when advance() is called."""
+
+    def __init__(self, start=1000.0):
+        self.now = start
+
+    def time(self):
+        return self.now
+
+    def monotonic(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
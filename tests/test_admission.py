@@ -0,0 +1,165 @@
+import pytest
+
+from google.api_core import exceptions as google_exceptions
+
+import admission
+from admission import PRIORITY_BACKGROUND, PRIORITY_INTERACTIVE, GeminiOverloaded, GeminiScheduler
+
+
+@pytest.fixture
+def scheduler(clock, monkeypatch):
+    """One token a second, a burst of two, and no dispatcher thread: tests call _grant() themselves."""
+    monkeypatch.setattr(admission, "time", clock)
+    monkeypatch.setattr(admission.random, "uniform", lambda low, high: 1.0)
+    scheduler = GeminiScheduler(rate_per_minute=60, burst=2,
+                                queue_limits={PRIORITY_INTERACTIVE: 3, PRIORITY_BACKGROUND: 2})
+    scheduler._dispatcher = "stopped"
+    return scheduler
+
+
+def drain(scheduler):
+    for _ in range(scheduler.burst):
+        scheduler.acquire(PRIORITY_INTERACTIVE)
+
+
+def enqueue(scheduler, level, deadline):
+    with scheduler._cond:
+        return scheduler._enqueue(level, deadline)
+
+
+def grant(scheduler, clock):
+    with scheduler._cond:
+        scheduler._grant(clock.now)
+
+
+def test_burst_is_admitted_without_queueing(scheduler):
+    drain(scheduler)
+    stats = scheduler.get_stats()
+    assert stats["admitted"] == 2
+    assert stats["queued"] == 0
+
+
+def test_interactive_goes_ahead_of_background(scheduler, clock):
+    drain(scheduler)
+    first = enqueue(scheduler, PRIORITY_BACKGROUND, clock.now + 60)
+    second = enqueue(scheduler, PRIORITY_BACKGROUND, clock.now + 60)
+    interactive = enqueue(scheduler, PRIORITY_INTERACTIVE, clock.now + 8)
+
+    order = []
+    for _ in range(3):
+        clock.advance(1)
+        grant(scheduler, clock)
+        order.extend(waiter for waiter in (first, second, interactive) if waiter.granted and waiter not in order)
+    assert order == [interactive, first, second]
+
+
+def test_shed_when_expected_wait_runs_past_deadline(scheduler, clock):
+    drain(scheduler)
+    with pytest.raises(GeminiOverloaded):
+        scheduler.acquire(PRIORITY_INTERACTIVE, deadline=clock.now + 0.5)
+
+    assert enqueue(scheduler, PRIORITY_INTERACTIVE, clock.now + 1.5) is not None
+    # Now second in line, so two seconds out
+    with pytest.raises(GeminiOverloaded):
+        enqueue(scheduler, PRIORITY_INTERACTIVE, clock.now + 1.5)
+    assert scheduler.get_stats()["shed_deadline"] == 2
+
+
+def test_shed_from_queue_once_deadline_passes(scheduler, clock):
+    drain(scheduler)
+    waiter = enqueue(scheduler, PRIORITY_INTERACTIVE, clock.now + 1.5)
+    clock.advance(2)
+    grant(scheduler, clock)
+
+    assert waiter.cancelled and not waiter.granted
+    with pytest.raises(GeminiOverloaded):
+        scheduler._finish_wait(waiter)
+    stats = scheduler.get_stats()
+    assert stats["shed_deadline"] == 1
+    assert stats["queued_now"] == {"interactive": 0, "background": 0}
+    # The token it would have taken is still there
+    assert stats["tokens"] == 2
+
+
+def test_shed_when_queue_is_full(scheduler, clock):
+    drain(scheduler)
+    for _ in range(2):
+        enqueue(scheduler, PRIORITY_BACKGROUND, clock.now + 60)
+    with pytest.raises(GeminiOverloaded):
+        enqueue(scheduler, PRIORITY_BACKGROUND, clock.now + 60)
+    assert scheduler.get_stats()["shed_queue_full"] == 1
+    # Interactive calls have a queue of their own
+    assert enqueue(scheduler, PRIORITY_INTERACTIVE, clock.now + 8) is not None
+
+
+def test_429_halves_rate_and_pauses(scheduler, clock):
+    sent_at = clock.now
+    clock.advance(0.1)
+    scheduler._throttled(sent_at)
+
+    stats = scheduler.get_stats()
+    assert stats["rate_per_minute"] == 30
+    assert stats["tokens"] == 0
+    assert stats["paused_for"] == 0.5
+
+    waiter = enqueue(scheduler, PRIORITY_INTERACTIVE, clock.now + 8)
+    clock.advance(2.4)
+    grant(scheduler, clock)
+    # Nothing accrues during the 0.5s pause, then one token every two seconds
+    assert not waiter.granted
+    clock.advance(0.1)
+    grant(scheduler, clock)
+    assert waiter.granted
+
+
+def test_429s_from_calls_sent_before_backoff_back_off_once(scheduler, clock):
+    sent_at = clock.now
+    clock.advance(0.1)
+    scheduler._throttled(sent_at)
+    clock.advance(0.1)
+    scheduler._throttled(sent_at)
+    assert scheduler.get_stats()["throttled"] == 2
+    assert scheduler.rate == scheduler.max_rate / 2
+    assert scheduler.consecutive_throttles == 1
+
+    # A call sent after the backoff began that still gets a 429 doubles the pause
+    clock.advance(1)
+    scheduler._throttled(clock.now)
+    assert scheduler.rate == scheduler.max_rate / 4
+    assert scheduler.paused_until == clock.now + 1.0
+
+
+def test_rate_recovers_with_successes(scheduler):
+    for _ in range(5):
+        scheduler._throttled(scheduler._throttled_at)
+    assert scheduler.rate == scheduler.min_rate
+
+    successes = 0
+    while scheduler.rate < scheduler.max_rate:
+        scheduler._succeeded()
+        successes += 1
+    assert successes == 18
+    assert scheduler.rate == scheduler.max_rate
+    assert scheduler.consecutive_throttles == 0
+
+
+def test_call_raises_429_once_retries_are_used_up(scheduler):
+    scheduler.throttle_retries = 0
+
+    def fn():
+        raise google_exceptions.ResourceExhausted("quota")
+
+    with pytest.raises(google_exceptions.ResourceExhausted):
+        scheduler.call(fn)
+    stats = scheduler.get_stats()
+    assert stats["throttled"] == 1
+    assert stats["retried"] == 0
+    assert stats["rate_per_minute"] == 30
+
+
+def test_throttled_call_is_retried_up_to_the_limit(scheduler, clock):
+    assert scheduler._retry_throttled(0, clock.now)
+    assert not scheduler._retry_throttled(1, clock.now)
+    stats = scheduler.get_stats()
+    assert stats["throttled"] == 2
+    assert stats["retried"] == 1
@@ -0,0 +1,222 @@
+import asyncio
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from admission import PRIORITY_BACKGROUND, PRIORITY_INTERACTIVE, current_priority, priority
+from batching import MicroBatcher
+from cache import MISSING
+from deadline import Deadline, DeadlineExceeded, current_deadline, end_deadline, start_deadline, within
+from tracing import current_trace, end_trace, mark, start_trace
+
+
+class Recorder:
+    """run_batch for tests: doubles every item except those in `skip`, and records each batch it ran."""
+
+    def __init__(self, skip=(), delay=0):
+        self.skip = set(skip)
+        self.delay = delay
+        self.batches = []
+
+    def __call__(self, batch_key, items):
+        self.batches.append((batch_key, sorted(items)))
+        time.sleep(self.delay)
+        return {item: item * 2 for item in items if item not in self.skip}
+
+
+def submit_all(batcher, calls):
+    """Submit each (batch_key, items) from its own thread at once; results (or exceptions) in order."""
+    def submit(call):
+        try:
+            return batcher.submit(*call)
+        except Exception as e:
+            return e
+
+    with ThreadPoolExecutor(max_workers=len(calls)) as pool:
+        return list(pool.map(submit, calls))
+
+
+def test_calls_within_the_window_share_one_batch():
+    run_batch = Recorder()
+    batcher = MicroBatcher(run_batch, window=0.1)
+
+    results = submit_all(batcher, [("movies", [1, 2]), ("movies", [2, 3]), ("movies", [4])])
+
+    assert results == [[2, 4], [4, 6], [8]]
+    assert run_batch.batches == [("movies", [1, 2, 3, 4])]
+    stats = batcher.get_stats()
+    assert stats["batches"] == 1
+    assert stats["calls_saved"] == 2
+    assert stats["open_batches"] == 0
+
+
+def test_batch_keys_are_batched_separately():
+    run_batch = Recorder()
+    batcher = MicroBatcher(run_batch, window=0.05)
+
+    assert submit_all(batcher, [("movies", [1]), ("books", [1])]) == [[2], [2]]
+    assert sorted(run_batch.batches) == [("books", [1]), ("movies", [1])]
+
+
+def test_calls_after_the_window_start_a_new_batch():
+    run_batch = Recorder()
+    batcher = MicroBatcher(run_batch, window=0.01)
+
+    assert batcher.submit("movies", [1]) == [2]
+    assert batcher.submit("movies", [1]) == [2]
+    assert len(run_batch.batches) == 2
+
+
+def test_full_batch_runs_without_waiting_out_the_window():
+    run_batch = Recorder()
+    batcher = MicroBatcher(run_batch, window=5, max_items=3)
+
+    started = time.monotonic()
+    results = submit_all(batcher, [("movies", [1, 2]), ("movies", [3])])
+
+    assert time.monotonic() - started < 1
+    assert results == [[2, 4], [6]]
+    assert batcher.get_stats()["max_batch_items"] == 3
+
+
+def test_items_left_out_of_the_batch_come_back_missing():
+    batcher = MicroBatcher(Recorder(skip={2}), window=0.01)
+    assert batcher.submit("movies", [1, 2, 3]) == [2, MISSING, 6]
+
+
+def test_batch_error_reaches_every_caller():
+    def run_batch(batch_key, items):
+        raise RuntimeError("gemini down")
+
+    batcher = MicroBatcher(run_batch, window=0.05)
+    results = submit_all(batcher, [("movies", [1]), ("movies", [2])])
+    assert all(isinstance(result, RuntimeError) for result in results)
+
+
+def test_caller_past_its_deadline_gives_up_while_the_batch_runs_on():
+    run_batch = Recorder(delay=0.2)
+    batcher = MicroBatcher(run_batch, window=0.01, name="enrichment")
+    release = threading.Event()
+
+    def patient():
+        release.wait(5)
+        return batcher.submit("movies", [2])
+
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        other = pool.submit(patient)
+        deadline, token = start_deadline(0.05)
+        try:
+            release.set()
+            with pytest.raises(DeadlineExceeded):
+                batcher.submit("movies", [1])
+            assert deadline.degraded() == [{"part": "enrichment", "reason": "deadline"}]
+        finally:
+            end_deadline(token)
+        assert other.result() == [4]
+
+    assert batcher.get_stats()["expired_waits"] == 1
+
+
+def test_batch_runs_under_the_latest_deadline_and_highest_priority():
+    seen = {}
+
+    def run_batch(batch_key, items):
+        seen["remaining"] = current_deadline().remaining()
+        seen["priority"] = current_priority()
+        return {item: item for item in items}
+
+    batcher = MicroBatcher(run_batch, window=0.05)
+
+    def submit(budget, level):
+        with within(Deadline(budget)), priority(level):
+            return batcher.submit("movies", [budget])
+
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        short = pool.submit(submit, 1, PRIORITY_BACKGROUND)
+        long = pool.submit(submit, 10, PRIORITY_INTERACTIVE)
+        assert short.result() == [1]
+        assert long.result() == [10]
+
+    assert 5 < seen["remaining"] <= 10
+    assert seen["priority"] == PRIORITY_INTERACTIVE
+
+
+def test_batch_without_a_deadline_for_some_caller_runs_without_one():
+    seen = []
+
+    def run_batch(batch_key, items):
+        seen.append(current_deadline())
+        return {}
+
+    batcher = MicroBatcher(run_batch, window=0.05)
+
+    def submit(budget):
+        with within(Deadline(budget) if budget else None):
+            return batcher.submit("movies", [budget])
+
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        list(pool.map(submit, [1, None]))
+    assert seen == [None]
+
+
+def test_batch_spans_are_recorded_in_every_callers_trace():
+    def run_batch(batch_key, items):
+        mark("gemini-call")
+        return {item: item for item in items}
+
+    batcher = MicroBatcher(run_batch, window=0.05)
+
+    def submit(item):
+        trace, token = start_trace()
+        try:
+            batcher.submit("movies", [item])
+            return [span["name"] for span in trace.waterfall()]
+        finally:
+            end_trace(token)
+
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        for names in pool.map(submit, [1, 2]):
+            assert "gemini-call" in names
+    assert current_trace() is None
+
+
+def test_async_calls_share_one_batch():
+    batches = []
+
+    async def run_batch(batch_key, items):
+        batches.append(sorted(items))
+        await asyncio.sleep(0)
+        return {item: item * 2 for item in items if item != 3}
+
+    batcher = MicroBatcher(run_batch, window=0.02)
+
+    async def run():
+        return await asyncio.gather(
+            batcher.submit_async("movies", [1, 2]), batcher.submit_async("movies", [3])
+        )
+
+    assert asyncio.run(run()) == [[2, 4], [MISSING]]
+    assert batches == [[1, 2, 3]]
+
+
+def test_async_caller_past_its_deadline_gives_up():
+    async def run_batch(batch_key, items):
+        await asyncio.sleep(0.2)
+        return {item: item for item in items}
+
+    batcher = MicroBatcher(run_batch, window=0.01, name="group_description")
+
+    async def late():
+        with within(Deadline(0.05)):
+            with pytest.raises(DeadlineExceeded):
+                await batcher.submit_async("groups", [1])
+
+    async def run():
+        _, result = await asyncio.gather(late(), batcher.submit_async("groups", [2]))
+        return result
+
+    assert asyncio.run(run()) == [2]
+    assert batcher.get_stats()["expired_waits"] == 1
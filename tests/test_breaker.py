@@ -0,0 +1,158 @@
+import json
+
+import pytest
+
+from google.api_core import exceptions as google_exceptions
+
+import breaker
+import cache
+from admission import GeminiScheduler
+from bench.fakes import Faults, FakeGeminiModel
+from breaker import CLOSED, HALF_OPEN, OPEN, CircuitBreaker, CircuitOpen
+from cache import ResponseCache
+from gemini_client import GeminiClient, is_gemini_failure
+
+PROMPT = 'Give two examples in the category "movies". {"recommendations": ["example1", "example2"]}'
+DETAILS_PROMPT = 'You are a structured knowledge assistant. The title is:\n        "Heat"'
+
+
+@pytest.fixture
+def gemini(clock, monkeypatch):
+    """A GeminiClient on the bench's fake model, with its own breaker driven by the fake clock."""
+    monkeypatch.setattr(breaker, "time", clock)
+    monkeypatch.setattr(cache, "time", clock)
+    model = FakeGeminiModel(Faults(error_rate=1.0, seed=1), seed=1)
+    circuit = CircuitBreaker("gemini-test", window=4, min_calls=4, error_rate=0.5, open_for=15,
+                             is_failure=is_gemini_failure)
+    return GeminiClient(model, scheduler=GeminiScheduler(rate_per_minute=60000, burst=100), breaker=circuit)
+
+
+def fail(client, times):
+    for _ in range(times):
+        with pytest.raises(google_exceptions.ServiceUnavailable):
+            client.generate_text("single_example", PROMPT)
+
+
+def test_opens_on_error_rate(gemini):
+    fail(gemini, 3)
+    assert gemini.breaker.state == CLOSED
+
+    fail(gemini, 1)
+    assert gemini.breaker.state == OPEN
+
+    with pytest.raises(CircuitOpen):
+        gemini.generate_text("single_example", PROMPT)
+    assert gemini.model.calls.snapshot()["error"] == 4
+    assert gemini.breaker.get_stats()["rejected"] == 1
+
+
+def test_stays_closed_below_error_rate(gemini):
+    fail(gemini, 1)
+    gemini.model.faults.error_rate = 0.0
+    for _ in range(5):
+        gemini.generate_text("single_example", PROMPT)
+    assert gemini.breaker.state == CLOSED
+
+
+def test_half_open_probe_that_succeeds_closes(gemini, clock):
+    fail(gemini, 4)
+    clock.advance(14)
+    assert gemini.breaker.state == OPEN
+
+    clock.advance(1)
+    assert gemini.breaker.state == HALF_OPEN
+    gemini.model.faults.error_rate = 0.0
+    assert json.loads(gemini.generate_text("single_example", PROMPT))["recommendations"]
+    assert gemini.breaker.state == CLOSED
+    assert gemini.breaker.get_stats()["probes"] == 1
+
+
+def test_only_one_probe_at_a_time(clock, monkeypatch):
+    monkeypatch.setattr(breaker, "time", clock)
+    circuit = CircuitBreaker("probe-test", window=2, min_calls=2, open_for=15)
+    for _ in range(2):
+        with pytest.raises(ValueError), circuit.guard():
+            raise ValueError("upstream down")
+    clock.advance(15)
+
+    with circuit.guard():
+        with pytest.raises(CircuitOpen):
+            circuit.check()
+        with pytest.raises(CircuitOpen), circuit.guard():
+            pass
+    assert circuit.state == CLOSED
+
+
+def test_half_open_probe_that_fails_reopens(gemini, clock):
+    fail(gemini, 4)
+    clock.advance(15)
+    assert gemini.breaker.state == HALF_OPEN
+
+    fail(gemini, 1)
+    assert gemini.breaker.state == OPEN
+    assert gemini.breaker.get_stats()["opened"] == 2
+    with pytest.raises(CircuitOpen):
+        gemini.generate_text("single_example", PROMPT)
+
+    # The open period starts over from the failed probe
+    clock.advance(14)
+    assert gemini.breaker.state == OPEN
+    clock.advance(1)
+    assert gemini.breaker.state == HALF_OPEN
+
+
+def test_slow_probe_reopens(clock, monkeypatch):
+    monkeypatch.setattr(breaker, "time", clock)
+    circuit = CircuitBreaker("slow-test", window=2, min_calls=2, slow_call=5, open_for=15)
+    for _ in range(2):
+        with pytest.raises(ValueError), circuit.guard():
+            raise ValueError("upstream down")
+    clock.advance(15)
+
+    with circuit.guard():
+        clock.advance(5)
+    assert circuit.state == OPEN
+
+
+def test_serves_last_good_gemini_result_while_open(gemini, clock):
+    gemini.model.faults.error_rate = 0.0
+    details = gemini.generate_parsed("item_details", DETAILS_PROMPT, json.loads, cache_args={"title": "Heat"})
+    assert details["name"] == "Heat"
+
+    # Past its TTL the result is no longer served while the circuit is closed
+    clock.advance(8 * 24 * 3600)
+    gemini.model.faults.error_rate = 1.0
+    with pytest.raises(google_exceptions.ServiceUnavailable):
+        gemini.generate_parsed("item_details", DETAILS_PROMPT, json.loads, cache_args={"title": "Heat"})
+    fail(gemini, 2)
+    assert gemini.breaker.state == OPEN
+
+    assert gemini.generate_parsed("item_details", DETAILS_PROMPT, json.loads, cache_args={"title": "Heat"}) == details
+    with pytest.raises(CircuitOpen):
+        gemini.generate_parsed("item_details", DETAILS_PROMPT, json.loads, cache_args={"title": "Alien"})
+
+
+def test_response_cache_serves_last_good_while_open(clock, monkeypatch):
+    monkeypatch.setattr(breaker, "time", clock)
+    monkeypatch.setattr(cache, "time", clock)
+    circuit = CircuitBreaker("qloo-test", window=2, min_calls=2, open_for=15)
+    responses = ResponseCache(ttl=10, stale_ttl=20)
+
+    def fetch(value):
+        def call():
+            with circuit.guard():
+                if value is None:
+                    raise ConnectionError("upstream down")
+                return value
+        return call
+
+    assert responses.get_or_fetch("k", fetch({"results": [1]})) == {"results": [1]}
+    clock.advance(31)
+    with pytest.raises(ConnectionError):
+        responses.get_or_fetch("k", fetch(None))
+    assert circuit.state == OPEN
+
+    assert responses.get_or_fetch("k", fetch(None)) == {"results": [1]}
+    assert responses.get_stats()["last_good_hits"] == 1
+    with pytest.raises(CircuitOpen):
+        responses.get_or_fetch("other", fetch(None))
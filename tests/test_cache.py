@@ -0,0 +1,234 @@
+import asyncio
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import cache
+from breaker import CircuitOpen
+from cache import MISSING, EntityIdCache, ResponseCache
+
+
+@pytest.fixture(autouse=True)
+def fake_time(clock, monkeypatch):
+    monkeypatch.setattr(cache, "time", clock)
+
+
+# ---------- EntityIdCache ----------
+
+def test_negative_lookup_expires_after_negative_ttl(clock):
+    entities = EntityIdCache(None, ttl=3600, negative_ttl=60)
+    entities.set("Unknown Band", "urn:entity:artist", None)
+
+    assert entities.get("unknown  band", "urn:entity:artist") is None
+    assert entities.get_stats()["negative_hits"] == 1
+
+    clock.advance(60)
+    assert entities.get("Unknown Band", "urn:entity:artist") is MISSING
+    assert entities.get_stats()["misses"] == 1
+
+
+def test_found_lookup_outlives_negative_ttl(clock):
+    entities = EntityIdCache(None, ttl=3600, negative_ttl=60)
+    entities.set("Radiohead", "urn:entity:artist", "A1")
+    clock.advance(61)
+    assert entities.get("Radiohead", "urn:entity:artist") == "A1"
+
+
+def test_negative_lookup_is_stored_on_disk(clock, tmp_path):
+    path = str(tmp_path / "entities.sqlite3")
+    EntityIdCache(path, ttl=3600, negative_ttl=60).set("Unknown Band", "urn:entity:artist", None)
+
+    restarted = EntityIdCache(path, ttl=3600, negative_ttl=60)
+    assert restarted.get("Unknown Band", "urn:entity:artist") is None
+    assert restarted.get_stats()["negative_hits"] == 1
+    clock.advance(60)
+    assert restarted.get("Unknown Band", "urn:entity:artist") is MISSING
+
+
+def test_disk_hit_is_promoted_with_remaining_lifetime(clock, tmp_path):
+    path = str(tmp_path / "entities.sqlite3")
+    EntityIdCache(path, ttl=100).set("Radiohead", "urn:entity:artist", "A1")
+
+    clock.advance(60)
+    restarted = EntityIdCache(path, ttl=100)
+    assert restarted.get("Radiohead", "urn:entity:artist") == "A1"
+    assert restarted.get("Radiohead", "urn:entity:artist") == "A1"
+    stats = restarted.get_stats()
+    assert stats["disk_hits"] == 1
+    assert stats["memory_hits"] == 1
+
+    # The memory copy expires with the disk row, not a full ttl after promotion
+    clock.advance(40)
+    assert restarted.get("Radiohead", "urn:entity:artist", disk=False) is MISSING
+    assert restarted.get("Radiohead", "urn:entity:artist") is MISSING
+
+
+def test_get_async_reads_disk_and_set_async_writes_it(tmp_path):
+    path = str(tmp_path / "entities.sqlite3")
+
+    async def run():
+        entities = EntityIdCache(path)
+        await entities.set_async("Dune", "urn:entity:book", "B1")
+        return await EntityIdCache(path).get_async("Dune", "urn:entity:book")
+
+    assert asyncio.run(run()) == "B1"
+
+
+# ---------- ResponseCache ----------
+
+def test_evicts_least_recently_used_past_byte_budget():
+    responses = ResponseCache(max_bytes=100)
+    value = "x" * 28  # 30 bytes as JSON
+    for key in ("a", "b", "c"):
+        responses.set(key, value)
+    assert responses.get("a") is not MISSING
+
+    responses.set("d", value)
+    assert responses.get("b") is MISSING
+    for key in ("a", "c", "d"):
+        assert responses.get(key) is not MISSING
+    stats = responses.get_stats()
+    assert stats["evictions"] == 1
+    assert stats["bytes"] == 90
+
+
+def test_replacing_an_entry_frees_its_bytes():
+    responses = ResponseCache(max_bytes=100)
+    responses.set("a", "x" * 48)
+    responses.set("a", "x" * 8)
+    assert responses.get_stats()["bytes"] == 10
+
+
+def test_value_larger_than_budget_is_not_cached():
+    responses = ResponseCache(max_bytes=10)
+    responses.set("a", "x" * 20)
+    assert responses.get("a") is MISSING
+    assert responses.get_stats()["evictions"] == 0
+
+
+def test_stale_hits_start_a_single_refresh(clock):
+    responses = ResponseCache(ttl=10, stale_ttl=100)
+    responses.set("k", "old")
+    clock.advance(11)
+
+    release = threading.Event()
+    fetches = []
+
+    def fetch():
+        fetches.append(1)
+        release.wait(5)
+        return "new"
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        served = list(pool.map(lambda _: responses.get_or_fetch("k", fetch), range(8)))
+    assert served == ["old"] * 8
+
+    release.set()
+    for _ in range(100):
+        if responses.get_stats()["refreshes"]:
+            break
+        time.sleep(0.01)
+
+    assert len(fetches) == 1
+    stats = responses.get_stats()
+    assert stats["stale_hits"] == 8
+    assert stats["refreshes"] == 1
+    assert responses.get("k") == ("new", False)
+
+
+def test_stale_hits_start_a_single_async_refresh(clock):
+    responses = ResponseCache(ttl=10, stale_ttl=100)
+    responses.set("k", "old")
+    clock.advance(11)
+    fetches = []
+
+    async def run():
+        release = asyncio.Event()
+
+        async def fetch():
+            fetches.append(1)
+            await release.wait()
+            return "new"
+
+        served = await asyncio.gather(*(responses.get_or_fetch_async("k", fetch) for _ in range(8)))
+        release.set()
+        while not responses.get_stats()["refreshes"]:
+            await asyncio.sleep(0)
+        return served
+
+    assert asyncio.run(run()) == ["old"] * 8
+    assert len(fetches) == 1
+    assert responses.get("k") == ("new", False)
+
+
+def test_entry_past_stale_window_is_fetched_inline(clock):
+    responses = ResponseCache(ttl=10, stale_ttl=100)
+    responses.set("k", "old")
+    clock.advance(110)
+    assert responses.get_or_fetch("k", lambda: "new") == "new"
+    assert responses.get_stats()["misses"] == 1
+
+
+def test_failed_refresh_keeps_serving_stale_value(clock):
+    responses = ResponseCache(ttl=10, stale_ttl=100)
+    responses.set("k", "old")
+    clock.advance(11)
+
+    def fetch():
+        raise RuntimeError("upstream down")
+
+    assert responses.get_or_fetch("k", fetch) == "old"
+    for _ in range(100):
+        if responses.get_stats()["refresh_errors"]:
+            break
+        time.sleep(0.01)
+
+    assert responses.get_stats()["refresh_errors"] == 1
+    assert responses.get("k") == ("old", True)
+
+
+def _circuit_open():
+    raise CircuitOpen("qloo circuit is open")
+
+
+def test_open_circuit_serves_last_good_value_past_stale_window(clock):
+    responses = ResponseCache(ttl=10, stale_ttl=100)
+    responses.set("k", "old")
+    clock.advance(1000)
+
+    assert responses.get_or_fetch("k", _circuit_open) == "old"
+    assert responses.get_stats()["last_good_hits"] == 1
+    # Nothing new was stored, so the entry is still past its stale window
+    assert responses.get("k") is MISSING
+
+
+def test_open_circuit_without_last_good_value_raises():
+    with pytest.raises(CircuitOpen):
+        ResponseCache().get_or_fetch("k", _circuit_open)
+
+
+def test_other_fetch_errors_do_not_fall_back_to_last_good(clock):
+    responses = ResponseCache(ttl=10, stale_ttl=100)
+    responses.set("k", "old")
+    clock.advance(1000)
+
+    def fetch():
+        raise RuntimeError("bad response")
+
+    with pytest.raises(RuntimeError):
+        responses.get_or_fetch("k", fetch)
+    assert responses.get_stats()["last_good_hits"] == 0
+
+
+def test_open_circuit_serves_last_good_value_async(clock):
+    responses = ResponseCache(ttl=10, stale_ttl=100)
+    responses.set("k", "old")
+    clock.advance(1000)
+
+    async def fetch():
+        _circuit_open()
+
+    assert asyncio.run(responses.get_or_fetch_async("k", fetch)) == "old"
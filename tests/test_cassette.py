@@ -0,0 +1,106 @@
+import asyncio
+
+import httpx
+import pytest
+import requests
+
+from bench.fakes import Faults, FakeGeminiModel, FakeQloo
+from cassette import (
+    AsyncCassetteTransport, Cassette, CassetteAdapter, CassetteMiss, CassetteModel, ReplayedError, qloo_key
+)
+
+PROMPT = 'Give two examples in the category "movies". {"recommendations": ["example1", "example2"]}'
+
+
+@pytest.fixture
+def qloo():
+    fake = FakeQloo(seed=1)
+    fake.start()
+    yield fake
+    fake.stop()
+
+
+def session_for(cassette):
+    session = requests.Session()
+    session.mount("http://", CassetteAdapter(cassette))
+    return session
+
+
+def test_qloo_key_ignores_query_order_and_host():
+    assert qloo_key("GET", "http://127.0.0.1:8000/search?b=2&a=1") == qloo_key("GET", "https://qloo/search?a=1&b=2")
+
+
+def test_record_then_replay_round_trip(qloo, tmp_path):
+    path = str(tmp_path / "upstream.cassette.jsonl.gz")
+    params = {"query": "Heat", "filter.type": "urn:entity:movie"}
+
+    recorder = Cassette(path, "record")
+    recorder.record_inbound("POST", "/get-item-details", {"name": "Heat"})
+    recorded_search = session_for(recorder).get(f"{qloo.url}/search", params=params)
+    model = CassetteModel(FakeGeminiModel(seed=1), recorder)
+    recorded_text = model.generate_content(PROMPT).text
+    recorder.close()
+    assert recorder.get_stats()["recorded"] == 3
+    calls = qloo.calls.snapshot()
+
+    player = Cassette(path, "replay", time_scale=0)
+    replayed_search = session_for(player).get(f"{qloo.url}/search", params=dict(reversed(params.items())))
+    replayed_text = CassetteModel(FakeGeminiModel(seed=2), player).generate_content(PROMPT).text
+
+    assert replayed_search.status_code == recorded_search.status_code
+    assert replayed_search.json() == recorded_search.json()
+    assert replayed_text == recorded_text
+    assert player.inbound_requests() == [("POST", "/get-item-details", {"name": "Heat"})]
+    # Nothing reached the upstream on replay
+    assert qloo.calls.snapshot() == calls
+    assert player.get_stats()["replayed_by_operation"] == {"qloo": {"search": 1}, "gemini": {"generate_content": 1}}
+
+
+def test_async_replay_serves_what_the_sync_client_recorded(qloo, tmp_path):
+    path = str(tmp_path / "upstream.cassette.jsonl.gz")
+    recorder = Cassette(path, "record")
+    recorded = session_for(recorder).get(f"{qloo.url}/search", params={"query": "Dune"}).json()
+    recorder.close()
+
+    player = Cassette(path, "replay", time_scale=0)
+
+    async def replay():
+        transport = AsyncCassetteTransport(player, httpx.AsyncHTTPTransport())
+        async with httpx.AsyncClient(base_url=qloo.url, transport=transport) as client:
+            return (await client.get("/search", params={"query": "Dune"})).json()
+
+    assert asyncio.run(replay()) == recorded
+
+
+def test_exchanges_with_one_key_replay_in_order_and_cycle(tmp_path):
+    path = str(tmp_path / "upstream.cassette.jsonl.gz")
+    recorder = Cassette(path, "record")
+    for text in ("first", "second"):
+        recorder.record("gemini", "k", "generate_content", 0.01, prompt="p", text=text)
+    recorder.close()
+
+    player = Cassette(path, "replay", time_scale=0)
+    assert [player.next("gemini", "k")["text"] for _ in range(3)] == ["first", "second", "first"]
+
+
+def test_recorded_gemini_error_is_raised_again_on_replay(tmp_path):
+    path = str(tmp_path / "upstream.cassette.jsonl.gz")
+    recorder = Cassette(path, "record")
+    failing = CassetteModel(FakeGeminiModel(Faults(error_rate=1.0, seed=1), seed=1), recorder)
+    with pytest.raises(Exception):
+        failing.generate_content(PROMPT)
+    recorder.close()
+
+    player = CassetteModel(FakeGeminiModel(seed=1), Cassette(path, "replay", time_scale=0))
+    with pytest.raises(ReplayedError):
+        player.generate_content(PROMPT)
+
+
+def test_unrecorded_call_is_a_miss(tmp_path):
+    path = str(tmp_path / "upstream.cassette.jsonl.gz")
+    Cassette(path, "record").close()
+
+    player = Cassette(path, "replay", time_scale=0)
+    with pytest.raises(CassetteMiss):
+        CassetteModel(FakeGeminiModel(seed=1), player).generate_content(PROMPT)
+    assert player.get_stats()["misses"] == 1
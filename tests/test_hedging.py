@@ -0,0 +1,158 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from deadline import Deadline, within
+from hedging import Hedger
+
+
+def primed(**kwargs):
+    """A Hedger that has seen enough 10ms /search calls to hedge after 10ms."""
+    kwargs.setdefault("min_samples", 5)
+    kwargs.setdefault("min_delay", 0.01)
+    hedger = Hedger(**kwargs)
+    for _ in range(hedger.min_samples):
+        hedger.observe("search", 0.01)
+    return hedger
+
+
+def slow_primary(hedge_delay=0.0, primary_delay=1.0):
+    """attempt() whose first try hangs for primary_delay and whose hedge answers after hedge_delay."""
+    release = threading.Event()
+
+    def attempt(hedge):
+        if hedge:
+            time.sleep(hedge_delay)
+            return "hedge"
+        release.wait(primary_delay)
+        return "primary"
+
+    attempt.release = release
+    return attempt
+
+
+def test_operation_without_enough_samples_is_not_hedged():
+    hedger = Hedger(min_samples=5)
+    attempts = []
+    assert hedger.call("search", lambda hedge: attempts.append(hedge) or "ok") == "ok"
+    assert attempts == [False]
+    assert hedger.delay_for("search") is None
+
+
+def test_delay_is_the_percentile_of_recent_latencies():
+    hedger = Hedger(percentile=90, min_samples=10, min_delay=0.001)
+    for ms in range(1, 11):
+        hedger.observe("search", ms / 1000)
+    assert hedger.delay_for("search") == pytest.approx(0.009)
+
+
+def test_slow_primary_is_hedged_and_the_hedge_wins():
+    hedger = primed()
+    attempt = slow_primary()
+    try:
+        assert hedger.call("search", attempt) == "hedge"
+    finally:
+        attempt.release.set()
+    stats = hedger.get_stats()
+    assert stats["hedged"] == 1
+    assert stats["hedge_won"] == 1
+
+
+def test_fast_primary_is_not_hedged():
+    hedger = primed()
+    attempts = []
+
+    def attempt(hedge):
+        attempts.append(hedge)
+        return "primary"
+
+    assert hedger.call("search", attempt) == "primary"
+    assert attempts == [False]
+    assert hedger.get_stats()["hedged"] == 0
+
+
+def test_failed_hedge_still_waits_for_the_primary():
+    hedger = primed()
+
+    def attempt(hedge):
+        if hedge:
+            raise RuntimeError("hedge failed")
+        time.sleep(0.05)
+        return "primary"
+
+    assert hedger.call("search", attempt) == "primary"
+    assert hedger.get_stats()["primary_won"] == 1
+
+
+def test_hedges_stop_once_the_budget_is_spent():
+    hedger = primed(max_tokens=2, budget_ratio=0)
+    attempt = slow_primary(primary_delay=0.05)
+    results = [hedger.call("search", attempt) for _ in range(3)]
+
+    assert results == ["hedge", "hedge", "primary"]
+    stats = hedger.get_stats()
+    assert stats["hedged"] == 2
+    assert stats["over_budget"] == 1
+    assert stats["tokens"] == 0
+
+
+def test_calls_earn_back_budget():
+    hedger = primed(max_tokens=1, budget_ratio=0.5)
+    attempt = slow_primary(primary_delay=0.05)
+    # Starts full, so the first call is hedged; the second only earns half a token back
+    assert [hedger.call("search", attempt) for _ in range(2)] == ["hedge", "primary"]
+    assert hedger.get_stats()["tokens"] == 0.5
+    assert hedger.call("search", attempt) == "hedge"
+    assert hedger.get_stats()["hedged"] == 2
+
+
+def test_no_hedge_once_the_deadline_has_passed():
+    hedger = primed()
+    attempt = slow_primary(primary_delay=0.05)
+    with within(Deadline(0.005)):
+        assert hedger.call("search", attempt) == "primary"
+    assert hedger.get_stats()["hedged"] == 0
+
+
+def test_async_loser_is_cancelled():
+    hedger = primed()
+    cancelled = []
+
+    async def attempt(hedge):
+        if hedge:
+            return "hedge"
+        try:
+            await asyncio.sleep(1)
+        except asyncio.CancelledError:
+            cancelled.append(True)
+            raise
+        return "primary"
+
+    async def run():
+        result = await hedger.call_async("search", attempt)
+        await asyncio.sleep(0)
+        return result
+
+    assert asyncio.run(run()) == "hedge"
+    assert cancelled == [True]
+    assert hedger.get_stats()["hedge_won"] == 1
+
+
+def test_async_hedges_stop_once_the_budget_is_spent():
+    hedger = primed(max_tokens=1, budget_ratio=0)
+    attempts = []
+
+    async def attempt(hedge):
+        attempts.append(hedge)
+        if not hedge:
+            await asyncio.sleep(0.05)
+        return hedge
+
+    async def run():
+        return [await hedger.call_async("search", attempt) for _ in range(2)]
+
+    assert asyncio.run(run()) == [True, False]
+    assert attempts == [False, True, False]
+    assert hedger.get_stats()["over_budget"] == 1
@@ -0,0 +1,210 @@
+import asyncio
+import json
+import threading
+import time
+
+import pytest
+
+import jobs
+from jobs import FAILED, RUNNING, SUCCEEDED, JobQueue, JobQueueFull, job_key
+
+
+def wait_until_finished(job):
+    version = None
+    while not job.finished:
+        version = job.wait(version, 5)
+    return job
+
+
+def test_job_key_ignores_payload_key_order():
+    assert job_key("blend", {"a": 1, "b": [1, 2]}) == job_key("blend", {"b": [1, 2], "a": 1})
+    assert job_key("blend", {"a": 1}) != job_key("swap", {"a": 1})
+
+
+def test_job_runs_in_the_background_with_its_own_deadline():
+    queue = JobQueue(workers=1, deadline=30)
+    job, created = queue.submit("blend", {"user": 1}, lambda payload: {"echo": payload})
+
+    assert created
+    wait_until_finished(job)
+    assert job.state == SUCCEEDED
+    assert job.to_dict()["result"] == {"echo": {"user": 1}}
+    assert job.expires_at == job.finished_at + queue.result_ttl
+
+
+def test_identical_submissions_share_a_job():
+    queue = JobQueue(workers=1)
+    release = threading.Event()
+    runs = []
+
+    def pipeline(payload):
+        runs.append(payload)
+        release.wait(5)
+        return "done"
+
+    first, created = queue.submit("blend", {"a": 1, "b": 2}, pipeline)
+    again, created_again = queue.submit("blend", {"b": 2, "a": 1}, pipeline)
+    release.set()
+    wait_until_finished(first)
+    after, created_after = queue.submit("blend", {"a": 1, "b": 2}, pipeline)
+
+    assert created and not created_again and not created_after
+    assert again is first and after is first
+    assert len(runs) == 1
+    assert queue.get_stats()["deduplicated"] == 2
+
+
+def test_failed_job_is_not_reused():
+    queue = JobQueue(workers=1)
+    attempts = []
+
+    def pipeline(payload):
+        attempts.append(payload)
+        if len(attempts) == 1:
+            raise RuntimeError("gemini down")
+        return "ok"
+
+    failed, _ = queue.submit("swap", {"a": 1}, pipeline)
+    wait_until_finished(failed)
+    assert failed.to_dict()["error"] == "gemini down"
+
+    retried, created = queue.submit("swap", {"a": 1}, pipeline)
+    wait_until_finished(retried)
+    assert created and retried is not failed
+    assert retried.state == SUCCEEDED
+    # The failed job can still be looked up until its result expires
+    assert queue.get(failed.id).state == FAILED
+
+
+def test_finished_jobs_are_dropped_after_result_ttl(clock, monkeypatch):
+    monkeypatch.setattr(jobs, "time", clock)
+    queue = JobQueue(workers=1, result_ttl=300)
+    job, _ = queue.submit("blend", {"a": 1}, lambda payload: "ok")
+    wait_until_finished(job)
+
+    clock.advance(299)
+    assert queue.get(job.id) is job
+    clock.advance(1)
+    assert queue.get(job.id) is None
+    assert queue.get_stats()["expired"] == 1
+
+    # Its inputs run again
+    _, created = queue.submit("blend", {"a": 1}, lambda payload: "ok")
+    assert created
+
+
+def test_queue_turns_jobs_away_when_full():
+    queue = JobQueue(workers=1, max_pending=1)
+    release = threading.Event()
+    job, _ = queue.submit("blend", {"a": 1}, lambda payload: release.wait(5))
+    try:
+        with pytest.raises(JobQueueFull):
+            queue.submit("blend", {"a": 2}, lambda payload: None)
+    finally:
+        release.set()
+    wait_until_finished(job)
+    assert queue.get_stats()["rejected"] == 1
+
+
+def test_submit_async_runs_on_the_loop_and_deduplicates():
+    queue = JobQueue(workers=1)
+    runs = []
+
+    async def pipeline(payload):
+        runs.append(payload)
+        await asyncio.sleep(0.01)
+        return "ok"
+
+    async def run():
+        job, created = await queue.submit_async("blend", {"a": 1}, pipeline)
+        again, created_again = await queue.submit_async("blend", {"a": 1}, pipeline)
+        version = None
+        while not job.finished:
+            version = await job.wait_async(version, 5)
+        return job, created, again is job, created_again
+
+    job, created, shared, created_again = asyncio.run(run())
+    assert created and shared and not created_again
+    assert job.state == SUCCEEDED
+    assert runs == [{"a": 1}]
+
+
+# ---------- /jobs/<id>/events ----------
+
+@pytest.fixture
+def flask_app(monkeypatch):
+    import app as app_module
+
+    queue = JobQueue(workers=1)
+    release = threading.Event()
+
+    def pipeline(payload):
+        release.wait(5)
+        return {"items": payload["items"]}
+
+    monkeypatch.setattr(app_module, "job_queue", queue)
+    monkeypatch.setitem(app_module.JOB_PIPELINES, "blend-recommendations", pipeline)
+    yield app_module.app.test_client(), queue, release
+    release.set()
+
+
+def submit_running_job(client, queue):
+    response = client.post("/jobs/blend-recommendations", json={"items": [1, 2]})
+    assert response.status_code == 202
+    job = queue.get(response.get_json()["job"]["id"])
+    for _ in range(500):
+        if job.state == RUNNING:
+            break
+        time.sleep(0.01)
+    assert job.state == RUNNING
+    return job
+
+
+def test_job_events_are_state_then_done_as_ndjson(flask_app):
+    client, queue, release = flask_app
+    job = submit_running_job(client, queue)
+
+    response = client.get(f"/jobs/{job.id}/events")
+    assert response.mimetype == "application/x-ndjson"
+    chunks = iter(response.response)
+    first = json.loads(next(chunks))
+    release.set()
+    rest = [json.loads(line) for chunk in chunks for line in chunk.decode().splitlines() if line]
+
+    assert first == {"event": "state", "data": {"id": job.id, "state": RUNNING}}
+    assert [event["event"] for event in rest] == ["done"]
+    assert rest[0]["data"]["state"] == SUCCEEDED
+    assert rest[0]["data"]["result"] == {"items": [1, 2]}
+
+
+def test_job_events_as_sse(flask_app):
+    client, queue, release = flask_app
+    job = submit_running_job(client, queue)
+
+    response = client.get(f"/jobs/{job.id}/events", headers={"Accept": "text/event-stream"})
+    assert response.mimetype == "text/event-stream"
+    chunks = iter(response.response)
+    first = next(chunks).decode()
+    release.set()
+    frames = [chunk.decode() for chunk in chunks]
+
+    assert first == f'event: state\ndata: {json.dumps({"id": job.id, "state": RUNNING})}\n\n'
+    assert len(frames) == 1
+    event, data = frames[0].split("\n")[:2]
+    assert event == "event: done"
+    assert json.loads(data[len("data: "):])["state"] == SUCCEEDED
+
+
+def test_events_for_a_finished_job_are_just_done(flask_app):
+    client, queue, release = flask_app
+    release.set()
+    response = client.post("/jobs/blend-recommendations", json={"items": [3]})
+    job = wait_until_finished(queue.get(response.get_json()["job"]["id"]))
+
+    lines = client.get(f"/jobs/{job.id}/events").get_data(as_text=True).splitlines()
+    assert [json.loads(line)["event"] for line in lines] == ["done"]
+
+
+def test_events_for_an_unknown_job_are_404(flask_app):
+    client, _, _ = flask_app
+    assert client.get("/jobs/nope/events").status_code == 404
@@ -0,0 +1,107 @@
+import re
+
+import pytest
+
+from metrics import CONTENT_TYPE, REGISTRY, Counter, Gauge, Histogram, track_upstream, upstream_errors
+
+# One sample line: metric name, optional {label="value",...}, then the value
+SAMPLE = re.compile(r'^[a-zA-Z_:][a-zA-Z0-9_:]*(\{([a-zA-Z_][a-zA-Z0-9_]*="(\\.|[^"\\])*",?)*\})? (\+Inf|-?[0-9.e+-]+)$')
+
+
+def test_counter_exposition():
+    counter = Counter("test_calls_total", "Calls.", ("upstream",))
+    counter.inc("qloo")
+    counter.inc("qloo", amount=2)
+    counter.inc("gemini")
+
+    assert counter.expose() == [
+        "# HELP test_calls_total Calls.",
+        "# TYPE test_calls_total counter",
+        'test_calls_total{upstream="gemini"} 1',
+        'test_calls_total{upstream="qloo"} 3',
+    ]
+
+
+def test_gauge_goes_up_and_down():
+    gauge = Gauge("test_in_flight", "In flight.")
+    gauge.inc()
+    gauge.inc()
+    gauge.dec()
+    assert gauge.expose()[-1] == "test_in_flight 1"
+
+
+def test_histogram_buckets_are_cumulative_with_sum_and_count():
+    histogram = Histogram("test_seconds", "Latency.", ("operation",), buckets=(0.1, 1.0))
+    for seconds in (0.05, 0.5, 0.5, 3.0):
+        histogram.observe(seconds, "search")
+
+    assert histogram.expose()[2:] == [
+        'test_seconds_bucket{operation="search",le="0.1"} 1',
+        'test_seconds_bucket{operation="search",le="1.0"} 3',
+        'test_seconds_bucket{operation="search",le="+Inf"} 4',
+        'test_seconds_sum{operation="search"} 4.05',
+        'test_seconds_count{operation="search"} 4',
+    ]
+
+
+def test_label_values_are_escaped():
+    counter = Counter("test_escaped_total", "Escaping.", ("detail",))
+    counter.inc('say "hi"\\\n')
+    assert counter.expose()[-1] == 'test_escaped_total{detail="say \\"hi\\"\\\\\\n"} 1'
+
+
+def test_wrong_label_count_is_rejected():
+    with pytest.raises(ValueError):
+        Counter("test_labels_total", "Labels.", ("a", "b")).inc("only-one")
+
+
+def test_track_upstream_counts_errors():
+    before = dict(upstream_errors._values)
+    with pytest.raises(RuntimeError):
+        with track_upstream("qloo", "test-operation"):
+            raise RuntimeError("boom")
+    assert upstream_errors._values[("qloo", "test-operation")] == before.get(("qloo", "test-operation"), 0) + 1
+
+
+def test_metrics_endpoint_serves_prometheus_text():
+    import app as app_module
+
+    client = app_module.app.test_client()
+    client.get("/cache-stats")
+    response = client.get("/metrics")
+
+    assert response.status_code == 200
+    assert response.headers["Content-Type"] == CONTENT_TYPE
+    text = response.get_data(as_text=True)
+    assert text.endswith("\n")
+
+    lines = text.splitlines()
+    for metric in REGISTRY:
+        assert f"# TYPE {metric.name} {metric.type_name}" in lines
+    for line in lines:
+        if not line.startswith("#"):
+            assert SAMPLE.match(line), line
+    assert any(
+        line.startswith('taste_http_request_duration_seconds_count{endpoint="/cache-stats",method="GET",status="200"}')
+        for line in lines
+    )
+
+
+def test_metrics_endpoint_parses_as_prometheus_text():
+    parser = pytest.importorskip("prometheus_client.parser")
+    import app as app_module
+
+    client = app_module.app.test_client()
+    client.get("/cache-stats")
+    families = {
+        family.name: family
+        for family in parser.text_string_to_metric_families(client.get("/metrics").get_data(as_text=True))
+    }
+
+    duration = families["taste_http_request_duration_seconds"]
+    assert duration.type == "histogram"
+    assert {sample.name for sample in duration.samples} >= {
+        "taste_http_request_duration_seconds_bucket",
+        "taste_http_request_duration_seconds_sum",
+        "taste_http_request_duration_seconds_count",
+    }
@@ -0,0 +1,83 @@
+import pytest
+
+import recommendation
+from moods import MOOD_CLUSTERS, PHRASES, activities_for_mood, classify_mood
+
+
+@pytest.mark.parametrize("mood, cluster", [
+    # Plain keywords, in any case and with punctuation around them
+    ("happy", "happy"),
+    ("Feeling CHILL today!", "calm"),
+    ("kinda anxious...", "stressed"),
+    # Negation flips to the opposite cluster, or drops the word when there is none
+    ("not happy", "sad"),
+    ("I'm not sad at all", "happy"),
+    ("don't feel calm", "stressed"),
+    ("not feeling happy", "sad"),
+    ("no stress", "calm"),
+    ("never tired", "happy"),
+    ("not angry, just bored", "tired"),
+    # Suffixes are stripped back to the lexicon word
+    ("sadder than yesterday", "sad"),
+    ("happiest day", "happy"),
+    ("relaxing", "calm"),
+    ("stressing out", "stressed"),
+    ("lonelier", "sad"),
+    # Phrases win over the words in them
+    ("down to earth", None),
+    ("down to earth and relaxed", "calm"),
+    ("down for anything", None),
+    ("feeling down", "sad"),
+    ("fed up", "angry"),
+    ("well fed", None),
+    ("a bit on edge", "stressed"),
+    ("under the weather", "tired"),
+    ("not fed up", None),
+    # More hits win; ties go to the cluster listed first
+    ("sad but happy but happy", "happy"),
+    ("happy and sad", "happy"),
+    # Nothing the lexicon knows
+    ("", None),
+    ("meeting my friends", None),
+    ("I am not sure", None),
+])
+def test_classify_mood(mood, cluster):
+    assert classify_mood(mood) == cluster
+
+
+def test_phrases_point_to_known_clusters():
+    for cluster in PHRASES.values():
+        assert cluster is None or cluster in MOOD_CLUSTERS
+
+
+@pytest.fixture
+def gemini_moods(monkeypatch):
+    """Records moods sent on to Gemini instead of calling it."""
+    sent = []
+
+    def fake(mood):
+        sent.append(mood)
+        return {"music": "From Gemini"}
+
+    monkeypatch.setattr(recommendation, "get_gemini_activity_recommendations_by_mood", fake)
+    return sent
+
+
+@pytest.mark.parametrize("mood", ["flibbertigibbet", "down to earth", "meeting my friends"])
+def test_unknown_mood_falls_back_to_gemini(mood, gemini_moods):
+    assert recommendation.get_activity_recommendations_by_mood(mood) == {"music": "From Gemini"}
+    assert gemini_moods == [mood]
+
+
+def test_known_mood_is_served_from_pools(gemini_moods, monkeypatch):
+    monkeypatch.setattr(recommendation.mood_example_pool, "pop", lambda key: f"Pooled {key[1]}")
+    assert recommendation.get_activity_recommendations_by_mood("not happy") == {
+        activity: f"Pooled {activity}" for activity in activities_for_mood("sad")
+    }
+    assert gemini_moods == []
+
+
+def test_known_mood_with_empty_pools_falls_back_to_gemini(gemini_moods, monkeypatch):
+    monkeypatch.setattr(recommendation.mood_example_pool, "pop", lambda key: None)
+    recommendation.get_activity_recommendations_by_mood("happy")
+    assert gemini_moods == ["happy"]
@@ -0,0 +1,136 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+import pools
+from pools import CandidatePool
+
+
+@pytest.fixture(autouse=True)
+def fake_time(clock, monkeypatch):
+    monkeypatch.setattr(pools, "time", clock)
+
+
+def pages(*items_per_fetch):
+    """fetch_page that returns the given pages in turn, recording every key it was asked for."""
+    remaining = list(items_per_fetch)
+    calls = []
+
+    def fetch_page(key):
+        calls.append(key)
+        return list(remaining.pop(0))
+
+    fetch_page.calls = calls
+    return fetch_page
+
+
+def wait_for(condition):
+    for _ in range(200):
+        if condition():
+            return
+        time.sleep(0.01)
+    raise AssertionError("condition not met")
+
+
+def test_hands_out_non_repeating_slices_from_one_fetch():
+    fetch_page = pages(range(10))
+    candidates = CandidatePool(fetch_page)
+
+    assert candidates.take("k", 3) == [0, 1, 2]
+    assert candidates.take("k", 3) == [3, 4, 5]
+    assert fetch_page.calls == ["k"]
+    assert candidates.get_stats()["page_fetches"] == 1
+
+
+def test_served_dicts_are_copies():
+    candidates = CandidatePool(pages([{"name": "Heat"}]))
+    first = candidates.take("k", 1)
+    first[0]["name"] = "changed"
+    assert candidates.take("k", 1) == [{"name": "Heat"}]
+
+
+def test_exhausted_pool_wraps_around_and_refills_once_in_background():
+    release = threading.Event()
+    fetched = pages(range(5), ["a", "b", "c", "d", "e"])
+
+    def fetch_page(key):
+        if fetched.calls:
+            release.wait(5)
+        return fetched(key)
+
+    candidates = CandidatePool(fetch_page)
+    assert candidates.take("k", 3) == [0, 1, 2]
+    # Too few left for another full slice: wrap around while one refill runs
+    assert candidates.take("k", 3) == [3, 4, 0]
+    assert candidates.take("k", 3) == [1, 2, 3]
+    release.set()
+    wait_for(lambda: candidates.get_stats()["refills"] == 1)
+
+    assert len(fetched.calls) == 2
+    assert sorted(candidates.take("k", 5)) == ["a", "b", "c", "d", "e"]
+
+
+def test_expired_pool_is_refilled(clock):
+    fetch_page = pages(range(10), range(10, 20))
+    candidates = CandidatePool(fetch_page, ttl=60)
+    candidates.take("k", 2)
+
+    clock.advance(61)
+    assert candidates.take("k", 2) == [2, 3]
+    wait_for(lambda: candidates.get_stats()["refills"] == 1)
+    assert all(item >= 10 for item in candidates.take("k", 2))
+
+
+def test_failed_refill_keeps_the_old_page():
+    def fetch_page(key):
+        if fetch_page.calls:
+            raise RuntimeError("qloo down")
+        fetch_page.calls.append(key)
+        return [1, 2]
+
+    fetch_page.calls = []
+    candidates = CandidatePool(fetch_page)
+    candidates.take("k", 2)
+    candidates.take("k", 2)
+    time.sleep(0.05)
+    assert candidates.take("k", 2) == [1, 2]
+    assert candidates.get_stats()["refills"] == 0
+
+
+def test_empty_page_is_not_pooled():
+    fetch_page = pages([], [1])
+    candidates = CandidatePool(fetch_page)
+    assert candidates.take("k", 2) == []
+    assert candidates.take("k", 2) == [1]
+    assert candidates.get_stats()["page_fetches"] == 2
+
+
+def test_least_recently_used_key_is_dropped_beyond_max_keys():
+    fetch_page = pages(*[range(10)] * 4)
+    candidates = CandidatePool(fetch_page, max_keys=2)
+    candidates.take("a", 1)
+    candidates.take("b", 1)
+    candidates.take("a", 1)
+    candidates.take("c", 1)
+
+    assert candidates.get_stats()["pools"] == 2
+    candidates.take("b", 1)
+    assert fetch_page.calls == ["a", "b", "c", "b"]
+
+
+def test_take_async_fetches_once_and_slices():
+    calls = []
+
+    async def fetch_page_async(key):
+        calls.append(key)
+        return list(range(10))
+
+    candidates = CandidatePool(None, fetch_page_async=fetch_page_async)
+
+    async def run():
+        return [await candidates.take_async("k", 3), await candidates.take_async("k", 3)]
+
+    assert asyncio.run(run()) == [[0, 1, 2], [3, 4, 5]]
+    assert calls == ["k"]
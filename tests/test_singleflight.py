@@ -0,0 +1,155 @@
+import asyncio
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from deadline import Deadline, DeadlineExceeded, end_deadline, start_deadline, within
+from singleflight import SingleFlight
+
+
+def run_together(flights, key, fn, callers):
+    """Call flights.do(key, fn) from `callers` threads, the first one to arrive running fn."""
+    started = threading.Event()
+    release = threading.Event()
+
+    def blocking():
+        started.set()
+        release.wait(5)
+        return fn()
+
+    def call(_):
+        try:
+            return flights.do(key, blocking)
+        except Exception as e:
+            return e
+
+    with ThreadPoolExecutor(max_workers=callers) as pool:
+        first = pool.submit(call, None)
+        started.wait(5)
+        rest = [pool.submit(call, None) for _ in range(callers - 1)]
+        while flights.get_stats()["collapsed"] < callers - 1:
+            time.sleep(0.001)
+        release.set()
+        return [first.result()] + [future.result() for future in rest]
+
+
+def test_identical_calls_share_one_run():
+    flights = SingleFlight()
+    runs = []
+
+    def fn():
+        runs.append(1)
+        return {"entity_id": "A1"}
+
+    results = run_together(flights, ("search", "heat"), fn, callers=5)
+
+    assert results == [{"entity_id": "A1"}] * 5
+    assert len(runs) == 1
+    stats = flights.get_stats()
+    assert stats["calls"] == 1
+    assert stats["collapsed"] == 4
+    assert stats["in_flight"] == 0
+
+
+def test_error_reaches_every_waiter():
+    flights = SingleFlight()
+
+    def fn():
+        raise RuntimeError("qloo down")
+
+    results = run_together(flights, "k", fn, callers=4)
+
+    assert all(isinstance(result, RuntimeError) for result in results)
+    # Nothing is remembered: the next call runs again
+    assert flights.do("k", lambda: "ok") == "ok"
+
+
+def test_different_keys_run_separately():
+    flights = SingleFlight()
+    assert flights.do("a", lambda: 1) == 1
+    assert flights.do("b", lambda: 2) == 2
+    assert flights.get_stats()["collapsed"] == 0
+
+
+def test_waiter_gives_up_at_its_own_deadline():
+    flights = SingleFlight("qloo")
+    started = threading.Event()
+    release = threading.Event()
+
+    def slow():
+        started.set()
+        release.wait(5)
+        return "late"
+
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        leader = pool.submit(flights.do, "k", slow)
+        started.wait(5)
+        deadline, token = start_deadline(0.05)
+        try:
+            with pytest.raises(DeadlineExceeded):
+                flights.do("k", slow)
+            assert deadline.degraded() == [{"part": "qloo", "reason": "deadline"}]
+        finally:
+            end_deadline(token)
+            release.set()
+        assert leader.result() == "late"
+
+
+def test_async_calls_share_one_run_and_error():
+    flights = SingleFlight()
+    runs = []
+
+    async def fn():
+        runs.append(1)
+        await asyncio.sleep(0.01)
+        raise RuntimeError("gemini down")
+
+    async def call():
+        try:
+            return await flights.do_async("k", fn)
+        except RuntimeError as e:
+            return e
+
+    async def run():
+        return await asyncio.gather(*(call() for _ in range(4)))
+
+    results = asyncio.run(run())
+
+    assert len(runs) == 1
+    assert all(isinstance(result, RuntimeError) for result in results)
+    assert flights.get_stats()["in_flight"] == 0
+
+
+def test_cancelling_the_first_async_caller_leaves_the_call_running():
+    flights = SingleFlight()
+
+    async def fn():
+        await asyncio.sleep(0.02)
+        return "done"
+
+    async def run():
+        first = asyncio.ensure_future(flights.do_async("k", fn))
+        await asyncio.sleep(0)
+        second = asyncio.ensure_future(flights.do_async("k", fn))
+        await asyncio.sleep(0)
+        first.cancel()
+        return await second
+
+    assert asyncio.run(run()) == "done"
+
+
+def test_async_waiter_gives_up_at_its_own_deadline():
+    flights = SingleFlight("gemini")
+
+    async def fn():
+        await asyncio.sleep(1)
+
+    async def run():
+        with within(Deadline(0.02)):
+            with pytest.raises(DeadlineExceeded):
+                await flights.do_async("k", fn)
+
+    asyncio.run(run())
@@ -0,0 +1,132 @@
+import contextvars
+import functools
+import threading
+import time
+
+from contextlib import contextmanager
+
+# Trace of the request being handled in this context, or None outside a request.
+# Executor work only sees it when submitted with submit_in_context().
+_current_trace = contextvars.ContextVar("current_trace", default=None)
+
+
+class Trace:
+    """Spans recorded while handling one request, as offsets from its start."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.spans = []
+        self._lock = threading.Lock()
+
+    def add(self, name, start, duration, detail=None, attrs=None):
+        span = {
+            "name": name,
+            "start_ms": round((start - self.started) * 1000, 2),
+            "duration_ms": round(duration * 1000, 2),
+            "thread": threading.current_thread().name,
+        }
+        if detail:
+            span["detail"] = detail
+        if attrs:
+            span.update(attrs)
+        with self._lock:
+            self.spans.append(span)
+
+    def elapsed_ms(self):
+        return round((time.perf_counter() - self.started) * 1000, 2)
+
+    def waterfall(self):
+        with self._lock:
+            return sorted(self.spans, key=lambda span: span["start_ms"])
+
+    def server_timing(self):
+        """Server-Timing header value: summed duration and count per span name, plus the total."""
+        totals = {}
+        with self._lock:
+            for span in self.spans:
+                duration, count = totals.get(span["name"], (0.0, 0))
+                totals[span["name"]] = (duration + span["duration_ms"], count + 1)
+
+        metrics = [f'{name};dur={duration:.1f};desc="{count}x"' for name, (duration, count) in totals.items()]
+        metrics.append(f"total;dur={self.elapsed_ms():.1f}")
+        return ", ".join(metrics)
+
+
+class _SharedTrace:
+    """Records each span in several requests' traces, for work done on behalf of all of them."""
+
+    def __init__(self, traces):
+        self.traces = traces
+
+    def add(self, name, start, duration, detail=None, attrs=None):
+        for trace in self.traces:
+            trace.add(name, start, duration, detail, attrs)
+
+
+def start_trace():
+    """Begin a trace for the current request; pass the token to end_trace()."""
+    trace = Trace()
+    return trace, _current_trace.set(trace)
+
+
+def end_trace(token):
+    _current_trace.reset(token)
+
+
+def current_trace():
+    return _current_trace.get()
+
+
+@contextmanager
+def shared_trace(traces):
+    """Record the enclosed block's spans in every one of `traces` (requests' traces, or None outside a request)."""
+    traces = [trace for trace in dict.fromkeys(traces) if trace is not None]
+    token = _current_trace.set(_SharedTrace(traces) if traces else None)
+    try:
+        yield
+    finally:
+        _current_trace.reset(token)
+
+
+@contextmanager
+def span(name, detail=None, **attrs):
+    """Time the enclosed block as a span of the current request. A no-op outside a request."""
+    trace = _current_trace.get()
+    if trace is None:
+        yield attrs
+        return
+
+    start = time.perf_counter()
+    try:
+        # Callers may add attributes (e.g. cache="hit") while the span is open
+        yield attrs
+    finally:
+        trace.add(name, start, time.perf_counter() - start, detail, attrs)
+
+
+def mark(name, detail=None, **attrs):
+    """Record an instant event, such as a cache hit, in the current request's waterfall."""
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.add(name, time.perf_counter(), 0.0, detail, attrs)
+
+
+def traced(name):
+    """Decorator form of span(), using the function name as the detail."""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(name, fn.__name__):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def submit_in_context(executor, fn, *args, **kwargs):
+    """executor.submit() that carries the caller's trace into the worker thread."""
+    return executor.submit(contextvars.copy_context().run, fn, *args, **kwargs)
+
+
+def wants_timing_debug(args, headers):
+    """True when a request opts into the timing waterfall via ?debug=timing or X-Debug-Timing: 1."""
+    return args.get("debug") == "timing" or headers.get("X-Debug-Timing") == "1"